@@ -0,0 +1,106 @@
+""" Per-vehicle context for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+One process serves one or more vehicles, each with an Agent holding its configuration,
+device id, Cometa connection, vehicle services and telemetry schedule. The RPC methods and
+the event senders use the agent current in the calling thread: callbacks registered with
+the Cometa connection, the vehicle and the services are wrapped by Agent.bind, so that they
+run with their agent current in whatever thread invokes them. The default agent is used by
+the threads not bound to any, and is set when the process serves a single vehicle.
+"""
+
+__all__ = ["Agent", "AgentAttribute", "current_agent", "set_default_agent"]
+
+import threading
+
+_local = threading.local()
+_default = None
+
+def current_agent():
+    """
+    Return the agent current in the calling thread.
+    """
+    return getattr(_local, 'agent', None) or _default
+
+def set_default_agent(agent):
+    global _default
+    _default = agent
+
+class Agent(object):
+    """
+    The state of a vehicle served by the process.
+    """
+
+    def __init__(self, index, device_id, config):
+        """
+        index: position of the vehicle in the configuration
+        device_id: Cometa device id
+        config: the configuration of the vehicle
+        """
+        self.index = index
+        self.device_id = device_id
+        self.config = config
+        self.status = None
+        self.vehicle = None
+        self.vsitl = None
+        self.com = None
+        self.subscription_manager = None
+        self.geofence = None
+        self.setpoint_streamer = None
+        self.stream_rates = None
+        self.mavlink_tunnel = None
+        self.log_downloader = None
+        self.mission_progress = None
+        self.home_location = None
+        self.reply_cache = None
+        self.time_sync = None
+        self.telemetry_period = config['app_params']['telemetry_period']
+        self.telemetry_attributes_names = []
+        self.sent = 0               # data events sent upstream
+        self.send_errors = 0        # data events refused by the Cometa client
+
+    def bind(self, func):
+        """
+        Return a function invoking func with this agent current.
+        """
+        def bound(*args, **kwargs):
+            previous = getattr(_local, 'agent', None)
+            _local.agent = self
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.agent = previous
+        return bound
+
+class AgentAttribute(object):
+    """
+    Proxy to an attribute of the current agent, such as its vehicle.
+    """
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_agent(), self._name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(getattr(current_agent(), self._name), attr, value)
+
+    def __nonzero__(self):
+        return bool(getattr(current_agent(), self._name))
@@ -17,19 +17,28 @@ limitations under the License.
 """
 
 import time
+import math
 import sys, getopt
 import string
 import json
+import heapq
+import base64
 import subprocess
 from uuid import getnode as get_mac
 from time import gmtime, strftime
 
 from runtime import Runtime
+from configuration import ConfigError, freeze
+from agent import Agent, AgentAttribute, current_agent, set_default_agent
 from cometalib import CometaClient
-
-from dronekit import connect, VehicleMode, LocationGlobal, LocationGlobalRelative, Command
-from pymavlink import mavutil
+from shell import ShellCommand, MAX_TIMEOUT, MAX_RUN_TIMEOUT, MAX_OUTPUT
+from subscriptions import SubscriptionManager
+from replycache import ReplyCache
+from timesync import TimeSync
+from startup import Startup
+from profiler import Sampler, MethodStats
 import utils
+import logger
 
 import pdb
 
@@ -44,39 +53,142 @@ JSON_RPC_INVALID_PARAMS_FMT_NUM = '{"jsonrpc":"2.0","error":{"code": -32602,"mes
 JSON_RPC_INTERNAL_ERROR_FMT_STR = '{"jsonrpc":"2.0","error":{"code": -32603,"message":"Method not found"},"id": %s}'
 JSON_RPC_INTERNAL_ERROR_FMT_NUM = '{"jsonrpc":"2.0","error":{"code": -32602,"message":"Method not found"},"id": %d}'
 
+# Upstream data event message types
+MSG_TELEMETRY = 1
+MSG_SHELL_OUTPUT = 2
+MSG_SUBSCRIPTION = 3
+MSG_SETPOINT_BRAKE = 4
+MSG_GEOFENCE = 5
+MSG_PROFILE = 6
+MSG_MAVLINK = 7
+MSG_LOG_DATA = 8
+MSG_MISSION = 9
+
+# Device status
+STATUS_CONNECTING = "vehicle connecting"
+STATUS_READY = "OK"
+
 # shortcut to refer to the system log in Runtime
 Runtime.init_runtime()
 syslog = Runtime.syslog
 
+# agents of the vehicles served by the process
+global agents
+agents = []
+
+# the state of the vehicle of the agent current in the calling thread
+vehicle = AgentAttribute('vehicle')
+com = AgentAttribute('com')
+subscription_manager = AgentAttribute('subscription_manager')
+geofence = AgentAttribute('geofence')
+setpoint_streamer = AgentAttribute('setpoint_streamer')
+stream_rates = AgentAttribute('stream_rates')
+mavlink_tunnel = AgentAttribute('mavlink_tunnel')
+log_downloader = AgentAttribute('log_downloader')
+mission_progress = AgentAttribute('mission_progress')
+home_location = AgentAttribute('home_location')
+reply_cache = AgentAttribute('reply_cache')
+time_sync = AgentAttribute('time_sync')
+
+# telemetry attributes sent by default
+TELEMETRY_ATTRIBUTES = ['attitude','location','velocity','battery','state','groundspeed','airspeed','mode','armed']
+
 # --------------------
 # 
 # RPC Methods
 
+def _shell_options(params, max_timeout=MAX_TIMEOUT):
+    """Get the optional {'timeout': seconds, 'max_output': bytes} object following the command in a shell request.
+
+    Return None if a limit is not a positive number within its cap.
+    """
+
+    options = {}
+    if len(params) > 1 and type(params[1]) is dict:
+        for k, cap in (('timeout', max_timeout), ('max_output', MAX_OUTPUT)):
+            if k in params[1]:
+                x = params[1][k]
+                if not utils.isnumber(x) or not 0 < x <= cap:
+                    return None
+                options[k] = x
+    return options
+
 def _shell(params):
     """Start a subprocess shell to execute the specified command and return its output.
 
-    params - a one element list ["/bin/cat /etc/hosts"]
+    params - a one element list ["/bin/cat /etc/hosts"] with an optional options object
+        ["/bin/dmesg", {"timeout": 10, "max_output": 65536}]
     """
 
     # check that params is a list
     if not isinstance(params, list) or len(params) == 0:
        return "Parameter must be a not empty list"    
     command = params[0]
+    # the command runs in the receive thread
+    options = _shell_options(params, MAX_RUN_TIMEOUT)
+    if options is None:
+        return {"success": False}
     try:
-        subprocess.check_call(command,shell=True)
-        out = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE).stdout.read()
-        return '\n' + out.decode()
+        cmd = ShellCommand(command, **options)
+        returncode, out, err = cmd.run()
+        if cmd.timed_out or cmd.truncated:
+            # killed by the agent, with the output captured until then
+            return {"output": '\n' + out.decode('utf-8', 'replace'), "returncode": returncode,
+                "timeout": cmd.timed_out, "truncated": cmd.truncated}
+        if returncode != 0:
+            return "{\"msg\":\"Invalid command.\"}"
+        return '\n' + out.decode('utf-8', 'replace')
     except Exception, e:
         print e
         return "{\"msg\":\"Invalid command.\"}"
 
+def _shell_stream(params, rpc_id):
+    """Start a subprocess shell to execute the specified command and stream its output upstream.
+
+    The reply is returned immediately. Output is sent as data events of type MSG_SHELL_OUTPUT tagged
+    with the id of the request, the last one with 'done' set and the command exit status.
+
+    params - a one element list ["/bin/dmesg"] with an optional options object
+        ["/usr/bin/tail -f /var/log/syslog", {"timeout": 60, "max_output": 65536}]
+    """
+
+    if not isinstance(params, list) or len(params) == 0:
+        return {"success": False}
+    options = _shell_options(params)
+    if options is None:
+        return {"success": False}
+    seq = [0]
+    agent = current_agent()
+
+    # invoked in the threads of the command
+    @agent.bind
+    def output_cb(stream, data):
+        msg = {'rpc_id': rpc_id, 'seq': seq[0], 'stream': stream, 'data': data.decode('utf-8', 'replace')}
+        seq[0] += 1
+        send_event(MSG_SHELL_OUTPUT, msg, CometaClient.PRIORITY_BULK)
+
+    @agent.bind
+    def done_cb(cmd):
+        msg = {'rpc_id': rpc_id, 'seq': seq[0], 'done': True, 'returncode': cmd.returncode,
+            'timeout': cmd.timed_out, 'truncated': cmd.truncated}
+        send_event(MSG_SHELL_OUTPUT, msg)
+
+    try:
+        cmd = ShellCommand(params[0], output_cb=output_cb, **options)
+    except Exception, e:
+        print e
+        return {"success": False}
+    cmd.start(done_cb)
+    return {"success": True}
+
 def _video_devices(params):
     """List available video devices (v4l)."""
 
-    vdevices = Runtime.list_camera_devices()
+    devices = Runtime.video_inventory().devices()
     ret = {}
-    ret['devices'] = vdevices[0]
-    ret['names'] = vdevices[1]
+    ret['devices'] = [d['device'] for d in devices]
+    ret['names'] = [d['name'] for d in devices]
+    ret['details'] = devices
     return ret
 
 def _get_autopilot_attributes(params):
@@ -91,31 +203,42 @@ def _get_autopilot_attributes(params):
 global attribute_names
 attribute_names = ('attitude','location','velocity','gps','gimbal','battery','ekf_ok','last_heartbeat','rangefinder','heading','armable','state','groundspeed','airspeed','mode','armed')
 
-def _get_vehicle_attributes(params):
-    """Get all vehicle attributes."""
+def _get_location(vehicle):
+    """Get the vehicle location in the global, relative and local frames."""
 
-    ret = {}
-    ret['attitude'] = vehicle.attitude.__dict__
     f = vehicle.location.global_frame
     r = vehicle.location.global_relative_frame
     l = vehicle.location.local_frame
-    ret['location'] = {'global':{'lat':f.lat,'lon':f.lon,'alt':f.alt}, 'relative':{'lat':r.lat,'lon':r.lon,'alt':r.alt},'local':{'north':l.north,'east':l.east,'down':l.down}}
-    ret['velocity'] = vehicle.velocity
-    ret['gps'] = vehicle.gps_0.__dict__
-    ret['gimbal'] = {'pitch' : vehicle.gimbal._pitch, 'yaw': vehicle.gimbal._yaw, 'roll': vehicle.gimbal._roll}
-    ret['battery'] = vehicle.battery.__dict__
-    ret['ekf_ok'] = vehicle.ekf_ok
-    ret['last_heartbeat'] = vehicle.last_heartbeat
-    ret['rangefinder'] =  vehicle.rangefinder.__dict__
-    ret['heading'] = vehicle.heading
-    ret['armable'] = vehicle.is_armable
-    ret['state'] =vehicle.system_status.state
-    ret['groundspeed'] = vehicle.groundspeed
-    ret['airspeed'] = vehicle.airspeed
-    ret['mode'] = vehicle.mode.name
-    ret['armed'] = vehicle.armed
-    return ret
+    return {'global':{'lat':f.lat,'lon':f.lon,'alt':f.alt}, 'relative':{'lat':r.lat,'lon':r.lon,'alt':r.alt},'local':{'north':l.north,'east':l.east,'down':l.down}}
+
+# functions returning the value of each attribute of a vehicle
+global attribute_getters
+attribute_getters = {'attitude': lambda vehicle: vehicle.attitude.__dict__,
+                     'location': _get_location,
+                     'velocity': lambda vehicle: vehicle.velocity,
+                     'gps': lambda vehicle: vehicle.gps_0.__dict__,
+                     'gimbal': lambda vehicle: {'pitch' : vehicle.gimbal._pitch, 'yaw': vehicle.gimbal._yaw, 'roll': vehicle.gimbal._roll},
+                     'battery': lambda vehicle: vehicle.battery.__dict__,
+                     'ekf_ok': lambda vehicle: vehicle.ekf_ok,
+                     'last_heartbeat': lambda vehicle: vehicle.last_heartbeat,
+                     'rangefinder': lambda vehicle: vehicle.rangefinder.__dict__,
+                     'heading': lambda vehicle: vehicle.heading,
+                     'armable': lambda vehicle: vehicle.is_armable,
+                     'state': lambda vehicle: vehicle.system_status.state,
+                     'groundspeed': lambda vehicle: vehicle.groundspeed,
+                     'airspeed': lambda vehicle: vehicle.airspeed,
+                     'mode': lambda vehicle: vehicle.mode.name,
+                     'armed': lambda vehicle: vehicle.armed,
+}
 
+def _get_vehicle_attributes(params):
+    """Get all vehicle attributes."""
+
+    ret = {}
+    v = current_agent().vehicle
+    for k in attribute_names:
+        ret[k] = attribute_getters[k](v)
+    return ret
 
 def _set_vehicle_attributes(params):
     """Set one or more vehicle attributes. Writable attributes 'armed','airspeed','groundspeed','mode'.
@@ -136,6 +259,8 @@ def _set_vehicle_attributes(params):
     if 'groundspeed' in params.keys():
         vehicle.groundspeed = params['groundspeed']
     if 'mode' in params.keys():
+        if params['mode'] != 'GUIDED':
+            _stop_setpoint()
         vehicle.mode = VehicleMode(params['mode'])
     return {"success": True}
 
@@ -157,17 +282,18 @@ def _set_vehicle_parameters(params):
     return {"success": True}
 
 def _get_home_location(params):
-    """Get Vehicle home location - will be `None` until first set by autopilot."""
-
-    while not vehicle.home_location:
-        cmds = vehicle.commands
-        cmds.download()
-        cmds.wait_ready()
-        if not vehicle.home_location:
-            pass
-    # TODO set a timeout
-    # return the home location.
-    return vehicle.home_location.__dict__
+    """Get Vehicle home location - will be unknown until first set by autopilot.
+
+    params - JSON object {'timeout':2} with the optional seconds waiting for the home location while unknown
+    """
+
+    timeout = params.get('timeout', 2.) if type(params) is dict else 2.
+    if not isinstance(timeout, (int, float)) or timeout < 0:
+        return {"success": False}
+    location = home_location.get(timeout)
+    if location is None:
+        return {"success": False}
+    return location.__dict__
 
 def _set_home_location(params):
     """Set home location in global coordinates.
@@ -177,7 +303,7 @@ def _set_home_location(params):
 
     if ('lat' and 'lon' and 'alt') not in params.keys():
         return {"success": False} 
-    vehicle.home_location = LocationGlobal(lat=params['lat'],lon=params['lon'],alt=params['alt'])
+    home_location.set(LocationGlobal(lat=params['lat'],lon=params['lon'],alt=params['alt']))
     return {"success": True}
 
 def _set_telemetry_period(params):
@@ -190,7 +316,8 @@ def _set_telemetry_period(params):
         return {"success": False}
     if params['period'] <= 0:
         return {"success": False}
-    config['app_params']['telemetry_period'] = params['period']
+    current_agent().telemetry_period = params['period']
+    update_stream_rates()
     return {"success": True}
 
 def _set_telemetry_attributes(params):
@@ -198,20 +325,259 @@ def _set_telemetry_attributes(params):
 
     params - An array of attribute names in the allowed set.
     """
-    global telemetry_attributes_names
 
     if type(params) is not list:
         return {"success": False}
 
     #tparams = tuple(params)
     tparams = params
-    allowed = ['attitude','location','velocity','battery','state','groundspeed','airspeed','mode','armed']
     for x in tparams:
-        if x not in allowed:
+        if x not in TELEMETRY_ATTRIBUTES:
+            return {"success": False}
+    current_agent().telemetry_attributes_names = list(params)
+    update_stream_rates()
+    return {"success": True}
+
+def _subscribe(params):
+    """Subscribe to updates of vehicle attributes pushed when their values change.
+
+    params - JSON object {"attributes": ["location","heading"], "max_rate": 5, "deadband": {"altitude": 0.5, "heading": 2.0}, "refresh": 10}
+        max_rate - maximum number of updates per second (optional)
+        deadband - minimum change of a quantity to push an update (optional), one of:
+            'altitude','distance' (meters), 'heading','roll','pitch','yaw' (degrees), 'groundspeed','airspeed' (m/s), 'voltage','level' (battery)
+        refresh - maximum interval in seconds between updates (optional)
+    """
+
+    if type(params) is not dict or 'attributes' not in params.keys():
+        return {"success": False}
+    if type(params['attributes']) is not list or len(params['attributes']) == 0:
+        return {"success": False}
+    for x in params['attributes']:
+        if x not in attribute_names:
+            return {"success": False}
+    max_rate = params.get('max_rate')
+    refresh = params.get('refresh')
+    deadband = params.get('deadband', {})
+    if type(deadband) is not dict:
+        return {"success": False}
+    for x in [max_rate, refresh] + deadband.values():
+        if x is not None and (not utils.isnumber(x) or x <= 0):
             return {"success": False}
-    telemetry_attributes_names = list(params)
+    try:
+        sid = subscription_manager.subscribe(params['attributes'], max_rate, deadband, refresh)
+    except ValueError:
+        return {"success": False}
+    update_stream_rates()
+    return {"success": True, "subscription": sid}
+
+def _unsubscribe(params):
+    """Cancel a subscription to vehicle attributes.
+
+    params - JSON object {"subscription": 1}
+    """
+
+    if type(params) is not dict or 'subscription' not in params.keys():
+        return {"success": False}
+    ret = subscription_manager.unsubscribe(params['subscription'])
+    update_stream_rates()
+    return {"success": ret}
+
+def _get_subscriptions(params):
+    """List the active subscriptions."""
+
+    return subscription_manager.subscriptions()
+
+def _get_reply_cache_stats(params):
+    """Get the statistics of the reply cache for retransmitted requests."""
+
+    return reply_cache.stats()
+
+def _get_time_sync(params):
+    """Get the estimate of the server time."""
+
+    return time_sync.status()
+
+def _profile(params, rpc_id):
+    """Sample the stacks of all threads and send them in a profile event when done.
+
+    {"duration":10, "interval":0.01}
+    """
+    global sampler
+    if params and not isinstance(params, dict):
+        return {"success": False}
+    params = params or {}
+    duration = params.get('duration', 10)
+    interval = params.get('interval', 0.01)
+    if not utils.isnumber(duration) or not utils.isnumber(interval) or duration <= 0 or interval <= 0:
+        return {"success": False}
+    if sampler and sampler.running():
+        return {"success": False, "running": True}
+    sampler = Sampler(duration, interval, current_agent().bind(lambda s: send_profile(rpc_id, s)))
+    sampler.start()
+    return {"success": True, "duration": sampler.duration}
+
+def _get_recording(params):
+    """Get the state of the recording of the Cometa traffic."""
+
+    return {"success": True, "recording": com.recorder.status() if com.recorder else None}
+
+def _get_rpc_stats(params):
+    """Get the wall and CPU time of the requests by method.
+
+    {"reset": true} to clear the statistics after reading them
+    """
+    stats = method_stats.stats()
+    if isinstance(params, dict) and params.get('reset'):
+        method_stats.reset()
+    return stats
+
+def _get_log(params):
+    """Get the most recent records of the system log.
+
+    {"count":100, "level":"warning"}
+    """
+    if params and not isinstance(params, dict):
+        return {"success": False}
+    params = params or {}
+    count = params.get('count')
+    if count is not None and (not isinstance(count, int) or count < 0):
+        return {"success": False}
+    if params.get('level', 'debug') not in logger.LEVELS:
+        return {"success": False}
+    log = Runtime.logger()
+    return {"records": log.records(count, logger.LEVELS[params.get('level', 'debug')]), "dropped": log.dropped}
+
+def configure_log(params):
+    """Apply the log parameters {"size":1024, "level":"info"} in app_params."""
+
+    log = Runtime.logger()
+    log_params = params.get('log', {})
+    log.level = logger.LEVELS[log_params.get('level', 'info')]
+    if 'size' in log_params:
+        log.resize(log_params['size'])
+
+def _geofence_check(lat, lon, alt, relative=True):
+    """Check a destination against the geofence. Return None if allowed or the reason of the breach.
+
+    The altitude is relative to home, unless relative is False.
+    """
+
+    if not geofence.active():
+        return None
+    if not relative:
+        # home altitude from the current position
+        alt -= vehicle.location.global_frame.alt - vehicle.location.global_relative_frame.alt
+    return geofence.check(lat, lon, alt)
+
+def _geofence_check_command(cmd):
+    """Check the position of a mission item navigation command against the geofence."""
+
+    if cmd.command >= mavutil.mavlink.MAV_CMD_NAV_LAST:
+        return None
+    if cmd.frame in (mavutil.mavlink.MAV_FRAME_GLOBAL, mavutil.mavlink.MAV_FRAME_GLOBAL_INT):
+        relative = False
+    elif cmd.frame in (mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT, mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT):
+        relative = True
+    else:
+        return None
+    if cmd.x == 0 and cmd.y == 0:
+        # commands without a position, such as takeoff, apply at the current position
+        cur = vehicle.location.global_relative_frame
+        return _geofence_check(cur.lat, cur.lon, cmd.z, relative)
+    return _geofence_check(cmd.x, cmd.y, cmd.z, relative)
+
+def _geofence_check_local(north, east, down):
+    """Check a destination in the local NED frame against the geofence, the frame origin taken as the home location."""
+
+    if not geofence.active():
+        return None
+    home = home_location.get(0)
+    if home is None:
+        return "home location unknown"
+    dest = utils.get_location_meters(LocationGlobalRelative(home.lat, home.lon, -down), north, east)
+    return _geofence_check(dest.lat, dest.lon, dest.alt)
+
+def _geofence_check_message(msg):
+    """Check the destination of a MAVLink position target or mission item against the geofence."""
+
+    mav = mavutil.mavlink
+    t = msg.get_type()
+    if t == 'MISSION_ITEM':
+        return _geofence_check_command(msg)
+    if t == 'MISSION_ITEM_INT':
+        return _geofence_check_command(Command(0, 0, 0, msg.frame, msg.command, 0, 0, 0, 0, 0, 0, msg.x / 1e7, msg.y / 1e7, msg.z))
+    if t not in ('SET_POSITION_TARGET_GLOBAL_INT', 'SET_POSITION_TARGET_LOCAL_NED') or msg.type_mask & 0b111 == 0b111:
+        # not a position setpoint
+        return None
+    if t == 'SET_POSITION_TARGET_GLOBAL_INT':
+        return _geofence_check(msg.lat_int / 1e7, msg.lon_int / 1e7, msg.alt,
+            msg.coordinate_frame not in (mav.MAV_FRAME_GLOBAL, mav.MAV_FRAME_GLOBAL_INT))
+    if msg.coordinate_frame == mav.MAV_FRAME_LOCAL_NED:
+        return _geofence_check_local(msg.x, msg.y, msg.z)
+    # offsets from the current position, rotated by the heading in the body frames
+    north, east = msg.x, msg.y
+    if msg.coordinate_frame in (mav.MAV_FRAME_BODY_NED, mav.MAV_FRAME_BODY_OFFSET_NED):
+        yaw = vehicle.attitude.yaw or 0.
+        north, east = msg.x * math.cos(yaw) - msg.y * math.sin(yaw), msg.x * math.sin(yaw) + msg.y * math.cos(yaw)
+    cur = vehicle.location.global_relative_frame
+    dest = utils.get_location_meters(cur, north, east)
+    return _geofence_check(dest.lat, dest.lon, cur.alt - msg.z)
+
+def _geofence_check_frames(data):
+    """Check the position targets and mission items in raw MAVLink frames against the geofence.
+
+    Frames that cannot be decoded are refused while the geofence is active.
+    """
+
+    if not geofence.active():
+        return None
+    parser = mavutil.mavlink.MAVLink(None)
+    parser.robust_parsing = True
+    try:
+        msgs = parser.parse_buffer(data) or []
+    except mavutil.mavlink.MAVError as e:
+        return "invalid frames: %s" % e
+    if parser.buf_len() or any(msg.get_type() == 'BAD_DATA' for msg in msgs):
+        return "invalid frames"
+    for msg in msgs:
+        breach = _geofence_check_message(msg)
+        if breach:
+            return breach
+    return None
+
+def _set_geofence(params):
+    """Set the geofence, replacing the current one.
+
+    params - JSON object {"polygons": [{"id": "KSFO", "type": "exclusion", "points": [[37.6, -122.4], [37.7, -122.4], [37.7, -122.3]]},
+                                       {"id": "field", "type": "inclusion", "points": [...], "ceiling": 120}],
+                          "ceiling": 150}
+        type - 'inclusion' or 'exclusion'
+        ceiling - maximum altitude in meters relative to home (optional)
+    """
+
+    if type(params) is not dict or 'polygons' not in params.keys():
+        return {"success": False}
+    if type(params['polygons']) is not list:
+        return {"success": False}
+    try:
+        geofence.load(params['polygons'], params.get('ceiling'))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return {"success": False, "error": str(e)}
+    update_stream_rates()
+    return {"success": True}
+
+def _clear_geofence(params):
+    """Remove the geofence."""
+
+    geofence.clear()
+    update_stream_rates()
     return {"success": True}
 
+def _get_geofence(params):
+    """Get the geofence and the current breach of the vehicle position."""
+
+    return geofence.info()
+
 def _takeoff(params):
     """Vehicle takeoff to the specified altitude.
 
@@ -223,6 +589,11 @@ def _takeoff(params):
     if ('alt') not in params.keys():
         return {"success": False}
     # TODO check for mode and that the vehicle is ready for takeoff
+    cur = vehicle.location.global_relative_frame
+    breach = _geofence_check(cur.lat, cur.lon, params['alt'])
+    if breach:
+        return {"success": False, "geofence": breach}
+    _stop_setpoint()
     vehicle.simple_takeoff(params['alt'])
     return {"success": True}
 
@@ -236,10 +607,14 @@ def _goto(params):
         return {"success": False}
     if ('lat' and 'lon' and 'alt' and 'relative') not in params.keys():
         return {"success": False}
+    breach = _geofence_check(params['lat'], params['lon'], params['alt'], params['relative'])
+    if breach:
+        return {"success": False, "geofence": breach}
     if params['relative']:
         dest = LocationGlobalRelative(params['lat'], params['lon'], params['alt'])
     else:
         dest = LocationGlobal(params['lat'], params['lon'], params['alt'])
+    _stop_setpoint()
     vehicle.simple_goto(dest)
     return {"success": True}
 
@@ -255,9 +630,27 @@ def _goto_destination(params):
         return {"success": False}
     curLocation = vehicle.location.global_relative_frame
     dest = utils.get_location_meters(curLocation, params['dNorth'], params['dEast'])
+    breach = _geofence_check(dest.lat, dest.lon, dest.alt)
+    if breach:
+        return {"success": False, "geofence": breach}
+    _stop_setpoint()
     vehicle.simple_goto(dest)
     return {"success": True}
 
+def _send_setpoint(msg):
+    """Send a position or velocity setpoint, streamed at a fixed rate when the setpoint streamer is enabled."""
+
+    if setpoint_streamer:
+        setpoint_streamer.update(msg)
+    else:
+        vehicle.send_mavlink(msg)
+
+def _stop_setpoint():
+    """Stop streaming the current setpoint when the vehicle is commanded otherwise."""
+
+    if setpoint_streamer:
+        setpoint_streamer.stop()
+
 def _goto_position_target_global_int(params):
     """Move the vehicle to the global position specified.
 
@@ -271,6 +664,9 @@ def _goto_position_target_global_int(params):
     lat = params['lat']
     lon = params['lon']
     alt = params['alt']
+    breach = _geofence_check(lat, lon, alt)
+    if breach:
+        return {"success": False, "geofence": breach}
     msg = vehicle.message_factory.set_position_target_global_int_encode(
         0,       # time_boot_ms (not used)
         0, 0,    # target system, target component
@@ -285,7 +681,7 @@ def _goto_position_target_global_int(params):
         0, 0, 0, # afx, afy, afz acceleration (not supported yet, ignored in GCS_Mavlink)
         0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink) 
     # send command to vehicle
-    vehicle.send_mavlink(msg)
+    _send_setpoint(msg)
     return {"success": True}
 
 def _goto_position_target_local_ned(params):
@@ -298,6 +694,9 @@ def _goto_position_target_local_ned(params):
         return {"success": False}
     if ('north' and 'east' and 'down') not in params.keys():
         return {"success": False}  
+    breach = _geofence_check_local(params['north'], params['east'], params['down'])
+    if breach:
+        return {"success": False, "geofence": breach}
     msg = vehicle.message_factory.set_position_target_local_ned_encode(
         0,       # time_boot_ms (not used)
         0, 0,    # target system, target component
@@ -308,7 +707,7 @@ def _goto_position_target_local_ned(params):
         0, 0, 0, # x, y, z acceleration (not supported yet, ignored in GCS_Mavlink)
         0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink) 
     # send command to vehicle
-    vehicle.send_mavlink(msg)
+    _send_setpoint(msg)
     return {"success": True}
 
 def _condition_yaw(params):
@@ -386,7 +785,7 @@ def _send_ned_velocity(params):
         0, 0, 0, # x, y, z acceleration (not supported yet, ignored in GCS_Mavlink)
         0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink) 
     # send command to vehicle
-    vehicle.send_mavlink(msg)
+    _send_setpoint(msg)
     return {"success": True}
 
 def _send_global_velocity(params):
@@ -414,9 +813,168 @@ def _send_global_velocity(params):
         0, 0, 0, # afx, afy, afz acceleration (not supported yet, ignored in GCS_Mavlink)
         0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink) 
     # send command to vehicle
-    vehicle.send_mavlink(msg)
+    _send_setpoint(msg)
+    return {"success": True}
+
+def _stop_setpoint_stream(params):
+    """Stop streaming the current setpoint and brake the vehicle with a zero velocity setpoint."""
+
+    if not setpoint_streamer:
+        return {"success": False}
+    setpoint_streamer.brake()
     return {"success": True}
 
+def _get_stream_rates(params):
+    """Get the MAVLink message rates negotiated with the vehicle."""
+
+    if not stream_rates:
+        return {"enabled": False}
+    return dict(stream_rates.status(), enabled=True)
+
+def update_stream_rates():
+    """Negotiate the MAVLink message rates required by the telemetry, the subscriptions and the geofence."""
+
+    if not stream_rates:
+        return
+    import streamrates
+    import missionprogress
+    agent = current_agent()
+    stream_rates.require('telemetry', streamrates.attribute_rates(agent.telemetry_attributes_names,
+        streamrates.OVERSAMPLING / agent.telemetry_period))
+    rates = {}
+    for sub in subscription_manager.subscriptions():
+        rates = streamrates.attribute_rates(sub['attributes'], sub['max_rate'] or streamrates.SUBSCRIPTION_RATE, rates)
+    stream_rates.require('subscriptions', rates)
+    stream_rates.require('geofence', streamrates.attribute_rates(['location'] if geofence.active() else [],
+        streamrates.GEOFENCE_RATE))
+    stream_rates.require('mission', {'MISSION_CURRENT': missionprogress.MISSION_RATE}
+        if mission_progress and mission_progress.running() else {})
+
+def _get_setpoint_stream(params):
+    """Get the setpoint streamer status."""
+
+    if not setpoint_streamer:
+        return {"streaming": False}
+    return setpoint_streamer.status()
+
+def _mavlink_tunnel(params):
+    """Open, change or close the MAVLink tunnel forwarding the frames of the vehicle upstream in batches.
+
+    params - JSON object {"enable": true, "types": ["HEARTBEAT", "ATTITUDE"], "rates": {"ATTITUDE": 5}, "flush_interval": 0.1, "max_batch": 4096}
+        types - message types forwarded, none if empty, all if null (optional, default all)
+        rates - maximum frames per second of message types (optional)
+        flush_interval - maximum seconds a frame waits in a batch (optional)
+        max_batch - bytes of a batch sent immediately (optional)
+    The options of an open tunnel not in the request are unchanged.
+    """
+    from mavtunnel import MavlinkTunnel
+
+    if type(params) is not dict or type(params.get('enable', True)) is not bool:
+        return {"success": False}
+    agent = current_agent()
+    if not params.get('enable', True):
+        if agent.mavlink_tunnel:
+            agent.mavlink_tunnel.close()
+            agent.mavlink_tunnel = None
+        return {"success": True}
+    types = params.get('types')
+    rates = params.get('rates', {})
+    if types is not None and (type(types) is not list or not all(isinstance(t, basestring) for t in types)):
+        return {"success": False}
+    if type(rates) is not dict:
+        return {"success": False}
+    for x in rates.values() + [params.get('flush_interval'), params.get('max_batch')]:
+        if x is not None and (not utils.isnumber(x) or x <= 0):
+            return {"success": False}
+    options = dict((k, params[k]) for k in ('flush_interval', 'max_batch') if k in params)
+    if 'types' in params:
+        options['types'] = [str(t) for t in types] if types is not None else None
+    if 'rates' in params:
+        options['rates'] = dict((str(t), r) for t, r in rates.items())
+    if agent.mavlink_tunnel:
+        agent.mavlink_tunnel.configure(**options)
+    else:
+        agent.mavlink_tunnel = MavlinkTunnel(agent.vehicle, agent.bind(send_mavlink_batch), **options)
+    return dict(mavlink_tunnel.status(), success=True)
+
+def _mavlink_send(params):
+    """Write raw MAVLink frames to the vehicle.
+
+    params - JSON object {"data": "/gkA/74AAAAAAAACAwBRBAM="} with one or more frames encoded in base64
+
+    While the geofence is active, position targets and mission items with a destination outside of it are refused.
+    """
+
+    if type(params) is not dict or not isinstance(params.get('data'), basestring):
+        return {"success": False}
+    try:
+        data = base64.b64decode(params['data'])
+    except (TypeError, ValueError):
+        return {"success": False}
+    breach = _geofence_check_frames(data)
+    if breach:
+        return {"success": False, "geofence": breach}
+    if mavlink_tunnel:
+        mavlink_tunnel.write(data)
+    else:
+        vehicle._master.mav.file.write(data)
+    return {"success": True, "bytes": len(data)}
+
+def _log_downloader():
+    """Return the log downloader of the current agent, created at the first use."""
+    from logdownload import LogDownloader
+
+    agent = current_agent()
+    if agent.log_downloader is None:
+        agent.log_downloader = LogDownloader(agent.vehicle, agent.bind(send_log_chunk))
+    return agent.log_downloader
+
+def _get_dataflash_logs(params):
+    """List the dataflash logs of the autopilot."""
+
+    downloader = _log_downloader()
+    if downloader.running():
+        return {"success": False, "downloading": True}
+    return {"success": True, "logs": downloader.list()}
+
+def _download_dataflash_log(params):
+    """Start streaming a dataflash log upstream in chunks, sent in log data events.
+
+    params - JSON object {"id": 2, "offset": 0, "chunk_size": 16384, "compress": true, "max_rate": 20000}
+        offset - offset in the log of the first chunk, to resume a download (optional, default 0)
+        chunk_size - bytes of log data in each event (optional)
+        compress - compress each chunk with zlib (optional, default false)
+        max_rate - maximum bytes per second sent upstream (optional, default unlimited)
+    """
+    from logdownload import DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+    if type(params) is not dict or not utils.isnumber(params.get('id')):
+        return {"success": False}
+    offset = params.get('offset', 0)
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    compress = params.get('compress', False)
+    max_rate = params.get('max_rate')
+    if not utils.isnumber(offset) or offset < 0 or type(compress) is not bool:
+        return {"success": False}
+    if not utils.isnumber(chunk_size) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        return {"success": False}
+    if max_rate is not None and (not utils.isnumber(max_rate) or max_rate <= 0):
+        return {"success": False}
+    downloader = _log_downloader()
+    if not downloader.start(int(params['id']), int(offset), int(chunk_size), compress, max_rate):
+        return {"success": False, "downloading": True}
+    return dict(downloader.status(), success=True)
+
+def _cancel_dataflash_log(params):
+    """Cancel the download of a dataflash log."""
+
+    return {"success": _log_downloader().cancel()}
+
+def _get_dataflash_download(params):
+    """Get the progress of the download of a dataflash log."""
+
+    return {"success": True, "download": _log_downloader().status()}
+
 def _new_mission(params):
     """Reset flight plan."""
 
@@ -439,9 +997,75 @@ def _add_mission_item(params):
     p = tuple(params)
 #    if len(p) != 14:        
 #        return {"success": False}
-    vehicle.commands.add(Command(*p))
+    cmd = Command(*p)
+    breach = _geofence_check_command(cmd)
+    if breach:
+        return {"success": False, "geofence": breach}
+    vehicle.commands.add(cmd)
     return {"success": True}
 
+def _generate_mission(params):
+    """Generate a survey or orbit flight plan on the vehicle.
+
+    params - JSON object {"pattern": "lawnmower", "polygon": [[37.42, -122.18], [37.43, -122.18], [37.43, -122.17]], "alt": 20, "spacing": 10, "angle": 0}
+        or {"pattern": "orbit", "center": [37.42, -122.18], "radius": 30, "alt": 20, "points": 16, "turns": 1}
+        pattern - 'lawnmower', 'grid' (two lawnmower sweeps at right angles) or 'orbit'
+        takeoff - add a takeoff to 'alt' before the first waypoint (optional, default true)
+        rtl - add a return to launch after the last waypoint (optional, default true)
+        upload - replace the flight plan and upload it to the vehicle (optional, default false),
+            otherwise the waypoints are added to the current flight plan as with add_mission_item
+    """
+    import patterns
+
+
+    if type(params) is not dict or 'pattern' not in params.keys() or 'alt' not in params.keys():
+        return {"success": False}
+    try:
+        if params['pattern'] in ('lawnmower', 'grid'):
+            fn = patterns.lawnmower if params['pattern'] == 'lawnmower' else patterns.grid
+            lat, lon = fn(params['polygon'], params['spacing'], params.get('angle', 0.), patterns.MAX_WAYPOINTS)
+        elif params['pattern'] == 'orbit':
+            lat, lon = patterns.orbit(params['center'], params['radius'], params.get('points', 16), params.get('turns', 1.),
+                patterns.MAX_WAYPOINTS)
+        else:
+            return {"success": False}
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        return {"success": False, "error": str(e)}
+    if len(lat) == 0:
+        return {"success": False, "error": "empty pattern"}
+
+    alt = params['alt']
+    for i in range(len(lat)):
+        breach = _geofence_check(lat[i], lon[i], alt)
+        if breach:
+            return {"success": False, "geofence": breach, "waypoint": i}
+    # legs between waypoints outside of an exclusion polygon crossing it
+    if geofence.active():
+        breach = geofence.check_path(lat, lon)
+        if breach:
+            return {"success": False, "geofence": breach[1], "leg": breach[0]}
+
+    frame = mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT
+    cmds = []
+    if params.get('takeoff', True):
+        cmds.append(Command(0, 0, 0, frame, mavutil.mavlink.MAV_CMD_NAV_TAKEOFF, 0, 0, 0, 0, 0, 0, 0, 0, alt))
+    for i in range(len(lat)):
+        cmds.append(Command(0, 0, 0, frame, mavutil.mavlink.MAV_CMD_NAV_WAYPOINT, 0, 0, 0, 0, 0, 0, float(lat[i]), float(lon[i]), alt))
+    if params.get('rtl', True):
+        cmds.append(Command(0, 0, 0, frame, mavutil.mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+    upload = params.get('upload', False)
+    if upload:
+        vehicle.commands.clear()
+    for cmd in cmds:
+        vehicle.commands.add(cmd)
+    if upload:
+        vehicle.commands.upload()
+
+    return {"success": True, "waypoints": len(lat), "commands": len(cmds), "uploaded": upload,
+        "length": patterns.path_length(lat, lon),
+        "bounds": {"south": float(lat.min()), "west": float(lon.min()), "north": float(lat.max()), "east": float(lon.max())}}
+
 def _start_mission(params):
     """Start current flight plan."""
 
@@ -449,34 +1073,72 @@ def _start_mission(params):
     vehicle.commands.upload()
     # mission set to first item in the flight plan
     vehicle.commands.next = 0
+    _stop_setpoint()
+    # progress events pushed while flying the mission
+    mission_progress.start(vehicle.commands)
+    update_stream_rates()
     # set mode to AUTO to start mission
     vehicle.mode = VehicleMode("AUTO")
     return {"success": True}
 
+def _get_mission_progress(params):
+    """Get the progress of the current or last mission."""
+
+    return dict(mission_progress.progress(), success=True)
+
+# timing of the requests by method and the current profiler
+global method_stats, sampler
+method_stats = MethodStats()
+sampler = None
+
 global rpc_methods
-rpc_methods = ({'name':'shell','function':_shell}, 
-               {'name':'video_devices','function':_video_devices}, 
+rpc_methods = ({'name':'shell','function':_shell,'vehicle':False,'cache':True}, 
+               {'name':'shell_stream','function':_shell_stream,'with_id':True,'vehicle':False,'cache':True},
+               {'name':'video_devices','function':_video_devices,'vehicle':False}, 
                {'name':'vehicle_attributes','function':_get_vehicle_attributes},
-               {'name':'set_attributes','function':_set_vehicle_attributes},
+               {'name':'set_attributes','function':_set_vehicle_attributes,'cache':True},
                {'name':'autopilot_attributes','function':_get_autopilot_attributes},
                {'name':'vehicle_parameters','function':_get_vehicle_parameters},
-               {'name':'set_parameters','function':_set_vehicle_parameters},
-               {'name':'set_telemetry_period','function':_set_telemetry_period},
-               {'name':'set_telemetry_attributes','function':_set_telemetry_attributes},
+               {'name':'set_parameters','function':_set_vehicle_parameters,'cache':True},
+               {'name':'set_telemetry_period','function':_set_telemetry_period,'cache':True},
+               {'name':'set_telemetry_attributes','function':_set_telemetry_attributes,'cache':True},
+               {'name':'subscribe','function':_subscribe,'cache':True},
+               {'name':'unsubscribe','function':_unsubscribe,'cache':True},
+               {'name':'subscriptions','function':_get_subscriptions},
+               {'name':'reply_cache_stats','function':_get_reply_cache_stats,'vehicle':False},
+               {'name':'log','function':_get_log,'vehicle':False},
+               {'name':'time_sync','function':_get_time_sync,'vehicle':False},
+               {'name':'profile','function':_profile,'with_id':True,'vehicle':False,'cache':True},
+               {'name':'rpc_stats','function':_get_rpc_stats,'vehicle':False},
+               {'name':'recording','function':_get_recording,'vehicle':False},
                {'name':'home_location','function':_get_home_location},
-               {'name':'set_home_location','function':_set_home_location},
-               {'name':'takeoff','function':_takeoff},
-               {'name':'goto','function':_goto},
-               {'name':'goto_destination','function':_goto_destination},
-               {'name':'goto_position_global_int','function':_goto_position_target_global_int},
-               {'name':'goto_position_local_ned','function':_goto_position_target_local_ned},
-               {'name':'condition_yaw','function':_condition_yaw},
-               {'name':'point_camera','function':_point_camera},
-               {'name':'send_ned_velocity','function':_send_ned_velocity},
-               {'name':'send_global_velocity','function':_send_global_velocity},
-               {'name':'new_mission','function':_new_mission},
-               {'name':'add_mission_item','function':_add_mission_item},
-               {'name':'start_mission','function':_start_mission},
+               {'name':'set_home_location','function':_set_home_location,'cache':True},
+               {'name':'set_geofence','function':_set_geofence,'cache':True},
+               {'name':'clear_geofence','function':_clear_geofence,'cache':True},
+               {'name':'geofence','function':_get_geofence},
+               {'name':'takeoff','function':_takeoff,'cache':True},
+               {'name':'goto','function':_goto,'cache':True},
+               {'name':'goto_destination','function':_goto_destination,'cache':True},
+               {'name':'goto_position_global_int','function':_goto_position_target_global_int,'cache':True},
+               {'name':'goto_position_local_ned','function':_goto_position_target_local_ned,'cache':True},
+               {'name':'condition_yaw','function':_condition_yaw,'cache':True},
+               {'name':'point_camera','function':_point_camera,'cache':True},
+               {'name':'send_ned_velocity','function':_send_ned_velocity,'cache':True},
+               {'name':'send_global_velocity','function':_send_global_velocity,'cache':True},
+               {'name':'stop_setpoint_stream','function':_stop_setpoint_stream,'cache':True},
+               {'name':'setpoint_stream','function':_get_setpoint_stream},
+               {'name':'stream_rates','function':_get_stream_rates},
+               {'name':'mavlink_tunnel','function':_mavlink_tunnel,'cache':True},
+               {'name':'mavlink_send','function':_mavlink_send,'cache':True},
+               {'name':'dataflash_logs','function':_get_dataflash_logs},
+               {'name':'download_dataflash_log','function':_download_dataflash_log,'cache':True},
+               {'name':'cancel_dataflash_log','function':_cancel_dataflash_log,'cache':True},
+               {'name':'dataflash_download','function':_get_dataflash_download},
+               {'name':'new_mission','function':_new_mission,'cache':True},
+               {'name':'add_mission_item','function':_add_mission_item,'cache':True},
+               {'name':'generate_mission','function':_generate_mission,'cache':True},
+               {'name':'start_mission','function':_start_mission,'cache':True},
+               {'name':'mission_progress','function':_get_mission_progress},
 )
 
 def message_handler(msg, msg_len):
@@ -491,7 +1153,7 @@ def message_handler(msg, msg_len):
         req = json.loads(msg)
     except:
         # the message is not a json object
-        syslog("Received JSON-RPC invalid message (parse error): %s" % msg, escape=True)
+        syslog("Received JSON-RPC invalid message (parse error): %s", msg, escape=True, level=logger.WARNING)
         return JSON_RPC_PARSE_ERROR
 
     # check the message is a proper JSON-RPC message
@@ -504,7 +1166,7 @@ def message_handler(msg, msg_len):
         else:
             return JSON_RPC_PARSE_ERROR
 
-    syslog("JSON-RPC: %s" % msg, escape=True)
+    syslog("JSON-RPC: %s", msg, escape=True)
 
     method = req['method']
     func = None
@@ -512,17 +1174,39 @@ def message_handler(msg, msg_len):
     for m in rpc_methods:
         if m['name'] == method:
             func = m['function']
+            with_id = m.get('with_id', False)
             break
 
     if func == None:
         return JSON_RPC_INVALID_REQUEST
 
+    # requests using the vehicle during startup or reconnection
+    status = current_agent().status
+    if m.get('vehicle', True) and status != STATUS_READY:
+        return json.dumps({"jsonrpc": "2.0", "result": {"success": False, "status": status}, "id": req['id']})
+
+    # a request with side effects retransmitted with the same id and params gets the cached reply without executing it again
+    key = reply_cache.key(method, req['id'], req['params']) if m.get('cache', False) else None
+    if key is not None:
+        cached = reply_cache.get(key)
+        if cached is not None:
+            syslog("JSON-RPC: duplicate request %s, reply from cache", id)
+            return cached
+
     # call the method
+    wall = Runtime.monotonic()
+    cpu = Runtime.thread_time()
     try:
-        result = func(req['params'])
+        if with_id:
+            # methods replying asynchronously tag their data events with the request id
+            result = func(req['params'], req['id'])
+        else:
+            result = func(req['params'])
     except Exception as e:
         print e
+        method_stats.record(method, Runtime.monotonic() - wall, Runtime.thread_time() - cpu, True)
         return JSON_RPC_INTERNAL_ERROR_FMT_STR % str(id)
+    method_stats.record(method, Runtime.monotonic() - wall, Runtime.thread_time() - cpu)
 
     # build the response object
     reply = {}
@@ -530,45 +1214,270 @@ def message_handler(msg, msg_len):
     reply['result'] = result
     reply['id'] = req['id']
 
-    return json.dumps(reply)
+    reply = json.dumps(reply)
+    if key is not None:
+        reply_cache.put(key, reply)
+    return reply
+
+def timestamp(msg):
+    """Stamp a message with the estimated server time in milliseconds and its error bound."""
+
+    server_time, error = time_sync.now()
+    msg['time'] = int(time.time())
+    msg['time_ms'] = int(server_time * 1000)
+    msg['time_err_ms'] = int(round(error * 1000)) if error is not None else None
+
+def send_event(msg_type, msg, priority=CometaClient.PRIORITY_TELEMETRY):
+    """Send a data event message of the specified type upstream. Return False if refused."""
+
+    msg['type'] = msg_type
+    agent = current_agent()
+    msg['id'] = agent.device_id
+    timestamp(msg)
+    if com.send_data(json.dumps(msg), priority) < 0:
+        agent.send_errors += 1
+        print "Error in sending data."
+        return False
+    agent.sent += 1
+    return True
+
+def send_profile(rpc_id, sampler):
+    """Send the collapsed stacks sampled by a profile request upstream."""
+
+    send_event(MSG_PROFILE, {'rpc_id': rpc_id, 'samples': sampler.samples, 'interval': sampler.interval,
+        'stacks': sampler.collapsed()}, CometaClient.PRIORITY_BULK)
+
+def send_mavlink_batch(data, frames):
+    """Send a batch of MAVLink frames of the tunnel upstream."""
+
+    send_event(MSG_MAVLINK, {'frames': frames, 'data': base64.b64encode(data)})
+
+def send_log_chunk(msg):
+    """Send a chunk of a dataflash log upstream in the bulk lane. Return False if refused."""
+
+    return send_event(MSG_LOG_DATA, dict(msg, data=base64.b64encode(msg['data'])), CometaClient.PRIORITY_BULK)
+
+def send_mission_progress(progress):
+    """Send an update of the progress of the mission upstream."""
+
+    send_event(MSG_MISSION, progress)
+    if progress['event'] in ('completed', 'interrupted'):
+        update_stream_rates()
+
+def send_subscription_update(sid, attributes):
+    """Send an update of a subscription upstream."""
+
+    send_event(MSG_SUBSCRIPTION, {'subscription': sid, 'attributes': attributes})
+
+def send_setpoint_brake():
+    """Send an event when the setpoint streamer watchdog brakes the vehicle."""
+
+    send_event(MSG_SETPOINT_BRAKE, {'watchdog': True}, CometaClient.PRIORITY_CONTROL)
+
+def send_geofence_breach(reason, location):
+    """Send an event when the vehicle breaches the geofence or is back inside."""
+
+    msg = {'breach': reason is not None, 'reason': reason, 'lat': location.lat, 'lon': location.lon, 'alt': location.alt}
+    send_event(MSG_GEOFENCE, msg, CometaClient.PRIORITY_CONTROL)
 
 def get_telemetry():
-    attr = _get_vehicle_attributes(None)
     ret = {}
-    for k in telemetry_attributes_names:
-        ret[str(k)] = attr[k]
+    agent = current_agent()
+    v = agent.vehicle
+    for k in agent.telemetry_attributes_names:
+        ret[str(k)] = attribute_getters[k](v)
     return ret
 
+def start_sitl():
+    """Start the SITL simulator specified in the configuration of the current vehicle."""
+
+    agent = current_agent()
+    config = agent.config
+    if 'sitl' in config:
+        # https://github.com/dronekit/dronekit-sitl
+        from dronekit_sitl import SITL
+        agent.vsitl = SITL()
+        # values for 'system':
+        #   >>> print dronekit_sitl.version_list().keys()
+        #   >>> [u'solo', u'plane', u'copter', u'rover']
+        agent.vsitl.download(config['sitl']['system'],config['sitl']['version'],verbose=True)
+        agent.vsitl.launch(list(config['sitl']['args']),verbose=True)
+        agent.vsitl.block_until_ready()
+    else:
+        import dronekit_sitl
+        agent.vsitl = dronekit_sitl.start_default()
+
+def import_vehicle_modules():
+    """Import DroneKit and pymavlink, which take a large part of the startup time."""
+
+    global connect, VehicleMode, LocationGlobal, LocationGlobalRelative, Command, mavutil
+    from dronekit import connect, VehicleMode, LocationGlobal, LocationGlobalRelative, Command
+    from pymavlink import mavutil
+
+def connect_vehicle():
+    """Connect to the vehicle specified in the configuration of the current vehicle."""
+
+    agent = current_agent()
+    config = agent.config
+    print "\nConnecting to vehicle at: %s" % (config['connection_string'])
+
+    if config.get('use_fake'):
+        # simulated vehicle without SITL {"home": [37.423455, -122.176394, 40], "rate": 10}
+        import fakevehicle
+        fake = config.get('fake', {})
+        agent.vehicle = fakevehicle.connect(config['connection_string'], wait_ready=True,
+            home=fake.get('home', fakevehicle.DEFAULT_HOME), rate=fake.get('rate', fakevehicle.DEFAULT_RATE))
+    else:
+        agent.vehicle = connect(config['connection_string'], wait_ready=True)
+    agent.vehicle.wait_ready('autopilot_version')
+
+def on_attach(t0, t1, reply):
+    """Add the server timestamp of an attach reply to the time estimate."""
+
+    # {"msg":"200 OK","heartbeat":60,"timestamp":1441405206}
+    try:
+        server_time = json.loads(reply)['timestamp']
+    except Exception, e:
+        return
+    time_sync.add_sample(t0, t1, server_time)
+
+def on_network_change(old, new):
+    """Reconnect to Cometa when the network interface or address changes."""
+
+    syslog("Network changed from %s to %s", old, new)
+    if (old['interface'], old['ip_address']) != (new['interface'], new['ip_address']):
+        for agent in agents:
+            agent.com.reconnect()
+
+def agent_configs(config, serial):
+    """Return the (device id, configuration) of each vehicle served by the process.
+
+    With a "vehicles" list the configuration of each vehicle is the top level one with the members
+    of its entry, and the device id is the serial with the index of the vehicle unless specified.
+    Otherwise there is a single vehicle with the serial as device id.
+    """
+
+    if not config.get('vehicles'):
+        return [(serial, config)]
+    ret = []
+    for i, entry in enumerate(config['vehicles']):
+        c = dict((k, v) for k, v in config.items() if k != 'vehicles')
+        c.update((k, v) for k, v in entry.items() if k not in ('device_id', 'telemetry_period'))
+        if 'telemetry_period' in entry:
+            c['app_params'] = dict(c['app_params'], telemetry_period=entry['telemetry_period'])
+        ret.append((entry.get('device_id', "%s-%d" % (serial, i)), freeze(c)))
+    return ret
+
+def apply_config(new):
+    """Apply a new configuration to the current vehicle."""
+
+    agent = current_agent()
+    old = agent.config
+    agent.config = new
+    old_params = old['app_params']
+    params = new['app_params']
+    if params['telemetry_period'] != old_params['telemetry_period']:
+        agent.telemetry_period = params['telemetry_period']
+        update_stream_rates()
+    com.debug = params['debug']
+    if 'reply_cache' in params:
+        reply_cache.size = params['reply_cache'].get('size', reply_cache.size)
+        reply_cache.window = params['reply_cache'].get('window', reply_cache.window)
+    if setpoint_streamer and 'setpoint_stream' in params:
+        setpoint_streamer.rate = params['setpoint_stream'].get('rate', setpoint_streamer.rate)
+        setpoint_streamer.watchdog = params['setpoint_stream'].get('watchdog', setpoint_streamer.watchdog)
+    if mission_progress and 'mission_progress' in params:
+        mission_progress.period = params['mission_progress'].get('period', mission_progress.period)
+    if stream_rates and 'stream_rates' in params:
+        stream_rates.min_rate = params['stream_rates'].get('min_rate', stream_rates.min_rate)
+        stream_rates.max_rate = params['stream_rates'].get('max_rate', stream_rates.max_rate)
+        stream_rates.renegotiate()
+    if new['use_sitl'] and not new.get('use_fake') and (new.get('sitl') != old.get('sitl') or not old['use_sitl']):
+        # restart the simulator with the new parameters and reconnect the vehicle
+        syslog("Restarting SITL of %s with the new configuration.", agent.device_id)
+        agent.status = STATUS_CONNECTING
+        vehicle.close()
+        if agent.vsitl:
+            agent.vsitl.stop()
+        start_sitl()
+        connect_vehicle()
+        subscription_manager.bind(agent.vehicle)
+        geofence.watch(agent.vehicle, agent.bind(send_geofence_breach))
+        if setpoint_streamer:
+            setpoint_streamer.bind(agent.vehicle)
+        if stream_rates:
+            stream_rates.bind(agent.vehicle)
+        if mavlink_tunnel:
+            mavlink_tunnel.bind(agent.vehicle)
+        if log_downloader:
+            log_downloader.bind(agent.vehicle)
+        mission_progress.bind(agent.vehicle)
+        home_location.bind(agent.vehicle)
+        com.set_platform("%s" % vehicle.version)
+        agent.status = STATUS_READY
+    if params.get('record') != old_params.get('record'):
+        record_traffic()
+    for k in ('connection_string', 'cometa'):
+        if new[k] != old[k]:
+            syslog("Configuration of %s changed, restart the agent to apply it.", k, level=logger.WARNING)
+
+def on_config_change(old, new):
+    """Apply a new configuration without restarting the agent or reconnecting to Cometa."""
+
+    global config
+    config = new['config']
+    configure_log(config['app_params'])
+    configs = agent_configs(config, Runtime.get_serial())
+    if [d for d, c in configs] != [agent.device_id for agent in agents]:
+        syslog("Configuration of vehicles changed, restart the agent to apply it.", level=logger.WARNING)
+    else:
+        for agent, (device_id, c) in zip(agents, configs):
+            agent.bind(apply_config)(c)
+    syslog("Configuration reloaded.")
+
 # --------------------
 # 
 # Entry point
 
-def main(argv):
-    global config
-    config = Runtime.read_config()
-    if config['use_sitl']:
-        if 'sitl' in config:
-            # https://github.com/dronekit/dronekit-sitl
-            from dronekit_sitl import SITL
-            vsitl = SITL()
-            # values for 'system':
-            #   >>> print dronekit_sitl.version_list().keys()
-            #   >>> [u'solo', u'plane', u'copter', u'rover']
-            vsitl.download(config['sitl']['system'],config['sitl']['version'],verbose=True)
-            vsitl.launch(config['sitl']['args'],verbose=True)
-            vsitl.block_until_ready()
-        else:
-            import dronekit_sitl
-            vsitl = dronekit_sitl.start_default()
+def start_vehicle(startup):
+    """Start SITL, connect to the current vehicle and start the services using it."""
 
-    print "\nConnecting to vehicle at: %s" % (config['connection_string'])
+    agent = current_agent()
+    startup.run('import', import_vehicle_modules)
+    if agent.config['use_sitl'] and not agent.config.get('use_fake'):
+        startup.run('sitl', start_sitl)
+    startup.run('vehicle', connect_vehicle)
 
-    global vehicle 
-    vehicle = connect(config['connection_string'], wait_ready=True)
-    vehicle.wait_ready('autopilot_version')
+    from setpoint import SetpointStreamer
+    from geofence import Geofence
 
-    global telemetry_attributes_names
-    telemetry_attributes_names = ['attitude','location','velocity','battery','state','groundspeed','airspeed','mode','armed']
+    # attribute updates pushed on change, the getters are invoked in the threads of the vehicle
+    getters = dict((k, lambda f=f: f(agent.vehicle)) for k, f in attribute_getters.items())
+    agent.subscription_manager = SubscriptionManager(agent.vehicle, getters, agent.bind(send_subscription_update))
+
+    # geofence checked on movement commands and location updates
+    agent.geofence = Geofence()
+    agent.geofence.watch(agent.vehicle, agent.bind(send_geofence_breach))
+
+    # setpoints re-sent at a fixed rate {"rate":10, "watchdog":3}
+    if 'setpoint_stream' in agent.config['app_params']:
+        agent.setpoint_streamer = SetpointStreamer(agent.vehicle, brake_cb=agent.bind(send_setpoint_brake),
+            **agent.config['app_params']['setpoint_stream'])
+
+    # home location cached from the autopilot notifications
+    from homelocation import HomeLocation
+    agent.home_location = HomeLocation(agent.vehicle)
+
+    # progress of the missions started pushed upstream {"period":2}
+    from missionprogress import MissionProgress
+    agent.mission_progress = MissionProgress(agent.vehicle, agent.bind(send_mission_progress),
+        **agent.config['app_params'].get('mission_progress', {}))
+
+    # MAVLink messages requested at the rates required by the agent {"method":"auto", "min_rate":0.5, "max_rate":10}
+    if 'stream_rates' in agent.config['app_params']:
+        from streamrates import StreamRates
+        agent.stream_rates = StreamRates(agent.vehicle, **agent.config['app_params']['stream_rates'])
+        update_stream_rates()
 
     # Get some vehicle attributes (state)
     print " GPS: %s" % vehicle.gps_0
@@ -577,26 +1486,37 @@ def main(argv):
     print " System status: %s" % vehicle.system_status.state
     print " Mode: %s" % vehicle.mode.name
 
+def attach(startup):
+    """Attach the current vehicle to Cometa."""
+
+    agent = current_agent()
+    config = agent.config
+    device_id = agent.device_id
     cometa_server = config['cometa']['server']
     cometa_port = config['cometa']['port']
     application_id = config['cometa']['app_key']
-    # use the machine's MAC address as Cometa device ID
-    device_id = Runtime.get_serial()
 
     # ------------------------------------------------ #
     print "Cometa client started.\r\ncometa_server:", cometa_server, "\r\ncometa_port:", cometa_port, "\r\napplication_id:", application_id, "\r\ndevice_id:", device_id
 
     # Instantiate a Cometa object
-    com = CometaClient(cometa_server, cometa_port, application_id, config['cometa']['ssl'])
+    agent.com = CometaClient(cometa_server, cometa_port, application_id, config['cometa']['ssl'])
     # Set debug flag
     com.debug = config['app_params']['debug']
 
     # Bind the message_handler() callback. The callback is doing the function of respoding
     # to remote requests and handling the core part of the work of the application.
-    com.bind_cb(message_handler)
+    com.bind_cb(agent.bind(message_handler))
+
+    # estimate the server time from the timestamps of attach replies
+    com.clock = Runtime.monotonic
+    com.bind_attach_cb(agent.bind(on_attach))
+
+    # requests and frames recorded for replay {"dir":"/var/log/cometa", "max_size":104857600}
+    record_traffic()
 
     # Attach the device to Cometa.
-    ret = com.attach(device_id, "%s" % vehicle.version)
+    ret = startup.run('attach', com.attach, device_id, STATUS_CONNECTING)
     if com.error != 0:
         print "(FATAL) Error in attaching to Cometa.", com.perror()
         sys.exit(2)
@@ -613,26 +1533,130 @@ def main(argv):
     if com.debug:
         print "Server returned:", ret
 
-    # Application main loop.
+def record_traffic():
+    """Record the traffic of the current agent in a new file, or stop recording, as in the configuration."""
+
+    from recorder import TrafficRecorder, recording_path
+
+    agent = current_agent()
+    params = agent.config['app_params'].get('record')
+    if com.recorder:
+        com.recorder.close()
+        syslog("Recording of %s saved in %s.", agent.device_id, com.recorder.path)
+        com.recorder = None
+    if not params:
+        return
+    path = recording_path(params['dir'], agent.device_id)
+    try:
+        com.recorder = TrafficRecorder(path, agent.device_id, **dict((k, v) for k, v in params.items() if k == 'max_size'))
+    except IOError, e:
+        syslog("Cannot record the traffic in %s: %s", path, e, level=logger.WARNING)
+        return
+    syslog("Recording the traffic of %s in %s.", agent.device_id, path)
+
+def add_agent(device_id, config):
+    """Create the agent of a vehicle with its reply cache, time estimate and telemetry."""
+
+    agent = Agent(len(agents), device_id, config)
+    # requests using the vehicle are refused until it is connected
+    agent.status = STATUS_CONNECTING
+    # cache of replies to retransmitted requests {"size":256, "window":30}
+    agent.reply_cache = ReplyCache(**config['app_params'].get('reply_cache', {}))
+    agent.time_sync = TimeSync(Runtime.monotonic)
+    agent.telemetry_attributes_names = list(TELEMETRY_ATTRIBUTES)
+    agents.append(agent)
+    # threads not bound to an agent use the only one
+    set_default_agent(agents[0] if len(agents) == 1 else None)
+    return agent
+
+def send_telemetry():
+    """
+    Send a telemetry data event of the current vehicle upstream.
+    """
+    agent = current_agent()
+    msg = get_telemetry()
+    msg['id'] = agent.device_id
+    timestamp(msg)
+    msg['type'] = MSG_TELEMETRY
+
+    #now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+    #msg = "{\"id\":\"%s\",\"time\":\"%s\"}" % (device_id, now)
+    if com.send_data(str(msg)) < 0:
+        agent.send_errors += 1
+        print "Error in sending data."
+    else:
+        agent.sent += 1
+        if com.debug:
+            print "sending data event.", msg
+
+def start(startup):
+    """Create the agents of the vehicles in the configuration, connect them and attach them to Cometa."""
+
+    Runtime.set_status(STATUS_CONNECTING)
+
+    # use the machine's MAC address as Cometa device ID, with the index of the vehicle when more than one
+    for device_id, c in agent_configs(config, Runtime.get_serial()):
+        add_agent(device_id, c)
+
+    # connect the vehicles while attaching to Cometa
+    vehicle_phases = [startup.start('vehicle startup', agent.bind(start_vehicle), startup) for agent in agents]
+    for agent in agents:
+        agent.bind(attach)(startup)
+
+    for agent, phase in zip(agents, vehicle_phases):
+        try:
+            phase.wait()
+        except Exception, e:
+            print "(FATAL) Error in connecting to the vehicle %s." % agent.device_id, e
+            sys.exit(2)
+        # attached as connecting, reconnections report the version of the vehicle
+        agent.com.set_platform("%s" % agent.vehicle.version)
+        agent.status = STATUS_READY
+    Runtime.set_status(STATUS_READY)
+
+def telemetry_loop():
+    """Send the telemetry of each vehicle at its own period."""
+
+    schedule = [(Runtime.monotonic() + agent.telemetry_period, agent.index) for agent in agents]
+    heapq.heapify(schedule)
     while True:
-        """
-        Send a telemetry data event upstream. 
-        """
-        time.sleep(config['app_params']['telemetry_period'])
-        msg = get_telemetry()
-        msg['id'] = device_id
-        msg['time'] = int(time.time())
-        msg['type'] = 1
-
-        #now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
-        #msg = "{\"id\":\"%s\",\"time\":\"%s\"}" % (device_id, now)
-        if com.send_data(str(msg)) < 0:
-            print "Error in sending data."
-        else:
-            if com.debug:
-                print "sending data event.", msg
+        due, index = heapq.heappop(schedule)
+        delay = due - Runtime.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        agent = agents[index]
+        agent.bind(send_telemetry)()
+        heapq.heappush(schedule, (Runtime.monotonic() + agent.telemetry_period, index))
+
+def main(argv):
+    startup = Startup()
+
+    global config
+    try:
+        config = startup.run('configuration', Runtime.read_config)
+    except ConfigError, e:
+        print "(FATAL) Error in the configuration.", e
+        sys.exit(2)
+    configure_log(config['app_params'])
+
+    start(startup)
+    print "Startup completed in %.3f s" % startup.report()['total']
+
+    # apply changes of the configuration file live
+    Runtime.configuration().add_listener(on_config_change)
+    Runtime.configuration().watch()
+
+    # reconnect immediately on a network switch, such as from Wi-Fi to LTE
+    Runtime.network().add_listener(on_network_change)
+    Runtime.network().watch()
+
+    # probe the video devices once and on hotplug
+    Runtime.video_inventory().watch()
+
+    # Application main loop.
+    telemetry_loop()
 
     print "***** should never get here"
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
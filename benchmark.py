@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+""" Microbenchmarks of the hot paths of the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The benchmarks run in-process against the fake vehicle, without a network connection.
+For each benchmark the report has the operations per second, the p50 and p99 latency in
+microseconds, and the objects retained per call: the net growth of the traced memory blocks
+where tracemalloc is available, otherwise of the objects tracked by the garbage collector. The
+objects allocated and freed within a call are not counted, and the retained objects are only
+reported, not compared with the baseline.
+
+A calibration loop of JSON encoding and decoding and plain Python operations is timed before
+and after the benchmarks, and the comparison with a baseline is on the operations per second
+relative to the calibration, so that a baseline saved on one machine is usable on another.
+A baseline without a calibration is compared only on the host where it was saved. Since the
+ops/s of short runs vary more than the tolerance, baselines are saved and compared with runs of
+at least MIN_COMPARE_DURATION seconds, repeated at least MIN_COMPARE_REPEATS times, and the
+fastest run of each benchmark and of the calibration is kept.
+
+Usage:
+    ./benchmark.py [-d seconds] [-r repeats] [-f filter] [-b baseline.json] [-s baseline.json] [-t tolerance]
+
+    -d  duration of each benchmark in seconds (default 1, at least 1 with -b or -s)
+    -r  runs of each benchmark, keeping the fastest (default 1, at least 3 with -b or -s)
+    -f  run only the benchmarks with names containing the filter
+    -b  compare with a baseline and exit with status 1 if a benchmark is slower than
+        the baseline ops/s, relative to the calibration, by more than the tolerance
+    -s  save the results as a baseline
+    -t  tolerance as a fraction of the baseline ops/s (default 0.25)
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import getopt
+import platform
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from runtime import Runtime
+from cometalib import CometaClient
+import application
+import logger
+import utils
+import fakevehicle
+
+BASELINE_FILENAME = 'benchmark_baseline.json'
+DEFAULT_DURATION = 1.
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_REPEATS = 1
+# Minimum duration and runs of each benchmark to save or compare with a baseline
+MIN_COMPARE_DURATION = 1.
+MIN_COMPARE_REPEATS = 3
+# Calls timed together for the latency percentiles
+BATCH = 20
+
+# message_handler requests: (method, params)
+RPC_REQUESTS = (
+    ('vehicle_attributes', {}),
+    ('autopilot_attributes', {}),
+    ('vehicle_parameters', {}),
+    ('set_attributes', {'groundspeed': 5}),
+    ('set_telemetry_period', {'period': 1}),
+    ('goto_position_local_ned', {'north': 10., 'east': 5., 'down': -10.}),
+    ('send_ned_velocity', {'velocity_x': 1., 'velocity_y': 0., 'velocity_z': 0.}),
+    ('geofence', {}),
+    ('time_sync', {}),
+)
+
+def setup():
+    """
+    Initialize the application globals with a fake vehicle stepped only by the benchmarks.
+    """
+    application.config = {'app_params': {'telemetry_period': 1}}
+    agent = application.add_agent('BENCH0', application.config)
+    agent.vehicle = fakevehicle.FakeVehicle(rate=0)
+    application.import_vehicle_modules()
+    from geofence import Geofence
+    agent.geofence = Geofence()
+    agent.vehicle.mode = application.VehicleMode('GUIDED')
+    agent.vehicle.armed = True
+    agent.status = application.STATUS_READY
+    # log records are formatted and written, but not to the console
+    Runtime.logger().stream = open(os.devnull, 'w')
+
+def benchmarks():
+    """
+    Return the list of (name, function) to benchmark.
+    """
+    ret = []
+    counter = [0]
+
+    def rpc(method, params):
+        def f():
+            # a new id every call, since retransmitted requests are replied from the cache
+            counter[0] += 1
+            return application.message_handler(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': counter[0]}), 0)
+        return f
+
+    for method, params in RPC_REQUESTS:
+        ret.append(('message_handler.' + method, rpc(method, params)))
+
+    req = {'jsonrpc': '2.0', 'method': 'vehicle_attributes', 'params': {}, 'id': 7}
+    ret.append(('utils.check_rpc_msg', lambda: utils.check_rpc_msg(req)))
+
+    ret.append(('get_telemetry', application.get_telemetry))
+
+    def telemetry_event():
+        msg = application.get_telemetry()
+        msg['id'] = application.current_agent().device_id
+        application.timestamp(msg)
+        msg['type'] = application.MSG_TELEMETRY
+        return str(msg)
+    ret.append(('telemetry_event', telemetry_event))
+
+    event = json.dumps({'type': application.MSG_SUBSCRIPTION, 'subscription': 1, 'attributes': application.get_telemetry()})
+    ret.append(('CometaClient._frame_data', lambda: CometaClient._frame_data(event)))
+
+    loc1 = application.LocationGlobalRelative(37.423455, -122.176394, 20)
+    loc2 = application.LocationGlobalRelative(37.424455, -122.175394, 20)
+    ret.append(('utils.get_location_meters', lambda: utils.get_location_meters(loc1, 100., 50.)))
+    ret.append(('utils.get_distance_meters', lambda: utils.get_distance_meters(loc1, loc2)))
+    ret.append(('utils.get_bearing', lambda: utils.get_bearing(loc1, loc2)))
+    return ret
+
+def calibration():
+    """
+    Return the function of the calibration loop, independent of the code of the agent.
+    """
+    msg = {'jsonrpc': '2.0', 'method': 'calibration', 'params': {'lat': 37.42, 'lon': -122.17, 'alt': 10.}, 'id': 7}
+
+    def f():
+        d = json.loads(json.dumps(msg))
+        n = 0
+        for k in sorted(d['params']):
+            n += len(k) * int(d['params'][k])
+        return n
+    return f
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def retained(func, calls):
+    """
+    Return the net growth of the objects per call, not the objects allocated.
+    """
+    if tracemalloc:
+        tracemalloc.start()
+        before = sum(s.count for s in tracemalloc.take_snapshot().statistics('filename'))
+        for i in range(calls):
+            func()
+        after = sum(s.count for s in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+    else:
+        gc.collect()
+        gc.disable()
+        before = len(gc.get_objects())
+        for i in range(calls):
+            func()
+        after = len(gc.get_objects())
+        gc.enable()
+    return float(after - before) / calls
+
+def run(name, func, duration):
+    """
+    Run a benchmark for the duration and return its results.
+    """
+    # warm up and calibrate
+    func()
+    latencies = []
+    calls = 0
+    start = Runtime.monotonic()
+    end = start + duration
+    now = start
+    while now < end:
+        t0 = Runtime.monotonic()
+        for i in range(BATCH):
+            func()
+        now = Runtime.monotonic()
+        latencies.append((now - t0) / BATCH)
+        calls += BATCH
+        # keep the fake vehicle moving as with the real time simulation
+        application.current_agent().vehicle.step()
+    elapsed = now - start
+    latencies.sort()
+    return {'name': name, 'ops': calls / elapsed, 'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6, 'retained': retained(func, 100), 'calls': calls}
+
+def best(name, func, duration, repeats):
+    """
+    Run a benchmark repeats times and return the results of the fastest run.
+    """
+    return max((run(name, func, duration) for i in range(repeats)), key=lambda r: r['ops'])
+
+def compare(results, calibration_ops, baseline, tolerance):
+    """
+    Print the comparison with the baseline and return the names of the benchmarks that regressed.
+    """
+    base = dict((r['name'], r) for r in baseline['results'])
+    # ops/s relative to the calibration, or absolute with a baseline of the same host
+    scale = baseline['calibration'] / calibration_ops if baseline.get('calibration') else 1.
+    regressions = []
+    for r in results:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        change = r['ops'] * scale / b['ops'] - 1
+        flag = ''
+        if change < -tolerance:
+            flag = ' REGRESSION'
+            regressions.append(r['name'])
+        print "%-40s %+7.1f%% ops/s%s" % (r['name'], change * 100, flag)
+    return regressions
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "d:r:f:b:s:t:h")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    duration = DEFAULT_DURATION
+    repeats = DEFAULT_REPEATS
+    tolerance = DEFAULT_TOLERANCE
+    name_filter = None
+    baseline_file = None
+    save_file = None
+    for opt, arg in opts:
+        if opt == '-d':
+            duration = float(arg)
+        elif opt == '-r':
+            repeats = int(arg)
+        elif opt == '-f':
+            name_filter = arg
+        elif opt == '-b':
+            baseline_file = arg
+        elif opt == '-s':
+            save_file = arg
+        elif opt == '-t':
+            tolerance = float(arg)
+        elif opt == '-h':
+            print __doc__
+            sys.exit(0)
+
+    if (baseline_file or save_file) and (duration < MIN_COMPARE_DURATION or repeats < MIN_COMPARE_REPEATS):
+        duration = max(duration, MIN_COMPARE_DURATION)
+        repeats = max(repeats, MIN_COMPARE_REPEATS)
+        print "(WARNING) Runs raised to %d of %.1f seconds to save or compare with a baseline." % (repeats, duration)
+
+    baseline = None
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if not baseline.get('calibration') and baseline.get('host') != platform.node():
+            print "(FATAL) The baseline %s has no calibration and was not saved on this host, save a new one with -s." % baseline_file
+            sys.exit(2)
+
+    setup()
+    results = []
+    print "%-40s %12s %10s %10s %8s" % ('benchmark', 'ops/s', 'p50 us', 'p99 us', 'retained')
+    # the calibration before and after the benchmarks, averaging the changes of speed of the machine
+    calibration_ops = best('calibration', calibration(), duration, repeats)['ops']
+    for name, func in benchmarks():
+        if name_filter and name_filter not in name:
+            continue
+        r = best(name, func, duration, repeats)
+        results.append(r)
+        print "%-40s %12.0f %10.2f %10.2f %8.1f" % (name, r['ops'], r['p50_us'], r['p99_us'], r['retained'])
+    calibration_ops = (calibration_ops + best('calibration', calibration(), duration, repeats)['ops']) / 2
+    print "%-40s %12.0f" % ('calibration', calibration_ops)
+
+    if save_file:
+        with open(save_file, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'host': platform.node(),
+                'calibration': calibration_ops, 'duration': duration, 'repeats': repeats, 'retained': 'tracemalloc' if tracemalloc else 'gc',
+                'results': results}, f, indent=2, sort_keys=True)
+        print "Baseline saved in", save_file
+
+    if baseline:
+        print "\nCompared with %s (Python %s %s, calibration %.0f ops/s)" % (baseline_file, baseline['python'],
+            baseline['machine'], baseline.get('calibration') or 0)
+        regressions = compare(results, calibration_ops, baseline, tolerance)
+        if regressions:
+            print "\n%d benchmarks regressed more than %d%%: %s" % (len(regressions), tolerance * 100, ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -20,6 +20,8 @@ import select
 import time
 import threading
 import ssl
+import errno
+from collections import deque
 # From http-parser (0.8.3)
 # pip install http-parser
 from http_parser.parser import HttpParser
@@ -29,6 +31,11 @@ class CometaClient(object):
 	"""Connect a device to the Cometa infrastructure"""
 	errors = {0:'ok', 1:'timeout', 2:'network error', 3:'protocol error', 4:'authorization error', 5:'wrong parameters', 9:'internal error'} 
 
+	# Upstream priority classes, frames in a higher class are always sent first
+	PRIORITY_CONTROL = 0	# RPC replies and heartbeats
+	PRIORITY_TELEMETRY = 1	# telemetry and event data
+	PRIORITY_BULK = 2		# bulk data
+
 	def __init__(self,server, port, application_id, use_ssl):
 		"""
 		The Cometa instance constructor.
@@ -45,6 +52,9 @@ class CometaClient(object):
 		self._app_id = application_id
 		self._use_ssl = use_ssl
 		self._message_cb = None
+		self._attach_cb = None
+		self.clock = time.time			# clock for the attach round trip times
+		self.recorder = None			# object with received(data) and sent(frame, priority) recording the traffic
 
 		self._device_id = ""
 		self._platform = ""
@@ -55,6 +65,13 @@ class CometaClient(object):
 		self._thbeat = None
 		self._hb_lock = threading.Lock()
 		self._reconnecting = False
+
+		# upstream priority lanes
+		self.chunk_size = 1024			# bytes written to the socket at a time
+		self.max_queued = 64			# frames queued in the telemetry and bulk lanes
+		self._lanes = (deque(), deque(), deque())
+		self._send_cond = threading.Condition()
+		self._tsend = None
 		return
 
 	def attach(self, device_id, device_info):
@@ -75,6 +92,7 @@ class CometaClient(object):
 			self._sock = tsock
 		try:
 			self._sock.connect((self._server, self._port))
+			t0 = self.clock()
 			sendBuf="POST /v1/applications/%s/devices/%s HTTP/1.1\r\nHost: api.cometa.io\r\nContent-Length:%d\r\n\r\n%s" % (self._app_id,device_id,len(device_info),device_info)
 			self._sock.send(sendBuf)
 			recvBuf = ""
@@ -108,6 +126,11 @@ class CometaClient(object):
 
 					# reset error
 					self.error = 0
+					if self._attach_cb:
+						try:
+							self._attach_cb(t0, self.clock(), recvBuf)
+						except Exception, e:
+							print e
 
 					# set the socket non blocking
 					self._sock.setblocking(0) 
@@ -119,14 +142,19 @@ class CometaClient(object):
 
 					if self.debug:
 						print "connection for device %s completed" % (device_id)
+					# start the upstream sender thread
+					self._tsend = threading.Thread(target=self._sender, name='cometa-sender')
+					self._tsend.daemon = True
+					self._tsend.start()
+
 											# start the hearbeat thread
-					self._thbeat = threading.Thread(target=self._heartbeat)
+					self._thbeat = threading.Thread(target=self._heartbeat, name='cometa-heartbeat')
 					self._thbeat.daemon = True
 					self._thbeat.start()
 						
 					# start the receive thread
 					#time.sleep(2)
-					self._trecv = threading.Thread(target=self._receive)
+					self._trecv = threading.Thread(target=self._receive, name='cometa-receive')
 					self._trecv.daemon = True	# force to exit on SIGINT
 					self._trecv.start()
 
@@ -137,27 +165,79 @@ class CometaClient(object):
 			self.error = 2
 			return
 
-	def send_data(self, msg):
+	def send_data(self, msg, priority=PRIORITY_TELEMETRY):
 		"""
 		Send a data event message upstream to the Cometa server.
  		If a Webhook is specified for the Application in the Cometa configuration file /etc/cometa.conf on the server, 
  		the message is relayed to the Webhook. Also, the Cometa server propagates the message to all open devices Websockets. 
+
+		The message is queued in the lane of the specified priority and sent by the sender thread.
+		When the lane is full, the oldest telemetry message is dropped, while bulk messages are refused.
 		"""
-		sendBuf = "%x\r\n%c%s\r\n" % (len(msg) + 1,'\07',msg)
 		if self._reconnecting:
 			if self.debug:
 				print "Error in Cometa.send_data(): device is reconnecting."
 			return -1
-		try:
-			self._hb_lock.acquire()
-			self._sock.send(sendBuf)
-			self._hb_lock.release()			
-		except Exception, e:
+		if not self._enqueue(self._frame_data(msg), priority, bounded=True):
 			if self.debug:
-				print "Error in Cometa.send_data(): socket write failed."
+				print "Error in Cometa.send_data(): upstream queue full."
 			return -1
 		return 0
 
+	@staticmethod
+	def _frame_data(msg):
+		"""
+		Return the chunk for a data event message.
+		"""
+		return "%x\r\n%c%s\r\n" % (len(msg) + 1,'\07',msg)
+
+	@staticmethod
+	def _frame_reply(reply):
+		"""
+		Return the chunk for a RPC reply message.
+		"""
+		return "%x\r\n%s\r\n" % (len(reply),reply)
+
+	def _enqueue(self, frame, priority, bounded=False):
+		"""
+		Queue a frame in the lane of the specified priority. Return False if the frame is refused.
+		Only data events are bounded, replies and heartbeats are always queued.
+		"""
+		with self._send_cond:
+			lane = self._lanes[priority]
+			if bounded and priority != CometaClient.PRIORITY_CONTROL and len(lane) >= self.max_queued:
+				if priority == CometaClient.PRIORITY_BULK:
+					return False
+				lane.popleft()
+			lane.append(frame)
+			self._send_cond.notify()
+		return True
+
+	def queued(self):
+		"""
+		Return the number of frames queued in each upstream lane.
+		"""
+		with self._send_cond:
+			return [len(lane) for lane in self._lanes]
+
+	def _write(self, buf):
+		"""
+		Write a frame to the non-blocking socket in slices of chunk_size bytes.
+		"""
+		sent = 0
+		while sent < len(buf):
+			ready_to_read, ready_to_write, in_error = select.select([], [self._sock], [], 15)
+			if not ready_to_write:
+				raise socket.timeout("socket write timeout")
+			try:
+				sent += self._sock.send(buf[sent:sent + self.chunk_size])
+			except ssl.SSLError, e:
+				if e.errno not in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+					raise
+			except socket.error, e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+
 	def bind_cb(self, message_cb):
 		"""
 		Binds the specified user callback to the Cometa instance.
@@ -165,6 +245,32 @@ class CometaClient(object):
 		self._message_cb = message_cb
 		return
 
+	def reconnect(self):
+		"""
+		Force an immediate reconnection to the Cometa server, for instance after a network change.
+		The socket is shut down and the receive thread reconnects when it reads the end of the stream.
+		"""
+		if self._reconnecting or self._sock is None:
+			return
+		print "Network changed. Reconnecting..."
+		try:
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except Exception, e:
+			print "--- exception in shutdown socket.", e
+
+	def bind_attach_cb(self, attach_cb):
+		"""
+		Binds the specified function invoked after every successful attach, including reconnections.
+		The function is called with the clock times of the request and the reply, and the server reply.
+		"""
+		self._attach_cb = attach_cb
+
+	def set_platform(self, device_info):
+		"""
+		Set the description of the platform sent when attaching again after a reconnection.
+		"""
+		self._platform = device_info
+
 	def perror(self):
 		"""
 		Return a string for the current error.
@@ -186,14 +292,40 @@ class CometaClient(object):
 				print "--- heartbeat while reconnecting"
 				continue	
 			sendBuf = "1\r\n%c\r\n" % '\06'
-			print "sending heartbeat"
+			if self.debug:
+				print "sending heartbeat"
+			self._enqueue(sendBuf, CometaClient.PRIORITY_CONTROL)
+
+	def _sender(self):
+		"""
+		The upstream sender thread.
+		Frames are sent one at a time from the highest priority lane that is not empty.
+		"""
+		if self.debug:
+			print "Sender thread started.\r"
+		while True:
+			with self._send_cond:
+				while self._reconnecting or not any(self._lanes):
+					self._send_cond.wait(1)
+				for priority, lane in enumerate(self._lanes):
+					if lane:
+						frame = lane.popleft()
+						break
+			self._hb_lock.acquire()
 			try:
-				self._hb_lock.acquire()
-				self._sock.send(sendBuf)
-				self._hb_lock.release()
+				self._write(frame)
+				sent = True
 			except Exception, e:
-				print "--- error sending heartbeat"
-				return
+				print "--- error sending upstream", e
+				sent = False
+			self._hb_lock.release()
+			if sent and self.recorder:
+				self.recorder.sent(frame, priority)
+			if not sent:
+				# put the frame back and retry after the receive thread reconnects
+				with self._send_cond:
+					lane.appendleft(frame)
+				time.sleep(1)
 
 	def _receive(self):
 		"""
@@ -255,6 +387,8 @@ class CometaClient(object):
 			self._hparser.execute(data, len(data))
 			if self._hparser.is_partial_body():
 				to_send = self._hparser.recv_body()
+				if self.recorder:
+					self.recorder.received(to_send)
 				# pdb.set_trace()
 				# the payload contains a HTTP chunk
 				if self._message_cb:
@@ -269,13 +403,8 @@ class CometaClient(object):
 
 			if self.debug:
 				print "Returning result."
-			sendBuf = "%x\r\n%s\r\n" % (len(reply),reply)
-			try:
-				self._hb_lock.acquire()
-				self._sock.send(sendBuf)
-				self._hb_lock.release()
-			except Exception, e:
-				print "--- error sending reply"
-				pass
+			# replies are not correlated with their requests by the server, so they are all
+			# sent in the control lane in the order of the requests
+			self._enqueue(self._frame_reply(reply), CometaClient.PRIORITY_CONTROL)
 
 			msg = ""		
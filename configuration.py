@@ -0,0 +1,288 @@
+""" Cached and validated configuration with hot reload for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["Configuration", "ConfigError", "FrozenDict"]
+
+import os
+import json
+import time
+import threading
+
+import inotify
+import logger
+
+# Seconds between checks of the file modification time when inotify is not available
+POLL_PERIOD = 2
+
+class ConfigError(Exception):
+    """
+    Invalid or unreadable configuration.
+    """
+    pass
+
+class FrozenDict(dict):
+    """
+    A read-only dictionary.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("configuration is read-only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+def freeze(value):
+    """
+    Return a read-only deep copy of a JSON value, with lists converted to tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class Field(object):
+    """
+    Schema of a configuration value.
+    """
+
+    def __init__(self, types, required=True, fields=None, check=None, items=None):
+        """
+        types: the allowed Python types
+        required: the value must be present
+        fields: dictionary with the schema of the members of an object
+        check: function(value) returning False if the value is invalid
+        items: the schema of the elements of a list
+        """
+        self.types = types
+        self.required = required
+        self.fields = fields
+        self.check = check
+        self.items = items
+
+NUMBER = (int, long, float)
+POSITIVE = lambda x: x > 0
+
+FAKE = Field(dict, required=False, fields={
+    'home': Field(list, required=False, check=lambda x: len(x) in (3, 4)),
+    'rate': Field(NUMBER, required=False, check=lambda x: x >= 0),
+})
+
+SITL = Field(dict, required=False, fields={
+    'system': Field(basestring),
+    'version': Field(basestring),
+    'args': Field(list),
+})
+
+# Schema of the DCT (Device Configuration Table), members not in the schema are allowed
+SCHEMA = {
+    'config': Field(dict, fields={
+        'connection_string': Field(basestring),
+        'use_sitl': Field(bool),
+        'use_fake': Field(bool, required=False),
+        'fake': FAKE,
+        'cometa': Field(dict, fields={
+            'ssl': Field(bool),
+            'server': Field(basestring),
+            'port': Field(int, check=POSITIVE),
+            'app_key': Field(basestring),
+        }),
+        'app_params': Field(dict, fields={
+            'debug': Field(bool),
+            'telemetry_period': Field(NUMBER, check=POSITIVE),
+            'reply_cache': Field(dict, required=False, fields={
+                'size': Field(int, required=False, check=POSITIVE),
+                'window': Field(NUMBER, required=False, check=POSITIVE),
+            }),
+            'log': Field(dict, required=False, fields={
+                'size': Field(int, required=False, check=POSITIVE),
+                'level': Field(basestring, required=False, check=lambda x: x in logger.LEVELS),
+            }),
+            'setpoint_stream': Field(dict, required=False, fields={
+                'rate': Field(NUMBER, required=False, check=POSITIVE),
+                'watchdog': Field(NUMBER, required=False, check=lambda x: x >= 0),
+            }),
+            'stream_rates': Field(dict, required=False, fields={
+                'method': Field(basestring, required=False, check=lambda x: x in ('auto', 'interval', 'data_stream')),
+                'min_rate': Field(NUMBER, required=False, check=lambda x: x >= 0),
+                'max_rate': Field(NUMBER, required=False, check=POSITIVE),
+            }),
+            'mission_progress': Field(dict, required=False, fields={
+                'period': Field(NUMBER, required=False, check=lambda x: x >= 0),
+            }),
+            'record': Field(dict, required=False, fields={
+                'dir': Field(basestring),
+                'max_size': Field(int, required=False, check=POSITIVE),
+            }),
+        }),
+        'sitl': SITL,
+        # vehicles served by the process, each with the top level members overridden by its own
+        'vehicles': Field(list, required=False, items=Field(dict, fields={
+            'connection_string': Field(basestring),
+            'device_id': Field(basestring, required=False),
+            'use_sitl': Field(bool, required=False),
+            'use_fake': Field(bool, required=False),
+            'fake': FAKE,
+            'sitl': SITL,
+            'telemetry_period': Field(NUMBER, required=False, check=POSITIVE),
+        })),
+    }),
+}
+
+def validate(value, fields, path=''):
+    """
+    Validate a configuration object against a schema. Raise ConfigError on the first invalid value.
+    """
+    for name, field in fields.items():
+        key = path + name
+        if name not in value:
+            if field.required:
+                raise ConfigError("missing %s" % key)
+            continue
+        v = value[name]
+        # bool is a subclass of int
+        if not isinstance(v, field.types) or (isinstance(v, bool) and field.types is not bool):
+            raise ConfigError("invalid type of %s" % key)
+        if field.check and not field.check(v):
+            raise ConfigError("invalid value of %s" % key)
+        if field.fields:
+            validate(v, field.fields, key + '.')
+        if field.items:
+            for i, item in enumerate(v):
+                validate({str(i): item}, {str(i): field.items}, key + '.')
+
+class Configuration(object):
+    """
+    The DCT (Device Configuration Table) read from a JSON file, parsed and validated once.
+    Readers get immutable snapshots. When watched, the file is reloaded on change and the
+    listeners are invoked with the old and the new snapshots.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._dct = None
+        self._mtime = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _read(self):
+        """
+        Read, complete from the environment and validate the file. Return the snapshot.
+        """
+        try:
+            with open(self.filename) as f:
+                content = json.loads(f.read())
+        except (IOError, ValueError) as e:
+            raise ConfigError("cannot read %s: %s" % (self.filename, e))
+        try:
+            # get Cometa API Key and Server name from the environment
+            cometa = content['config']['cometa']
+            if not 'app_key' in cometa:
+                cometa['app_key'] = os.environ['COMETA_APIKEY']
+            if not 'server' in cometa:
+                cometa['server'] = os.environ['COMETA_SERVER']
+            if not 'port' in cometa:
+                cometa['port'] = int(os.environ['COMETA_PORT'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ConfigError("missing Cometa parameter %s" % e)
+        validate(content, SCHEMA)
+        return freeze(content)
+
+    def load(self):
+        """
+        (Re)load the file. Return the new snapshot, or raise ConfigError keeping the current one.
+        """
+        mtime = os.path.getmtime(self.filename) if os.path.exists(self.filename) else None
+        dct = self._read()
+        with self._lock:
+            self._dct = dct
+            self._mtime = mtime
+        return dct
+
+    def dct(self):
+        """
+        Return the current snapshot of the whole DCT.
+        """
+        if self._dct is None:
+            self.load()
+        return self._dct
+
+    def config(self):
+        """
+        Return the current snapshot of the 'config' object.
+        """
+        return self.dct()['config']
+
+    def add_listener(self, listener):
+        """
+        Add a function(old, new) invoked with the old and new snapshots when the file changes.
+        """
+        self._listeners.append(listener)
+
+    def watch(self):
+        """
+        Start watching the file for changes, with inotify when available.
+        """
+        if self._thread:
+            return
+        self.dct()
+        self._thread = threading.Thread(target=self._watch_inotify if inotify.available() else self._watch_poll)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reload(self):
+        """
+        Reload the file and notify the listeners if the content changed.
+        """
+        old = self._dct
+        try:
+            new = self.load()
+        except ConfigError as e:
+            print "Configuration not reloaded:", e
+            return
+        if new == old:
+            return
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                print e
+
+    def _watch_inotify(self):
+        """
+        Watch the directory of the file, since editors often replace the file instead of writing it.
+        """
+        ino = inotify.Inotify()
+        ino.add_watch(os.path.dirname(self.filename), inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE)
+        name = os.path.basename(self.filename)
+        while True:
+            events = ino.read()
+            if any(e[2] == name for e in events):
+                self._reload()
+
+    def _watch_poll(self):
+        """
+        Check the file modification time periodically.
+        """
+        while True:
+            time.sleep(POLL_PERIOD)
+            try:
+                mtime = os.path.getmtime(self.filename)
+            except OSError:
+                continue
+            if mtime != self._mtime:
+                self._reload()
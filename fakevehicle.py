@@ -0,0 +1,597 @@
+""" Simulated vehicle for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+An in-process replacement of the DroneKit Vehicle with the attributes and methods used by the
+agent, for benchmarks and tests without an autopilot or SITL. The motion is a simple kinematic
+model advanced in fixed time steps, so that the same requests always produce the same
+trajectory. MAVLink messages sent to the vehicle are encoded and decoded with pymavlink and
+applied to the simulation: velocity and position setpoints, and the yaw command.
+
+Use it with "use_fake": true in the 'config' object of config.json, and optionally
+"fake": {"home": [37.423455, -122.176394, 40], "rate": 10}.
+"""
+
+__all__ = ["FakeVehicle", "connect"]
+
+import math
+import threading
+
+from dronekit import (HasObservers, VehicleMode, LocationGlobal, LocationGlobalRelative, LocationLocal,
+    Attitude, Battery, GPSInfo, Rangefinder, SystemStatus, Version, Capabilities)
+from pymavlink import mavutil
+
+mavlink = mavutil.mavlink
+
+EARTH_RADIUS = 6378137.0
+DEFAULT_HOME = (37.423455, -122.176394, 40.)
+# Simulation steps per second
+DEFAULT_RATE = 10
+
+# Vehicle model
+SPEED = 5.                  # default horizontal speed in m/s
+CLIMB_RATE = 2.5            # vertical speed in m/s
+LAND_RATE = 0.5             # landing speed in m/s
+ACCURACY = 1.               # distance in meters to consider a target reached
+SETPOINT_TIMEOUT = 3.       # seconds a velocity setpoint is followed, as in ArduPilot
+RTL_ALT = 15.
+BATTERY_CAPACITY = 5200.    # mAh
+HOVER_CURRENT = 15.         # A
+IDLE_CURRENT = 0.5          # A
+
+# ArduCopter 3.3.0 official release, quadrotor
+RAW_VERSION = (3 << 24) | (3 << 16) | (0 << 8) | 255
+CAPABILITIES = (mavlink.MAV_PROTOCOL_CAPABILITY_MISSION_FLOAT | mavlink.MAV_PROTOCOL_CAPABILITY_PARAM_FLOAT |
+    mavlink.MAV_PROTOCOL_CAPABILITY_MISSION_INT | mavlink.MAV_PROTOCOL_CAPABILITY_COMMAND_INT |
+    mavlink.MAV_PROTOCOL_CAPABILITY_SET_POSITION_TARGET_LOCAL_NED |
+    mavlink.MAV_PROTOCOL_CAPABILITY_SET_POSITION_TARGET_GLOBAL_INT)
+
+PARAMETERS = {'SYSID_THISMAV': 1., 'THR_MIN': 130., 'RTL_ALT': RTL_ALT * 100, 'WPNAV_SPEED': SPEED * 100,
+    'FENCE_ENABLE': 0., 'BATT_CAPACITY': BATTERY_CAPACITY}
+
+# Dataflash logs of the autopilot, id -> (time_utc, size in bytes)
+LOGS = {1: (1478383338, 150000), 2: (1478386938, 600000)}
+
+# type_mask bits of the SET_POSITION_TARGET messages ignoring the position
+POSITION_IGNORE = 0b0000000000000111
+
+class _Writer(object):
+    """
+    Connection of the message factory, decoding the messages written and applying them to the vehicle.
+    """
+
+    def __init__(self, vehicle):
+        self._vehicle = vehicle
+        self._parser = mavlink.MAVLink(None)
+        self.written = 0
+
+    def write(self, buf):
+        self.written += len(buf)
+        for msg in self._parser.parse_buffer(buf) or []:
+            self._vehicle._handle(msg)
+
+class _Master(object):
+    def __init__(self, mav):
+        self.mav = mav
+
+class _Sink(object):
+    """
+    Connection of the messages sent by the vehicle, which are only notified to the message listeners.
+    """
+
+    def write(self, buf):
+        pass
+
+class Locations(object):
+    """
+    The vehicle location in the global, global relative and local frames.
+    """
+
+    def __init__(self, vehicle):
+        self._vehicle = vehicle
+
+    @property
+    def global_frame(self):
+        v = self._vehicle
+        lat, lon = v._latlon(v._pos[0], v._pos[1])
+        return LocationGlobal(lat, lon, v.home_location.alt - v._pos[2])
+
+    @property
+    def global_relative_frame(self):
+        v = self._vehicle
+        lat, lon = v._latlon(v._pos[0], v._pos[1])
+        return LocationGlobalRelative(lat, lon, -v._pos[2])
+
+    @property
+    def local_frame(self):
+        return LocationLocal(*self._vehicle._pos)
+
+class Gimbal(object):
+    def __init__(self):
+        self._pitch = 0.
+        self._yaw = 0.
+        self._roll = 0.
+
+class Parameters(HasObservers):
+    """
+    Vehicle parameters, stored in the attribute cache as in DroneKit.
+    """
+
+    def __init__(self, parameters):
+        super(Parameters, self).__init__()
+        self._attribute_cache.update(parameters)
+
+    def __getitem__(self, name):
+        return self._attribute_cache[name.upper()]
+
+    def __setitem__(self, name, value):
+        self._attribute_cache[name.upper()] = float(value)
+        self.notify_attribute_listeners(name.upper(), float(value))
+
+    def get(self, name, default=None):
+        return self._attribute_cache.get(name.upper(), default)
+
+    def __len__(self):
+        return len(self._attribute_cache)
+
+class Commands(object):
+    """
+    Mission commands. Commands added are flown in AUTO mode after upload().
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._mission = []
+        self.next = 0
+
+    def add(self, cmd):
+        self._pending.append(cmd)
+
+    def clear(self):
+        self._pending = []
+
+    def upload(self, timeout=None):
+        self._mission = list(self._pending)
+
+    def download(self):
+        self._pending = list(self._mission)
+
+    def wait_ready(self, **kwargs):
+        return True
+
+    @property
+    def count(self):
+        return len(self._pending)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __iter__(self):
+        return iter(self._pending)
+
+    def __getitem__(self, index):
+        return self._pending[index]
+
+class FakeVehicle(HasObservers):
+    """
+    A simulated copter.
+    """
+
+    def __init__(self, home=DEFAULT_HOME, rate=DEFAULT_RATE):
+        """
+        home: [lat, lon, alt] of the home location, optionally followed by the initial heading
+        rate: simulation steps per second in real time, or 0 to advance the simulation only with step()
+        """
+        super(FakeVehicle, self).__init__()
+        self.home_location = LocationGlobal(*home[:3])
+        self.version = Version(RAW_VERSION, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, mavlink.MAV_TYPE_QUADROTOR)
+        self.capabilities = Capabilities(CAPABILITIES)
+        self.parameters = Parameters(PARAMETERS)
+        self.commands = Commands()
+        self.location = Locations(self)
+        self.gimbal = Gimbal()
+        self.gps_0 = GPSInfo(121, 65535, 3, 10)
+        self.rangefinder = Rangefinder(None, None)
+        self.ekf_ok = True
+        self.is_armable = True
+        self.last_heartbeat = 0.
+
+        self.message_factory = mavlink.MAVLink(_Writer(self), srcSystem=255, srcComponent=0)
+        self._master = _Master(self.message_factory)
+        self._link = mavlink.MAVLink(_Sink(), srcSystem=1, srcComponent=1)
+
+        self.time = 0.                      # simulated time in seconds
+        self._mode = VehicleMode('STABILIZE')
+        self._armed = False
+        self._pos = [0., 0., 0.]            # north, east, down in meters from home
+        self._vel = [0., 0., 0.]
+        self._yaw = math.radians(home[3]) if len(home) > 3 else 0.
+        self._target = None                 # [north, east, down] position target
+        self._speed = SPEED
+        self._setpoint = None               # [vn, ve, vd] velocity setpoint
+        self._setpoint_time = 0.
+        self._yaw_target = None
+        self._consumed = 0.                 # mAh
+        self._groundspeed = 0.
+        self._lock = threading.RLock()
+        self._message_listeners = {}
+        self.message_intervals = {}         # message id -> interval in microseconds set by SET_MESSAGE_INTERVAL
+        self.data_streams = {}              # stream id -> rate set by REQUEST_DATA_STREAM
+
+        self._stop = threading.Event()
+        self._rate = rate
+        self._thread = None
+        if rate:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    # Attributes
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, value):
+        with self._lock:
+            self._mode = VehicleMode(value.name if isinstance(value, VehicleMode) else value)
+            self._target = None
+            self._setpoint = None
+        self.notify_attribute_listeners('mode', self._mode, cache=True)
+
+    @property
+    def armed(self):
+        return self._armed
+
+    @armed.setter
+    def armed(self, value):
+        with self._lock:
+            if not value and self._pos[2] < -0.1:
+                # do not disarm in flight
+                return
+            self._armed = bool(value)
+        self.notify_attribute_listeners('armed', self._armed, cache=True)
+
+    @property
+    def system_status(self):
+        return SystemStatus('ACTIVE' if self._armed else 'STANDBY')
+
+    @property
+    def attitude(self):
+        # lean in the direction of motion
+        vn, ve = self._vel[0], self._vel[1]
+        c, s = math.cos(self._yaw), math.sin(self._yaw)
+        forward = vn * c + ve * s
+        right = -vn * s + ve * c
+        return Attitude(-math.radians(2.) * forward, self._yaw, math.radians(2.) * right)
+
+    @property
+    def velocity(self):
+        return list(self._vel)
+
+    @property
+    def heading(self):
+        return int(round(math.degrees(self._yaw))) % 360
+
+    @property
+    def groundspeed(self):
+        return self._groundspeed
+
+    @groundspeed.setter
+    def groundspeed(self, value):
+        self._speed = float(value)
+
+    @property
+    def airspeed(self):
+        return self._groundspeed
+
+    @airspeed.setter
+    def airspeed(self, value):
+        self._speed = float(value)
+
+    @property
+    def battery(self):
+        current = HOVER_CURRENT if self._pos[2] < -0.1 else IDLE_CURRENT if self._armed else 0.
+        level = max(0, int(100 * (1 - self._consumed / BATTERY_CAPACITY)))
+        return Battery(12600 - 20 * (100 - level), current * 100, level)
+
+    # Methods
+    def wait_ready(self, *types, **kwargs):
+        return True
+
+    def close(self):
+        self._stop.set()
+
+    def add_message_listener(self, name, fn):
+        self._message_listeners.setdefault(str(name), []).append(fn)
+
+    def remove_message_listener(self, name, fn):
+        listeners = self._message_listeners.get(str(name), [])
+        if fn in listeners:
+            listeners.remove(fn)
+
+    def notify_message_listeners(self, name, msg):
+        for fn in self._message_listeners.get(name, []) + self._message_listeners.get('*', []):
+            try:
+                fn(self, name, msg)
+            except Exception as e:
+                print e
+
+    def flush(self):
+        pass
+
+    def simple_takeoff(self, alt):
+        with self._lock:
+            if self._armed and self._mode.name == 'GUIDED':
+                self._target = [self._pos[0], self._pos[1], -float(alt)]
+                self._setpoint = None
+
+    def simple_goto(self, location, airspeed=None, groundspeed=None):
+        with self._lock:
+            self._target = self._local(location)
+            self._setpoint = None
+            if groundspeed or airspeed:
+                self._speed = float(groundspeed or airspeed)
+
+    def send_mavlink(self, message):
+        self.message_factory.send(message)
+
+    # Simulation
+    def _latlon(self, north, east):
+        lat = self.home_location.lat + math.degrees(north / EARTH_RADIUS)
+        lon = self.home_location.lon + math.degrees(east / (EARTH_RADIUS * math.cos(math.radians(self.home_location.lat))))
+        return lat, lon
+
+    def _local(self, location):
+        """
+        Return the [north, east, down] position of a global location.
+        """
+        north = math.radians(location.lat - self.home_location.lat) * EARTH_RADIUS
+        east = math.radians(location.lon - self.home_location.lon) * EARTH_RADIUS * math.cos(math.radians(self.home_location.lat))
+        if isinstance(location, LocationGlobalRelative):
+            down = -location.alt
+        else:
+            down = self.home_location.alt - location.alt
+        return [north, east, down]
+
+    def _handle(self, msg):
+        """
+        Apply a MAVLink message sent to the vehicle.
+        """
+        t = msg.get_type()
+        with self._lock:
+            if t == 'SET_POSITION_TARGET_LOCAL_NED':
+                if msg.type_mask & POSITION_IGNORE == POSITION_IGNORE:
+                    self._velocity_setpoint(msg.vx, msg.vy, msg.vz)
+                elif msg.coordinate_frame in (mavlink.MAV_FRAME_LOCAL_OFFSET_NED, mavlink.MAV_FRAME_BODY_OFFSET_NED):
+                    self._target = [self._pos[0] + msg.x, self._pos[1] + msg.y, self._pos[2] + msg.z]
+                    self._setpoint = None
+                else:
+                    self._target = [msg.x, msg.y, msg.z]
+                    self._setpoint = None
+            elif t == 'SET_POSITION_TARGET_GLOBAL_INT':
+                if msg.type_mask & POSITION_IGNORE == POSITION_IGNORE:
+                    self._velocity_setpoint(msg.vx, msg.vy, msg.vz)
+                else:
+                    self._target = self._local(LocationGlobalRelative(msg.lat_int / 1e7, msg.lon_int / 1e7, msg.alt))
+                    self._setpoint = None
+            elif t == 'COMMAND_LONG' and msg.command == mavlink.MAV_CMD_CONDITION_YAW:
+                if msg.param4:
+                    # relative yaw
+                    self._yaw_target = self._yaw + math.radians(msg.param1) * (msg.param3 or 1)
+                else:
+                    self._yaw_target = math.radians(msg.param1)
+            elif t == 'COMMAND_LONG' and msg.command == mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+                self.message_intervals[int(msg.param1)] = int(msg.param2)
+                self.notify_message_listeners('COMMAND_ACK',
+                    mavlink.MAVLink_command_ack_message(msg.command, mavlink.MAV_RESULT_ACCEPTED))
+            elif t == 'COMMAND_LONG' and msg.command == mavlink.MAV_CMD_GET_HOME_POSITION:
+                home = self.home_location
+                self.notify_message_listeners('HOME_POSITION', mavlink.MAVLink_home_position_message(
+                    int(home.lat * 1e7), int(home.lon * 1e7), int(home.alt * 1000), 0, 0, 0, [1, 0, 0, 0], 0, 0, 0))
+                # as DroneKit caches the home from HOME_POSITION
+                self.notify_attribute_listeners('home_location', home, cache=True)
+            elif t == 'REQUEST_DATA_STREAM':
+                self.data_streams[msg.req_stream_id] = msg.req_message_rate if msg.start_stop else 0
+            elif t == 'LOG_REQUEST_LIST':
+                for log_id in sorted(LOGS):
+                    self.notify_message_listeners('LOG_ENTRY', mavlink.MAVLink_log_entry_message(log_id, len(LOGS),
+                        max(LOGS), LOGS[log_id][0], LOGS[log_id][1]))
+            elif t == 'LOG_REQUEST_DATA':
+                self._send_log(msg.id, msg.ofs, msg.count)
+
+    def _send_log(self, log_id, ofs, count):
+        """
+        Notify the LOG_DATA messages of the requested data of a log, a sequence of 16 byte text records.
+        """
+        size = LOGS[log_id][1] if log_id in LOGS else 0
+        end = min(ofs + count, size)
+        while True:
+            n = max(min(90, end - ofs), 0)
+            first = ofs // 16
+            text = ''.join('%02d:%012d\n' % (log_id, r) for r in range(first, (ofs + n) // 16 + 1))
+            data = [ord(c) for c in text[ofs - first * 16:ofs - first * 16 + n]]
+            self.notify_message_listeners('LOG_DATA', mavlink.MAVLink_log_data_message(log_id, ofs, n, data + [0] * (90 - n)))
+            ofs += n
+            if n < 90 or ofs >= end:
+                # the end of the request, or a short message at the end of the log
+                break
+
+    def _velocity_setpoint(self, vn, ve, vd):
+        if self._mode.name != 'GUIDED' or not self._armed:
+            return
+        self._setpoint = [vn, ve, vd]
+        self._setpoint_time = self.time
+        self._target = None
+
+    def _command_target(self, cmd):
+        """
+        Return the position target of a mission command, or None for commands without one.
+        """
+        if cmd.command == mavlink.MAV_CMD_NAV_TAKEOFF:
+            return [self._pos[0], self._pos[1], -cmd.z]
+        if cmd.command in (mavlink.MAV_CMD_NAV_WAYPOINT, mavlink.MAV_CMD_NAV_LAND):
+            if cmd.frame == mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT:
+                target = self._local(LocationGlobalRelative(cmd.x, cmd.y, cmd.z))
+            else:
+                target = self._local(LocationGlobal(cmd.x, cmd.y, cmd.z))
+            if cmd.command == mavlink.MAV_CMD_NAV_LAND:
+                target[2] = 0.
+            return target
+        return None
+
+    def _auto(self):
+        """
+        Fly the mission commands in AUTO mode.
+        """
+        mission = self.commands._mission
+        while self.commands.next < len(mission):
+            cmd = mission[self.commands.next]
+            if cmd.command == mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH:
+                self._mode = VehicleMode('RTL')
+                return None
+            target = self._command_target(cmd)
+            if target is None or self._distance(target) < ACCURACY:
+                if target is not None and self._message_listeners:
+                    msg = self._link.mission_item_reached_encode(self.commands.next + 1)
+                    self._link.send(msg)
+                    self.notify_message_listeners(msg.get_type(), msg)
+                self.commands.next += 1
+                continue
+            return target
+        return None
+
+    def _rtl(self):
+        alt = max(-self._pos[2], RTL_ALT)
+        if math.hypot(self._pos[0], self._pos[1]) > ACCURACY:
+            if -self._pos[2] < alt - ACCURACY:
+                return [self._pos[0], self._pos[1], -alt]
+            return [0., 0., -alt]
+        return [0., 0., 0.]
+
+    def _distance(self, target):
+        return math.sqrt(sum((target[i] - self._pos[i]) ** 2 for i in range(3)))
+
+    def step(self, dt=None):
+        """
+        Advance the simulation by dt seconds, one step at the simulation rate by default.
+        """
+        dt = dt or 1. / (self._rate or DEFAULT_RATE)
+        with self._lock:
+            self.time += dt
+            self.last_heartbeat = 0.
+            mode = self._mode.name
+            vel = [0., 0., 0.]
+            if self._armed:
+                target = None
+                if mode == 'GUIDED':
+                    if self._setpoint and self.time - self._setpoint_time <= SETPOINT_TIMEOUT:
+                        vel = list(self._setpoint)
+                    else:
+                        self._setpoint = None
+                        target = self._target
+                elif mode == 'AUTO':
+                    target = self._auto()
+                if self._mode.name == 'RTL':
+                    target = self._rtl()
+                elif mode == 'LAND':
+                    target = [self._pos[0], self._pos[1], 0.]
+                if target is not None:
+                    vel = self._toward(target, dt, LAND_RATE if mode in ('LAND', 'RTL') and
+                        math.hypot(target[0] - self._pos[0], target[1] - self._pos[1]) < ACCURACY else CLIMB_RATE)
+            for i in range(3):
+                self._pos[i] += vel[i] * dt
+            if self._pos[2] >= 0.:
+                # on the ground
+                self._pos[2] = 0.
+                vel[2] = 0.
+                if self._mode.name in ('LAND', 'RTL') and self._armed:
+                    self._armed = False
+            self._vel = vel
+            self._groundspeed = math.hypot(vel[0], vel[1])
+            if self._yaw_target is not None:
+                self._yaw = self._yaw_target
+                self._yaw_target = None
+            elif self._groundspeed > 0.5:
+                self._yaw = math.atan2(vel[1], vel[0])
+            self._consumed += self.battery.current * dt / 3.6
+        # the frames are notified with their own value, as by DroneKit
+        location = self.location
+        for name in ('global_frame', 'global_relative_frame', 'local_frame'):
+            self.notify_attribute_listeners('location.' + name, getattr(location, name))
+        self.notify_attribute_listeners('location', location)
+        self.notify_attribute_listeners('attitude', self.attitude)
+        self.notify_attribute_listeners('velocity', self.velocity)
+        self.notify_attribute_listeners('heading', self.heading)
+        self.notify_attribute_listeners('groundspeed', self.groundspeed)
+        self.notify_attribute_listeners('airspeed', self.airspeed)
+        self.notify_attribute_listeners('battery', self.battery)
+        self.notify_attribute_listeners('armed', self._armed, cache=True)
+        self.notify_attribute_listeners('mode', self._mode, cache=True)
+        if self._message_listeners:
+            self._send_messages()
+
+    def _send_messages(self):
+        """
+        Notify the message listeners of the messages streamed by the autopilot at every step.
+        """
+        location = self.location.global_frame
+        relative = self.location.global_relative_frame
+        attitude = self.attitude
+        battery = self.battery
+        modes = dict((v, k) for k, v in mavutil.mode_mapping_acm.items())
+        base_mode = mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED | (mavlink.MAV_MODE_FLAG_SAFETY_ARMED if self._armed else 0)
+        for msg in (
+            self._link.heartbeat_encode(mavlink.MAV_TYPE_QUADROTOR, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, base_mode,
+                modes.get(self._mode.name, 0), mavlink.MAV_STATE_ACTIVE if self._armed else mavlink.MAV_STATE_STANDBY, 3),
+            self._link.global_position_int_encode(int(self.time * 1000), int(location.lat * 1e7), int(location.lon * 1e7),
+                int(location.alt * 1000), int(relative.alt * 1000), int(self._vel[0] * 100), int(self._vel[1] * 100),
+                int(self._vel[2] * 100), self.heading * 100),
+            self._link.attitude_encode(int(self.time * 1000), attitude.roll, attitude.pitch, attitude.yaw, 0, 0, 0),
+            self._link.vfr_hud_encode(self.airspeed, self.groundspeed, self.heading, 0, relative.alt, -self._vel[2]),
+            self._link.sys_status_encode(0, 0, 0, 0, battery.voltage * 1000, battery.current * 100, battery.level,
+                0, 0, 0, 0, 0, 0),
+            # mission items numbered from 1, after home
+            self._link.mission_current_encode(self.commands.next + 1)):
+            # pack the message as received
+            self._link.send(msg)
+            self.notify_message_listeners(msg.get_type(), msg)
+
+    def _toward(self, target, dt, climb_rate):
+        """
+        Return the velocity moving toward a target without overshooting it.
+        """
+        dn, de, dd = [target[i] - self._pos[i] for i in range(3)]
+        h = math.hypot(dn, de)
+        hspeed = min(self._speed, h / dt)
+        vspeed = min(climb_rate, abs(dd) / dt)
+        vn = dn / h * hspeed if h > 0 else 0.
+        ve = de / h * hspeed if h > 0 else 0.
+        return [vn, ve, math.copysign(vspeed, dd)]
+
+    def _run(self):
+        while not self._stop.wait(1. / self._rate):
+            try:
+                self.step()
+            except Exception as e:
+                print e
+
+def connect(ip=None, wait_ready=None, home=DEFAULT_HOME, rate=DEFAULT_RATE, **kwargs):
+    """
+    Return a FakeVehicle, with the same signature as dronekit.connect.
+    """
+    return FakeVehicle(home, rate)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+""" Simulated fleet launcher for load testing the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The vehicles are divided in shards, one process per shard, each process serving its vehicles
+as a multi-vehicle agent attached to the Cometa server of config.json. A process is not limited
+by the interpreter lock of the others, so the fleet scales with the available cores.
+
+The supervisor restarts a shard that exits, after a delay doubling at every restart until the
+shard stays up for STABLE_TIME, when the delay starts again from RESTART_DELAY. Every
+shard reports its metrics to the collector, which prints a summary periodically and writes
+the aggregated report of all the shards at the end of the run.
+
+Usage:
+    ./fleet.py [-n vehicles] [-p processes] [-d seconds] [-i prefix] [-s] [-l logdir] [-r report.json]
+
+    -n  number of vehicles (default 100)
+    -p  number of shard processes (default the number of cores)
+    -d  duration of the run in seconds, until interrupted if not specified
+    -i  prefix of the device ids, followed by the vehicle number (default "fleet")
+    -s  use a SITL instance for each vehicle instead of the fake vehicle
+    -l  directory of the output of each shard, discarded if not specified
+    -r  file of the JSON report
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import signal
+import resource
+import threading
+import multiprocessing
+from Queue import Empty
+
+from runtime import Runtime
+from configuration import ConfigError, freeze
+
+DEFAULT_VEHICLES = 100
+DEFAULT_PREFIX = 'fleet'
+# seconds between the metrics reported by each shard and between the summaries
+METRICS_INTERVAL = 5.
+# delay before the first restart of a shard, doubled at every restart up to the maximum
+RESTART_DELAY = 1.
+MAX_RESTART_DELAY = 60.
+# seconds up after which a restarted shard is restarted again after RESTART_DELAY
+STABLE_TIME = MAX_RESTART_DELAY
+# SITL instances listen on consecutive ports 10 apart
+SITL_PORT = 5760
+
+def vehicle_entries(config, count, prefix, sitl=False):
+    """
+    Return the entries of the "vehicles" configuration of the fleet.
+    """
+    entries = []
+    home = config.get('fake', {}).get('home', (37.423455, -122.176394, 40.))
+    for n in range(count):
+        entry = {'device_id': "%s-%04d" % (prefix, n)}
+        if sitl:
+            # each simulator instance with its own ports
+            entry['connection_string'] = "tcp:127.0.0.1:%d" % (SITL_PORT + 10 * n)
+            entry['use_fake'] = False
+            entry['use_sitl'] = True
+            entry['sitl'] = dict(config['sitl'], args=list(config['sitl']['args']) + ['-I%d' % n])
+        else:
+            # vehicles spread on a grid about 100 m apart
+            entry['connection_string'] = "fake:%d" % n
+            entry['use_fake'] = True
+            entry['fake'] = dict(config.get('fake', {}), home=[home[0] + (n // 32) * 0.001, home[1] + (n % 32) * 0.001] + list(home[2:]))
+        entries.append(entry)
+    return entries
+
+def rss_kb():
+    """
+    Return the current resident memory of the process in KB, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return None
+
+def shard_metrics(index, started, startup):
+    """
+    Return the metrics of the shard process, started at the specified time and with the
+    duration of its startup, None until completed.
+    """
+    import application
+    agents = list(application.agents)
+    t = os.times()
+    return {'shard': index, 'pid': os.getpid(), 'uptime': time.time() - started,
+        'startup': startup,
+        'vehicles': len(agents),
+        'ready': sum(1 for a in agents if a.status == application.STATUS_READY),
+        'attached': sum(1 for a in agents if a.com is not None and a.com.error == 0),
+        'sent': sum(a.sent for a in agents),
+        'send_errors': sum(a.send_errors for a in agents),
+        'queued': sum(sum(a.com.queued()) for a in agents if a.com is not None),
+        'cpu': t[0] + t[1],
+        'rss_kb': rss_kb(),
+        'rss_peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'threads': threading.active_count(),
+        'rpc': application.method_stats.stats()}
+
+def run_shard(index, config, queue, logdir):
+    """
+    Serve the vehicles of a shard and report its metrics until terminated.
+    """
+    # the output of the agents and the system log go to the log of the shard
+    out = open(os.path.join(logdir, 'shard-%d.log' % index), 'a', 0) if logdir else open(os.devnull, 'w')
+    sys.stdout = sys.stderr = out
+    import application
+    from startup import Startup
+
+    started = time.time()
+    startup = Startup()
+    startup_time = [None]
+
+    def reporter():
+        while True:
+            try:
+                queue.put(shard_metrics(index, started, startup_time[0]))
+            except Exception, e:
+                print "--- error reporting metrics", e
+            time.sleep(METRICS_INTERVAL)
+
+    application.config = config
+    application.configure_log(config['app_params'])
+    t = threading.Thread(target=reporter, name='fleet-reporter')
+    t.daemon = True
+    t.start()
+    application.start(startup)
+    startup_time[0] = startup.report()['total']
+    application.telemetry_loop()
+
+class Shard(object):
+    """
+    A shard process and its restarts.
+    """
+
+    def __init__(self, index, config):
+        self.index = index
+        self.config = config
+        self.vehicles = len(config['vehicles'])
+        self.process = None
+        self.restarts = 0
+        self.failures = 0           # restarts since the shard was last up for STABLE_TIME
+        self.started = None
+        self.restart_at = None      # time of the pending restart
+        self.metrics = None         # last metrics reported
+
+    def start(self, queue, logdir):
+        self.process = multiprocessing.Process(target=run_shard, args=(self.index, self.config, queue, logdir),
+            name='shard-%d' % self.index)
+        self.process.daemon = True
+        self.process.start()
+        self.started = time.time()
+        self.restart_at = None
+
+class Fleet(object):
+    """
+    Supervisor of the shard processes and collector of their metrics.
+    """
+
+    def __init__(self, config, entries, processes, logdir=None):
+        """
+        config: the configuration of the agents
+        entries: the "vehicles" configuration of the fleet, divided in shards
+        processes: number of shards
+        """
+        self.logdir = logdir
+        self.queue = multiprocessing.Queue()
+        self.shards = []
+        processes = max(1, min(processes, len(entries)))
+        for i in range(processes):
+            c = dict(config)
+            c['vehicles'] = entries[i * len(entries) // processes:(i + 1) * len(entries) // processes]
+            self.shards.append(Shard(i, freeze(c)))
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        for shard in self.shards:
+            shard.start(self.queue, self.logdir)
+
+    def supervise(self):
+        """
+        Restart the shards that exited.
+        """
+        now = time.time()
+        for shard in self.shards:
+            if shard.process.is_alive():
+                if shard.failures and now - shard.started >= STABLE_TIME:
+                    shard.failures = 0
+                continue
+            if shard.restart_at is None:
+                delay = min(RESTART_DELAY * 2 ** shard.failures, MAX_RESTART_DELAY)
+                print "Shard %d exited with code %s, restarting in %.0f s" % (shard.index, shard.process.exitcode, delay)
+                shard.restart_at = now + delay
+            elif now >= shard.restart_at:
+                shard.restarts += 1
+                shard.failures += 1
+                shard.metrics = None
+                shard.start(self.queue, self.logdir)
+
+    def collect(self, timeout):
+        """
+        Receive the metrics reported by the shards for up to timeout seconds.
+        """
+        end = time.time() + timeout
+        while True:
+            try:
+                metrics = self.queue.get(timeout=max(0, end - time.time()))
+            except Empty:
+                return
+            self.shards[metrics['shard']].metrics = metrics
+
+    def stop(self):
+        for shard in self.shards:
+            if shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shards:
+            shard.process.join(5)
+
+    def report(self):
+        """
+        Return the metrics of all the shards and their totals.
+        """
+        shards = []
+        totals = {'vehicles': 0, 'ready': 0, 'attached': 0, 'sent': 0, 'send_errors': 0, 'queued': 0,
+            'cpu': 0., 'rss_kb': 0, 'rss_peak_kb': 0, 'threads': 0, 'restarts': 0, 'sent_per_s': 0.}
+        rpc = {}
+        startup = []
+        for shard in self.shards:
+            m = dict(shard.metrics or {'shard': shard.index, 'vehicles': 0})
+            m['restarts'] = shard.restarts
+            m['configured'] = shard.vehicles
+            m['alive'] = shard.process.is_alive()
+            # the last metrics of a shard that exited are reported, but not counted in the totals
+            if shard.metrics and m['alive']:
+                m['sent_per_s'] = m['sent'] / m['uptime'] if m['uptime'] > 0 else 0.
+                for k in totals:
+                    totals[k] += m[k] or 0
+                if m['startup'] is not None:
+                    startup.append(m['startup'])
+                for method, s in m['rpc'].items():
+                    r = rpc.setdefault(method, {'calls': 0, 'errors': 0, 'wall_ms': 0., 'wall_max_ms': 0., 'cpu_ms': 0.})
+                    for k in ('calls', 'errors', 'wall_ms', 'cpu_ms'):
+                        r[k] += s[k]
+                    r['wall_max_ms'] = max(r['wall_max_ms'], s['wall_max_ms'])
+            else:
+                totals['restarts'] += shard.restarts
+            shards.append(m)
+        for r in rpc.values():
+            r['wall_mean_ms'] = r['wall_ms'] / r['calls']
+        totals['configured'] = sum(s.vehicles for s in self.shards)
+        totals['shards'] = len(self.shards)
+        totals['alive'] = sum(1 for s in self.shards if s.process.is_alive())
+        totals['startup_max'] = max(startup) if startup else None
+        return {'elapsed': time.time() - self.started, 'cores': multiprocessing.cpu_count(),
+            'totals': totals, 'rpc': rpc, 'shards': shards}
+
+def summary(report):
+    t = report['totals']
+    return "[%5.0f s] shards %d/%d vehicles %d/%d ready %d attached %d sent %d (%.1f/s) errors %d cpu %.1f s rss %.0f MB (peak %.0f MB) restarts %d" % (
+        report['elapsed'], t['alive'], t['shards'], t['vehicles'], t['configured'], t['ready'], t['attached'],
+        t['sent'], t['sent_per_s'], t['send_errors'], t['cpu'], t['rss_kb'] / 1024., t['rss_peak_kb'] / 1024., t['restarts'])
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "n:p:d:i:sl:r:h")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    count = DEFAULT_VEHICLES
+    processes = multiprocessing.cpu_count()
+    duration = None
+    prefix = DEFAULT_PREFIX
+    sitl = False
+    logdir = None
+    report_file = None
+    for opt, arg in opts:
+        if opt == '-n':
+            count = int(arg)
+        elif opt == '-p':
+            processes = int(arg)
+        elif opt == '-d':
+            duration = float(arg)
+        elif opt == '-i':
+            prefix = arg
+        elif opt == '-s':
+            sitl = True
+        elif opt == '-l':
+            logdir = arg
+        elif opt == '-r':
+            report_file = arg
+        elif opt == '-h':
+            print __doc__
+            sys.exit(0)
+
+    if count < 1 or processes < 1:
+        print __doc__
+        sys.exit(2)
+
+    try:
+        config = Runtime.read_config()
+    except ConfigError, e:
+        print "(FATAL) Error in the configuration.", e
+        sys.exit(2)
+    if sitl and 'sitl' not in config:
+        print "(FATAL) The sitl parameters are required in the configuration to run SITL instances."
+        sys.exit(2)
+    if logdir and not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    fleet = Fleet(config, vehicle_entries(config, count, prefix, sitl), processes, logdir)
+    print "Starting %d vehicles in %d shards" % (count, len(fleet.shards))
+    # terminate on SIGTERM as on SIGINT, writing the report
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    fleet.start()
+    next_summary = time.time() + METRICS_INTERVAL
+    try:
+        while duration is None or time.time() < fleet.started + duration:
+            fleet.collect(1.)
+            fleet.supervise()
+            if time.time() >= next_summary:
+                print summary(fleet.report())
+                next_summary += METRICS_INTERVAL
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    report = fleet.report()
+    fleet.stop()
+    print summary(report)
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "Report saved in", report_file
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+""" Vectorized geodesy functions for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Batch versions of the frame conversion functions in utils. All functions take scalars or arrays
+of latitudes and longitudes in decimal degrees, broadcast following the NumPy rules, and return
+arrays of the same shape.
+
+Distances and bearings are available with three methods:
+* 'flat' - the flat-earth approximation from the ArduPilot test code, fast but accurate only over short distances
+* 'haversine' - great circle on a spherical earth, accurate to about 0.5%
+* 'ellipsoid' - Vincenty's inverse formula on the WGS84 ellipsoid, accurate to less than a millimeter
+"""
+
+__all__ = ["offset", "distance", "bearing"]
+
+import numpy as np
+
+EARTH_RADIUS = 6378137.0            # radius of "spherical" earth used for offsets (equatorial)
+MEAN_EARTH_RADIUS = 6371008.8       # mean radius for great circle distances
+DEGREE_METERS = 1.113195e5          # meters in a degree at the equator
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+VINCENTY_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+
+def offset(lat, lon, dNorth, dEast):
+    """
+    Return the latitudes and longitudes `dNorth` and `dEast` meters from the specified positions.
+
+    The algorithm is relatively accurate over small distances (10m within 1km) except close to the poles.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    dLat = np.asarray(dNorth, dtype=np.float64) / EARTH_RADIUS
+    dLon = np.asarray(dEast, dtype=np.float64) / (EARTH_RADIUS * np.cos(np.radians(lat)))
+    return lat + np.degrees(dLat), lon + np.degrees(dLon)
+
+def distance(lat1, lon1, lat2, lon2, method='flat'):
+    """
+    Return the ground distances in meters between two sets of positions.
+    """
+    lat1 = np.asarray(lat1, dtype=np.float64)
+    lon1 = np.asarray(lon1, dtype=np.float64)
+    lat2 = np.asarray(lat2, dtype=np.float64)
+    lon2 = np.asarray(lon2, dtype=np.float64)
+    if method == 'flat':
+        return np.hypot(lat2 - lat1, lon2 - lon1) * DEGREE_METERS
+    if method == 'haversine':
+        phi1 = np.radians(lat1)
+        phi2 = np.radians(lat2)
+        h = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2
+        return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    if method == 'ellipsoid':
+        return _vincenty(lat1, lon1, lat2, lon2)[0]
+    raise ValueError("Invalid method %s" % method)
+
+def bearing(lat1, lon1, lat2, lon2, method='flat'):
+    """
+    Return the bearings in degrees [0, 360) from the first to the second set of positions.
+    """
+    lat1 = np.asarray(lat1, dtype=np.float64)
+    lon1 = np.asarray(lon1, dtype=np.float64)
+    lat2 = np.asarray(lat2, dtype=np.float64)
+    lon2 = np.asarray(lon2, dtype=np.float64)
+    if method == 'flat':
+        b = 90.00 + np.degrees(np.arctan2(-(lat2 - lat1), lon2 - lon1))
+    elif method == 'haversine':
+        phi1 = np.radians(lat1)
+        phi2 = np.radians(lat2)
+        dlon = np.radians(lon2 - lon1)
+        b = np.degrees(np.arctan2(np.sin(dlon) * np.cos(phi2),
+            np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(dlon)))
+    elif method == 'ellipsoid':
+        b = _vincenty(lat1, lon1, lat2, lon2)[1]
+    else:
+        raise ValueError("Invalid method %s" % method)
+    return np.mod(b, 360.0)
+
+def _vincenty(lat1, lon1, lat2, lon2):
+    """
+    Vincenty's inverse formula on the WGS84 ellipsoid.
+    Return the distances in meters and the initial bearings in degrees. Nearly antipodal
+    positions where the iteration does not converge fall back to the haversine distance.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    active = np.ones(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(VINCENTY_ITERATIONS):
+            sinLam, cosLam = np.sin(lam), np.cos(lam)
+            sinSigma = np.hypot(cosU2 * sinLam, cosU1 * sinU2 - sinU1 * cosU2 * cosLam)
+            cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+            sigma = np.arctan2(sinSigma, cosSigma)
+            sinAlpha = np.where(sinSigma == 0, 0., cosU1 * cosU2 * sinLam / sinSigma)
+            cos2Alpha = 1 - sinAlpha ** 2
+            # equatorial lines have cos2Alpha == 0
+            cos2SigmaM = np.where(cos2Alpha == 0, 0., cosSigma - 2 * sinU1 * sinU2 / cos2Alpha)
+            C = WGS84_F / 16 * cos2Alpha * (4 + WGS84_F * (4 - 3 * cos2Alpha))
+            prev = lam
+            lam = np.where(active, L + (1 - C) * WGS84_F * sinAlpha * (sigma + C * sinSigma *
+                (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2))), lam)
+            active = np.abs(lam - prev) > VINCENTY_TOLERANCE
+            if not active.any():
+                break
+
+        u2 = cos2Alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+            B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+        s = WGS84_B * A * (sigma - deltaSigma)
+        b = np.degrees(np.arctan2(cosU2 * np.sin(lam), cosU1 * sinU2 - sinU1 * cosU2 * np.cos(lam)))
+
+    if active.any():
+        s = np.where(active, distance(lat1, lon1, lat2, lon2, 'haversine'), s)
+        b = np.where(active, bearing(lat1, lon1, lat2, lon2, 'haversine'), b)
+    return s, b
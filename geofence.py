@@ -0,0 +1,233 @@
+""" Onboard geofence for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["Geofence"]
+
+import threading
+import numpy as np
+
+# Polygons spanning more grid cells than this are tested for every point instead of being indexed
+MAX_CELLS = 1024
+# Smallest grid cell size in degrees (about 100 m)
+MIN_CELL = 0.001
+
+class Polygon(object):
+    """
+    An inclusion or exclusion polygon with an optional altitude ceiling.
+    """
+
+    def __init__(self, pid, kind, points, ceiling=None):
+        """
+        pid: polygon identifier
+        kind: 'inclusion' or 'exclusion'
+        points: list of [lat, lon] vertices
+        ceiling: maximum altitude in meters relative to home inside an inclusion polygon
+        """
+        if kind not in ('inclusion', 'exclusion'):
+            raise ValueError("Invalid polygon type %s" % kind)
+        pts = np.array(points, dtype=np.float64)
+        if pts.ndim != 2 or pts.shape[0] < 3 or pts.shape[1] != 2:
+            raise ValueError("Invalid polygon %s" % pid)
+        self.pid = pid
+        self.kind = kind
+        self.ceiling = ceiling
+        self.lat = pts[:, 0]
+        self.lon = pts[:, 1]
+        # edges from vertex i to vertex j = i + 1
+        self._lat_j = np.roll(self.lat, -1)
+        self._lon_j = np.roll(self.lon, -1)
+        self.bbox = (self.lat.min(), self.lon.min(), self.lat.max(), self.lon.max())
+
+    def contains(self, lat, lon):
+        """
+        Ray casting point in polygon test.
+        """
+        if not (self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3]):
+            return False
+        crossing = (self.lat > lat) != (self._lat_j > lat)
+        if not crossing.any():
+            return False
+        lat_i = self.lat[crossing]
+        lon_i = self.lon[crossing]
+        lon_x = (self._lon_j[crossing] - lon_i) * (lat - lat_i) / (self._lat_j[crossing] - lat_i) + lon_i
+        return np.count_nonzero(lon < lon_x) % 2 == 1
+
+    def crosses(self, lat1, lon1, lat2, lon2):
+        """
+        Return for each segment from (lat1, lon1) to (lat2, lon2) True if it crosses an edge of the polygon.
+        """
+        # segments as a column against the edges in a row
+        lat1, lon1, lat2, lon2 = [np.asarray(x, dtype=np.float64)[:, np.newaxis] for x in (lat1, lon1, lat2, lon2)]
+        # sides of the segment ends from the edges, and of the edge ends from the segments
+        d1 = (self._lon_j - self.lon) * (lat1 - self.lat) - (self._lat_j - self.lat) * (lon1 - self.lon)
+        d2 = (self._lon_j - self.lon) * (lat2 - self.lat) - (self._lat_j - self.lat) * (lon2 - self.lon)
+        d3 = (lon2 - lon1) * (self.lat - lat1) - (lat2 - lat1) * (self.lon - lon1)
+        d4 = (lon2 - lon1) * (self._lat_j - lat1) - (lat2 - lat1) * (self._lon_j - lon1)
+        return ((d1 * d2 < 0) & (d3 * d4 < 0)).any(axis=1)
+
+    def info(self):
+        return {'id': self.pid, 'type': self.kind, 'points': np.column_stack((self.lat, self.lon)).tolist(), 'ceiling': self.ceiling}
+
+class Geofence(object):
+    """
+    Inclusion and exclusion polygons and altitude ceilings, indexed in a uniform grid
+    so that a point is tested only against the polygons overlapping its grid cell.
+    """
+
+    def __init__(self):
+        self.ceiling = None
+        self._polygons = []
+        self._cell = 1.
+        self._grid = {}         # (row, column) -> list of polygons whose bounding box overlaps the cell
+        self._large = []        # polygons tested for every point
+        self._has_inclusion = False
+        self._lock = threading.Lock()
+
+        self.breach = None      # reason of the current breach of the vehicle position
+        self._breach_cb = None
+
+    def load(self, polygons, ceiling=None):
+        """
+        Replace the geofence.
+
+        polygons: list of objects {'id': 'KSFO', 'type': 'exclusion', 'points': [[lat, lon], ...], 'ceiling': 120}
+        ceiling: maximum altitude in meters relative to home everywhere
+        """
+        polys = [Polygon(p.get('id', i), p['type'], p['points'], p.get('ceiling')) for i, p in enumerate(polygons)]
+        # cell size from the median polygon size
+        if polys:
+            sizes = [max(p.bbox[2] - p.bbox[0], p.bbox[3] - p.bbox[1]) for p in polys]
+            cell = max(float(np.median(sizes)), MIN_CELL)
+        else:
+            cell = 1.
+        grid = {}
+        large = []
+        for p in polys:
+            r0, c0 = self._index(p.bbox[0], p.bbox[1], cell)
+            r1, c1 = self._index(p.bbox[2], p.bbox[3], cell)
+            if (r1 - r0 + 1) * (c1 - c0 + 1) > MAX_CELLS:
+                large.append(p)
+                continue
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    grid.setdefault((r, c), []).append(p)
+        with self._lock:
+            self.ceiling = ceiling
+            self._polygons = polys
+            self._cell = cell
+            self._grid = grid
+            self._large = large
+            self._has_inclusion = any(p.kind == 'inclusion' for p in polys)
+
+    def clear(self):
+        """
+        Remove all polygons and the ceiling.
+        """
+        self.load([], None)
+
+    def active(self):
+        return bool(self._polygons) or self.ceiling is not None
+
+    @staticmethod
+    def _index(lat, lon, cell):
+        return int(np.floor(lat / cell)), int(np.floor(lon / cell))
+
+    def check(self, lat, lon, alt=None):
+        """
+        Check a position against the geofence. Return None if the position is allowed,
+        or a string with the reason of the breach.
+
+        alt: altitude in meters relative to home, or None to skip the ceiling checks
+        """
+        with self._lock:
+            if self.ceiling is not None and alt is not None and alt > self.ceiling:
+                return "above ceiling %.1f m" % self.ceiling
+            if not self._polygons:
+                return None
+            candidates = self._grid.get(self._index(lat, lon, self._cell), [])
+            if self._large:
+                candidates = candidates + self._large
+            inside = [p for p in candidates if p.contains(lat, lon)]
+
+        for p in inside:
+            if p.kind == 'exclusion':
+                return "inside exclusion %s" % p.pid
+        if not self._has_inclusion:
+            return None
+        inclusions = [p for p in inside if p.kind == 'inclusion']
+        if not inclusions:
+            return "outside inclusion polygons"
+        if alt is not None:
+            ceilings = [p.ceiling for p in inclusions]
+            if None not in ceilings and alt > max(ceilings):
+                return "above ceiling %.1f m" % max(ceilings)
+        return None
+
+    def check_path(self, lat, lon):
+        """
+        Check the legs between consecutive points of a path against the exclusion polygons, whose
+        positions are checked on their own. Return None if no leg crosses an exclusion polygon,
+        or a tuple (index of the first leg crossing one, reason of the breach).
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if len(lat) < 2:
+            return None
+        with self._lock:
+            exclusions = [p for p in self._polygons if p.kind == 'exclusion']
+        lat1, lon1, lat2, lon2 = lat[:-1], lon[:-1], lat[1:], lon[1:]
+        first = None
+        for p in exclusions:
+            # legs overlapping the bounding box of the polygon
+            near = np.nonzero((np.maximum(lat1, lat2) >= p.bbox[0]) & (np.minimum(lat1, lat2) <= p.bbox[2]) &
+                (np.maximum(lon1, lon2) >= p.bbox[1]) & (np.minimum(lon1, lon2) <= p.bbox[3]))[0]
+            if not len(near):
+                continue
+            crossing = near[p.crosses(lat1[near], lon1[near], lat2[near], lon2[near])]
+            if len(crossing) and (first is None or crossing[0] < first[0]):
+                first = (int(crossing[0]), "crossing exclusion %s" % p.pid)
+        return first
+
+    def info(self):
+        """
+        Return the geofence definition.
+        """
+        with self._lock:
+            return {'ceiling': self.ceiling, 'polygons': [p.info() for p in self._polygons], 'breach': self.breach}
+
+    def watch(self, vehicle, breach_cb):
+        """
+        Check every location update of the vehicle.
+
+        breach_cb: function(reason, location) invoked when the vehicle breaches the geofence,
+            and with reason None when it is back inside
+        """
+        self._breach_cb = breach_cb
+        vehicle.add_attribute_listener('location.global_relative_frame', self._on_location)
+
+    def _on_location(self, vehicle, name, location):
+        """
+        DroneKit location listener.
+        """
+        if location.lat is None or location.lon is None or not self.active():
+            reason = None
+        else:
+            reason = self.check(location.lat, location.lon, location.alt)
+        if reason != self.breach:
+            self.breach = reason
+            if self._breach_cb:
+                self._breach_cb(reason, location)
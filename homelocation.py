@@ -0,0 +1,120 @@
+""" Home location tracking for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The home location is cached as DroneKit notifies it, from the HOME_POSITION messages sent by
+the autopilot when the home is set or changed, or in reply to MAV_CMD_GET_HOME_POSITION. The
+home is requested when the vehicle is bound, so that it is usually known before it is asked
+for, and again when asked for while still unknown, at most once every request_interval
+seconds. A caller waits for the home up to its own timeout, and the mission is never
+downloaded to read the home from its first item.
+"""
+
+__all__ = ["HomeLocation"]
+
+import time
+import threading
+
+from pymavlink import mavutil
+
+mavlink = mavutil.mavlink
+
+# Default values
+DEFAULT_TIMEOUT = 2.            # seconds waiting for the home location when unknown
+MAX_TIMEOUT = 30.
+REQUEST_INTERVAL = 1.           # seconds between requests of the home location
+
+class HomeLocation(object):
+    """
+    Cache of the home location of the vehicle.
+    """
+
+    def __init__(self, vehicle, request_interval=REQUEST_INTERVAL):
+        """
+        vehicle: the DroneKit vehicle
+        request_interval: minimum seconds between requests of the home location to the autopilot
+        """
+        self.request_interval = request_interval
+        self.location = None        # LocationGlobal of the home, None until known
+        self.updated = None         # time of the last update
+        self.requests = 0           # MAV_CMD_GET_HOME_POSITION sent
+
+        self._vehicle = None
+        self._known = threading.Event()
+        self._requested = 0.
+        self.bind(vehicle)
+
+    def bind(self, vehicle):
+        """
+        Track the home of a new vehicle, after a reconnection.
+        """
+        if self._vehicle is not None:
+            self._vehicle.remove_attribute_listener('home_location', self._on_home)
+        self._vehicle = vehicle
+        self.location = None
+        self._known.clear()
+        self._requested = 0.
+        vehicle.add_attribute_listener('home_location', self._on_home)
+        # already known by the vehicle, from a mission downloaded or set
+        self._update(vehicle.home_location)
+        if self.location is None:
+            self.request()
+
+    def get(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Return the home location, waiting up to timeout seconds while unknown. Return None on timeout.
+        """
+        if self.location is None:
+            self._update(self._vehicle.home_location)
+        if self.location is None and timeout > 0:
+            self.request()
+            self._known.wait(min(timeout, MAX_TIMEOUT))
+        return self.location
+
+    def set(self, location):
+        """
+        Set the home location of the vehicle.
+        """
+        self._vehicle.home_location = location
+        self._update(location)
+
+    def request(self):
+        """
+        Request the home location to the autopilot, unless requested in the last request_interval seconds.
+        """
+        now = time.time()
+        if now - self._requested < self.request_interval:
+            return
+        self._requested = now
+        self.requests += 1
+        self._vehicle.send_mavlink(self._vehicle.message_factory.command_long_encode(
+            0, 0,    # target system, target component
+            mavlink.MAV_CMD_GET_HOME_POSITION, 0,
+            0, 0, 0, 0, 0, 0, 0))
+
+    def _update(self, location):
+        if location is None or location.lat is None:
+            return
+        self.location = location
+        self.updated = time.time()
+        self._known.set()
+
+    def _on_home(self, vehicle, name, location):
+        """
+        DroneKit home_location listener.
+        """
+        self._update(location)
@@ -0,0 +1,96 @@
+""" Minimal Linux inotify binding for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["Inotify", "available"]
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0x00080000
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+_EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+def available():
+    """
+    Return True if inotify is available on this system.
+    """
+    return _libc is not None
+
+class Inotify(object):
+    """
+    An inotify instance. Events are read with a blocking read().
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self._fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._paths = {}
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """
+        Watch a file or a directory for the events in mask. Return the watch descriptor.
+        """
+        wd = _libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self._paths[wd] = path
+        return wd
+
+    def read(self):
+        """
+        Block until events are available and return a list of (path, mask, name) tuples,
+        where name is the file name in a watched directory or an empty string.
+        """
+        buf = os.read(self._fd, 64 * (_EVENT.size + 256))
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(buf):
+            wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((self._paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self._fd)
@@ -0,0 +1,299 @@
+""" Dataflash log download for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+A log is read from the autopilot one chunk at a time with LOG_REQUEST_DATA. The LOG_DATA replies
+carry 90 bytes each and the ones lost on the link are requested again, until the chunk is
+complete. Every chunk is sent upstream with its offset in the log, optionally compressed on its
+own, so that the application can resume an interrupted download from the offset following the
+last chunk received. A chunk refused by the Cometa client, while reconnecting or when the bulk
+lane is full, is sent again later instead of being dropped, and the chunks sent are spaced to
+stay within max_rate bytes per second of the upstream link, counted after the base64 encoding of
+the data events.
+"""
+
+__all__ = ["LogDownloader"]
+
+import time
+import zlib
+import threading
+
+from pymavlink import mavutil
+
+from runtime import Runtime
+import logger
+
+mavlink = mavutil.mavlink
+
+# Default values
+DEFAULT_CHUNK_SIZE = 16384      # bytes of a log chunk sent upstream
+MAX_CHUNK_SIZE = 262144
+
+# bytes of log data in a LOG_DATA message
+LOG_DATA_SIZE = 90
+# seconds waiting for the LOG_ENTRY messages of a log list requested by the application
+LIST_TIMEOUT = 1.
+# seconds waiting for them before a download, in the thread of the download
+DOWNLOAD_LIST_TIMEOUT = 3.
+# seconds without LOG_DATA before requesting the missing data again
+REQUEST_TIMEOUT = 1.
+# requests without any progress before giving up
+MAX_RETRIES = 5
+# seconds before sending again a chunk refused by the Cometa client
+SEND_RETRY = 0.5
+
+class Transfer(object):
+    """
+    The state of a log download.
+    """
+
+    def __init__(self, log_id, offset, chunk_size, compress, max_rate):
+        self.log_id = log_id
+        self.offset = offset            # offset of the next chunk
+        self.size = None                # size of the log, from the log list
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.max_rate = max_rate
+        self.state = 'starting'         # listing, reading, sending, waiting, done, cancelled or failed
+        self.error = None
+        self.chunks = 0
+        self.sent = 0                   # bytes sent upstream
+        self.requests = 0               # LOG_REQUEST_DATA sent
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def status(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return {'id': self.log_id, 'offset': self.offset, 'size': self.size, 'state': self.state,
+            'error': self.error, 'chunk_size': self.chunk_size, 'compress': self.compress,
+            'max_rate': self.max_rate, 'chunks': self.chunks, 'sent': self.sent, 'requests': self.requests,
+            'elapsed': elapsed}
+
+class LogDownloader(object):
+    """
+    List the dataflash logs of the autopilot and stream one of them upstream in chunks.
+    """
+
+    def __init__(self, vehicle, send_cb):
+        """
+        vehicle: the DroneKit vehicle
+        send_cb: function(msg) sending a chunk upstream, returning False when refused
+        """
+        self.logs = {}                  # log id -> LOG_ENTRY of the last list
+        self.transfer = None
+
+        self._send_cb = send_cb
+        self._vehicle = None
+        self._lock = threading.Lock()
+        self._entries = None            # LOG_ENTRY messages of the list in progress
+        self._listed = threading.Event()
+        self._chunk = None              # [log id, offset, buffer, missing pieces] of the chunk read
+        self._progress = threading.Event()
+        self.bind(vehicle)
+
+    def bind(self, vehicle):
+        """
+        Use a new vehicle, after a reconnection. A download in progress requests the missing data again.
+        """
+        if self._vehicle is not None:
+            self._vehicle.remove_message_listener('LOG_ENTRY', self._on_entry)
+            self._vehicle.remove_message_listener('LOG_DATA', self._on_data)
+        self._vehicle = vehicle
+        vehicle.add_message_listener('LOG_ENTRY', self._on_entry)
+        vehicle.add_message_listener('LOG_DATA', self._on_data)
+
+    def running(self):
+        return self.transfer is not None and self.transfer.state not in ('done', 'cancelled', 'failed')
+
+    def list(self, timeout=LIST_TIMEOUT):
+        """
+        Return the logs of the autopilot [{"id": 1, "size": 1048576, "time_utc": 1478386938}].
+        """
+        with self._lock:
+            self._entries = {}
+            self._listed.clear()
+        self._vehicle.send_mavlink(self._vehicle.message_factory.log_request_list_encode(
+            0, 0,    # target system, target component
+            0, 0xffff)) # first and last log id
+        self._listed.wait(timeout)
+        with self._lock:
+            entries = self._entries
+            self._entries = None
+        if entries:
+            self.logs = entries
+        return [{'id': e.id, 'size': e.size, 'time_utc': e.time_utc} for i, e in sorted(entries.items())]
+
+    def start(self, log_id, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, compress=False, max_rate=None):
+        """
+        Start downloading a log from the specified offset. Return False if a download is in progress.
+        """
+        if self.running():
+            return False
+        self.transfer = Transfer(log_id, offset, chunk_size, compress, max_rate)
+        t = threading.Thread(target=self._run, args=(self.transfer,), name='log-download')
+        t.daemon = True
+        t.start()
+        return True
+
+    def cancel(self):
+        if not self.running():
+            return False
+        self.transfer.cancelled.set()
+        self._progress.set()
+        return True
+
+    def status(self):
+        return self.transfer.status() if self.transfer else None
+
+    def _on_entry(self, vehicle, name, msg):
+        """
+        DroneKit LOG_ENTRY listener.
+        """
+        with self._lock:
+            if self._entries is None:
+                return
+            if msg.num_logs:
+                self._entries[msg.id] = msg
+            if len(self._entries) >= msg.num_logs:
+                self._listed.set()
+
+    def _on_data(self, vehicle, name, msg):
+        """
+        DroneKit LOG_DATA listener.
+        """
+        with self._lock:
+            if self._chunk is None or msg.id != self._chunk[0]:
+                return
+            log_id, offset, buf, missing = self._chunk
+            if msg.count == 0 and msg.ofs <= offset + len(buf):
+                # the end of the log
+                del buf[max(msg.ofs - offset, 0):]
+                missing.difference_update([p for p in missing if p * LOG_DATA_SIZE >= len(buf)])
+            else:
+                piece = (msg.ofs - offset) // LOG_DATA_SIZE
+                if piece not in missing or msg.ofs != offset + piece * LOG_DATA_SIZE:
+                    return
+                data = bytearray(msg.data[:msg.count])
+                buf[msg.ofs - offset:msg.ofs - offset + len(data)] = data
+                missing.discard(piece)
+        self._progress.set()
+
+    def _run(self, transfer):
+        """
+        Thread downloading a log.
+        """
+        try:
+            if transfer.log_id not in self.logs:
+                transfer.state = 'listing'
+                self.list(DOWNLOAD_LIST_TIMEOUT)
+            entry = self.logs.get(transfer.log_id)
+            if entry is None:
+                transfer.state = 'failed'
+                transfer.error = 'log not found'
+                return
+            transfer.size = entry.size
+            next_send = time.time()
+            while transfer.offset < transfer.size and not transfer.cancelled.is_set():
+                transfer.state = 'reading'
+                data = self._read(transfer, min(transfer.chunk_size, transfer.size - transfer.offset))
+                if data is None:
+                    break
+                last = transfer.offset + len(data) >= transfer.size or not data
+                msg = {'log_id': transfer.log_id, 'offset': transfer.offset, 'size': len(data),
+                    'log_size': transfer.size, 'crc32': zlib.crc32(data) & 0xffffffff, 'last': last,
+                    'compressed': False}
+                if transfer.compress:
+                    packed = zlib.compress(data)
+                    if len(packed) < len(data):
+                        data = packed
+                        msg['compressed'] = True
+                msg['data'] = data
+                # keep within max_rate bytes per second of the data encoded in base64
+                if transfer.max_rate:
+                    time.sleep(max(0, next_send - time.time()))
+                    next_send = max(next_send, time.time()) + 4 * ((len(data) + 2) // 3) / float(transfer.max_rate)
+                transfer.state = 'sending'
+                while not self._send_cb(msg):
+                    transfer.state = 'waiting'
+                    if transfer.cancelled.wait(SEND_RETRY):
+                        break
+                else:
+                    transfer.chunks += 1
+                    transfer.sent += len(data)
+                    transfer.offset += msg['size']
+                if last:
+                    break
+            if transfer.cancelled.is_set():
+                transfer.state = 'cancelled'
+            elif transfer.state != 'failed':
+                transfer.state = 'done'
+        except Exception as e:
+            Runtime.syslog("Error downloading log %s: %s", transfer.log_id, e, level=logger.ERROR)
+            transfer.state = 'failed'
+            transfer.error = str(e)
+        finally:
+            transfer.finished = time.time()
+            with self._lock:
+                self._chunk = None
+            try:
+                # the autopilot resumes logging
+                self._vehicle.send_mavlink(self._vehicle.message_factory.log_request_end_encode(0, 0))
+            except Exception as e:
+                Runtime.syslog("Error ending the download of log %s: %s", transfer.log_id, e, level=logger.WARNING)
+
+    def _read(self, transfer, size):
+        """
+        Read a chunk of the log at the offset of the transfer. Return None if cancelled or failed.
+        """
+        offset = transfer.offset
+        missing = set(range((size + LOG_DATA_SIZE - 1) // LOG_DATA_SIZE))
+        buf = bytearray(size)
+        with self._lock:
+            self._chunk = [transfer.log_id, offset, buf, missing]
+        retries = 0
+        try:
+            while not transfer.cancelled.is_set():
+                with self._lock:
+                    if not missing:
+                        return bytes(buf)
+                    first, last = min(missing), max(missing)
+                    remaining = len(missing)
+                # request the span of the data still missing
+                self._progress.clear()
+                start = offset + first * LOG_DATA_SIZE
+                self._vehicle.send_mavlink(self._vehicle.message_factory.log_request_data_encode(
+                    0, 0,    # target system, target component
+                    transfer.log_id, start, min(offset + (last + 1) * LOG_DATA_SIZE, offset + size) - start))
+                transfer.requests += 1
+                # wait while data is received
+                while self._progress.wait(REQUEST_TIMEOUT) and not transfer.cancelled.is_set():
+                    self._progress.clear()
+                    with self._lock:
+                        if not missing:
+                            break
+                with self._lock:
+                    progress = len(missing) < remaining
+                retries = 0 if progress else retries + 1
+                if retries > MAX_RETRIES:
+                    transfer.state = 'failed'
+                    transfer.error = 'timeout reading offset %d' % start
+                    return None
+            return None
+        finally:
+            with self._lock:
+                self._chunk = None
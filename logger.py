@@ -0,0 +1,122 @@
+""" Asynchronous system logger for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Callers only append a record tuple to two bounded deques, which is atomic in CPython and
+does not take a lock. Records below the logger level are discarded before anything else.
+The message is formatted with its arguments and written by a background thread, so that
+a slow console does not stall the caller. The most recent records are kept for inspection.
+"""
+
+__all__ = ["Logger", "DEBUG", "INFO", "WARNING", "ERROR", "LEVELS"]
+
+import sys
+import threading
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+NAMES = dict((v, k.upper()) for k, v in LEVELS.items())
+
+# Records kept for inspection and queued for writing
+DEFAULT_SIZE = 1024
+
+def _format(record):
+    """
+    Return the message of a record (time, level, msg, args, escape).
+    """
+    msg = record[2]
+    if record[3]:
+        try:
+            msg = msg % record[3]
+        except (TypeError, ValueError):
+            msg = "%s %s" % (msg, record[3])
+    if record[4]:
+        msg = msg.replace('\n', '#015').replace('\r', '#012')
+    return msg
+
+class Logger(object):
+    """
+    Ring buffer logger with a background writer.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, level=INFO, stream=None):
+        """
+        size: number of records kept and queued for writing
+        level: minimum level of the records logged
+        stream: output file, sys.stdout by default
+        """
+        self.level = level
+        self.dropped = 0            # records not written because the queue was full
+        self.stream = stream or sys.stdout
+        self._ring = deque(maxlen=size)
+        self._queue = deque(maxlen=size)
+        self._event = threading.Event()
+        self._thread = threading.Thread(target=self._writer, name='logger')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, now, level, msg, args=None, escape=False):
+        """
+        Log a message formatted as msg % args at the specified level.
+        """
+        if level < self.level:
+            return
+        record = (now, level, msg, args, escape)
+        self._ring.append(record)
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(record)
+        self._event.set()
+
+    def resize(self, size):
+        """
+        Change the number of records kept.
+        """
+        self._ring = deque(self._ring, maxlen=size)
+        self._queue = deque(self._queue, maxlen=size)
+
+    def records(self, count=None, level=DEBUG):
+        """
+        Return the most recent records at or above level, oldest first.
+        """
+        records = [r for r in list(self._ring) if r[1] >= level]
+        if count is not None:
+            records = records[-count:] if count > 0 else []
+        return [{'time': r[0], 'level': NAMES.get(r[1], r[1]), 'msg': _format(r)} for r in records]
+
+    def _writer(self):
+        """
+        Thread formatting and writing the queued records.
+        """
+        while True:
+            self._event.wait()
+            self._event.clear()
+            while self._queue:
+                record = self._queue.popleft()
+                try:
+                    self.stream.write("[%d] %s\n" % (record[0], _format(record)))
+                except Exception:
+                    pass
+            try:
+                self.stream.flush()
+            except Exception:
+                pass
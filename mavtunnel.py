@@ -0,0 +1,156 @@
+""" MAVLink passthrough tunnel for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Upstream, the frames received from the vehicle are filtered by message type, limited to a maximum
+rate per message type and appended to a batch. The batch is flushed every flush interval, or as
+soon as it reaches max_batch bytes. Downstream, raw frames are queued on the vehicle connection
+with the messages sent by DroneKit.
+"""
+
+__all__ = ["MavlinkTunnel"]
+
+import time
+import threading
+
+from runtime import Runtime
+import logger
+
+# Default values
+DEFAULT_FLUSH_INTERVAL = 0.1    # seconds
+DEFAULT_MAX_BATCH = 4096        # bytes
+
+class MavlinkTunnel(object):
+    """
+    Forward the MAVLink frames of the vehicle in batches and write frames to the vehicle.
+    """
+
+    def __init__(self, vehicle, send_cb, flush_interval=DEFAULT_FLUSH_INTERVAL, max_batch=DEFAULT_MAX_BATCH,
+            types=None, rates=None):
+        """
+        vehicle: the DroneKit vehicle
+        send_cb: function(data, frames) invoked with a batch of frames to send upstream
+        flush_interval: maximum seconds a frame waits in the batch
+        max_batch: bytes of a batch flushed immediately
+        types: message types forwarded, all if None
+        rates: maximum frames per second of message types {"ATTITUDE": 5}
+        """
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.types = set(types) if types is not None else None
+        self.rates = dict(rates or {})
+        self.received = 0           # frames received from the vehicle
+        self.filtered = 0           # frames not forwarded by type or rate
+        self.forwarded = 0          # frames sent upstream
+        self.batches = 0
+        self.written = 0            # bytes written to the vehicle
+
+        self._send_cb = send_cb
+        self._vehicle = None
+        self._batch = []
+        self._size = 0
+        self._last = {}             # message type -> time of the last frame forwarded
+        self._lock = threading.Lock()
+        self._flush = threading.Event()
+        self._stop = threading.Event()
+
+        self.bind(vehicle)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def bind(self, vehicle):
+        """
+        Tunnel a new vehicle, after a reconnection.
+        """
+        if self._vehicle is not None:
+            self._vehicle.remove_message_listener('*', self._on_message)
+        self._vehicle = vehicle
+        vehicle.add_message_listener('*', self._on_message)
+
+    def configure(self, **options):
+        """
+        Change the options given as in the constructor, the others keep their value.
+        """
+        if 'types' in options:
+            self.types = set(options['types']) if options['types'] is not None else None
+        if 'rates' in options:
+            self.rates = dict(options['rates'] or {})
+        self.flush_interval = options.get('flush_interval', self.flush_interval)
+        self.max_batch = options.get('max_batch', self.max_batch)
+
+    def close(self):
+        self._vehicle.remove_message_listener('*', self._on_message)
+        self._stop.set()
+        self._flush.set()
+
+    def write(self, data):
+        """
+        Write raw frames to the vehicle.
+        """
+        self._vehicle._master.mav.file.write(data)
+        self.written += len(data)
+
+    def status(self):
+        return {'types': sorted(self.types) if self.types is not None else None, 'rates': self.rates,
+            'flush_interval': self.flush_interval, 'max_batch': self.max_batch, 'received': self.received,
+            'filtered': self.filtered, 'forwarded': self.forwarded, 'batches': self.batches, 'written': self.written}
+
+    def _on_message(self, vehicle, name, msg):
+        """
+        DroneKit listener of all the messages.
+        """
+        self.received += 1
+        t = msg.get_type()
+        if self.types is not None and t not in self.types:
+            self.filtered += 1
+            return
+        rate = self.rates.get(t)
+        if rate:
+            now = time.time()
+            if now - self._last.get(t, 0.) < 1. / rate:
+                self.filtered += 1
+                return
+            self._last[t] = now
+        buf = bytes(msg.get_msgbuf())
+        with self._lock:
+            self._batch.append(buf)
+            self._size += len(buf)
+            full = self._size >= self.max_batch
+        if full:
+            self._flush.set()
+
+    def _run(self):
+        """
+        Thread sending the batches upstream.
+        """
+        while not self._stop.is_set():
+            self._flush.wait(self.flush_interval)
+            self._flush.clear()
+            with self._lock:
+                if not self._batch:
+                    continue
+                data = ''.join(self._batch)
+                frames = len(self._batch)
+                self._batch = []
+                self._size = 0
+            self.batches += 1
+            self.forwarded += frames
+            try:
+                self._send_cb(data, frames)
+            except Exception as e:
+                Runtime.syslog("MAVLink tunnel: error sending a batch of %d frames: %s", frames, e, level=logger.WARNING)
@@ -0,0 +1,241 @@
+""" Mission progress events for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Mission items are numbered as in the MAVLink mission protocol, with the home location at 0 and
+the first command of the flight plan at 1. The current item comes from MISSION_CURRENT and the
+items reached from MISSION_ITEM_REACHED, and a progress update is pushed when they change, when
+the vehicle leaves or resumes the AUTO mode, at the end of the mission and every period seconds
+while flying it. The remaining distance is from the vehicle to the current item and along the
+following items with a location, and the ETA is the remaining distance at the groundspeed, or
+at the waypoint speed of the autopilot while the vehicle is slower.
+"""
+
+__all__ = ["MissionProgress"]
+
+import time
+import threading
+
+import geodesy
+from pymavlink import mavutil
+
+from runtime import Runtime
+import logger
+
+mavlink = mavutil.mavlink
+
+# Default values
+DEFAULT_PERIOD = 2.         # seconds between progress updates while flying the mission
+
+# rate of MISSION_CURRENT during a mission
+MISSION_RATE = 1.
+# groundspeed in m/s below which the ETA uses the waypoint speed
+MIN_SPEED = 1.
+
+# commands with a location flown to
+NAV_COMMANDS = (mavlink.MAV_CMD_NAV_WAYPOINT, mavlink.MAV_CMD_NAV_SPLINE_WAYPOINT, mavlink.MAV_CMD_NAV_LOITER_UNLIM,
+    mavlink.MAV_CMD_NAV_LOITER_TURNS, mavlink.MAV_CMD_NAV_LOITER_TIME, mavlink.MAV_CMD_NAV_LAND)
+# commands ending the mission, possibly away from the AUTO mode
+RETURN_COMMANDS = (mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH, mavlink.MAV_CMD_NAV_LAND)
+
+class MissionProgress(object):
+    """
+    Follow the progress of the mission started on the vehicle.
+    """
+
+    def __init__(self, vehicle, progress_cb, period=DEFAULT_PERIOD):
+        """
+        vehicle: the DroneKit vehicle
+        progress_cb: function(progress) invoked with the progress object of every update
+        period: seconds between progress updates while flying the mission, 0 for updates only on changes
+        """
+        self.period = period
+        self.state = None           # running, paused, completed or interrupted, None before a mission
+        self.current = None
+        self.reached = 0
+        self.last_reached = None
+        self.total = 0
+        self.started = None
+        self.finished = None
+        self.updates = 0
+
+        self._progress_cb = progress_cb
+        self._vehicle = None
+        self._lock = threading.RLock()
+        self._commands = {}         # seq -> command
+        self._positions = {}        # seq -> (lat, lon) of the items with a location
+        self._remaining = {}        # seq -> distance along the items with a location after it
+        self._pushed = 0.
+        self.bind(vehicle)
+
+    def bind(self, vehicle):
+        """
+        Follow a new vehicle, after a reconnection.
+        """
+        if self._vehicle is not None:
+            self._vehicle.remove_message_listener('MISSION_CURRENT', self._on_current)
+            self._vehicle.remove_message_listener('MISSION_ITEM_REACHED', self._on_reached)
+            self._vehicle.remove_attribute_listener('mode', self._on_mode)
+            self._vehicle.remove_attribute_listener('armed', self._on_armed)
+            self._vehicle.remove_attribute_listener('location.global_relative_frame', self._on_location)
+        self._vehicle = vehicle
+        vehicle.add_message_listener('MISSION_CURRENT', self._on_current)
+        vehicle.add_message_listener('MISSION_ITEM_REACHED', self._on_reached)
+        vehicle.add_attribute_listener('mode', self._on_mode)
+        vehicle.add_attribute_listener('armed', self._on_armed)
+        vehicle.add_attribute_listener('location.global_relative_frame', self._on_location)
+
+    def running(self):
+        return self.state in ('running', 'paused')
+
+    def start(self, commands):
+        """
+        Follow a mission of the specified commands, flown from the first one.
+        """
+        with self._lock:
+            self._commands = dict((i + 1, cmd) for i, cmd in enumerate(commands))
+            self._positions = dict((seq, (cmd.x, cmd.y)) for seq, cmd in self._commands.items()
+                if cmd.command in NAV_COMMANDS and (cmd.x or cmd.y))
+            # the return to launch flies to home
+            home = self._vehicle.home_location
+            if home is not None and home.lat is not None:
+                self._positions.update((seq, (home.lat, home.lon)) for seq, cmd in self._commands.items()
+                    if cmd.command == mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH)
+            # distance along the items from each item to the end of the mission
+            seqs = sorted(self._positions)
+            legs = geodesy.distance([self._positions[s][0] for s in seqs[:-1]], [self._positions[s][1] for s in seqs[:-1]],
+                [self._positions[s][0] for s in seqs[1:]], [self._positions[s][1] for s in seqs[1:]], method='haversine')
+            remaining = 0.
+            self._remaining = {}
+            for i in reversed(range(len(seqs))):
+                self._remaining[seqs[i]] = remaining
+                if i > 0:
+                    remaining += float(legs[i - 1])
+            self.total = len(self._commands)
+            self.current = 1 if self.total else None
+            self.reached = 0
+            self.last_reached = None
+            self.started = time.time()
+            self.finished = None
+            self.state = 'running' if self.total else None
+            if self.total:
+                self._push('started')
+
+    def progress(self):
+        """
+        Return the progress of the mission.
+        """
+        with self._lock:
+            remaining, eta = self._estimate()
+            return {'state': self.state, 'current': self.current, 'total': self.total, 'reached': self.reached,
+                'last_reached': self.last_reached, 'remaining': remaining, 'eta': eta,
+                'elapsed': (self.finished or time.time()) - self.started if self.started else None}
+
+    def _estimate(self):
+        """
+        Return the remaining distance in meters and the estimated seconds to the end of the mission.
+        """
+        if self.state not in ('running', 'paused'):
+            return (0., 0.) if self.state == 'completed' else (None, None)
+        seqs = [s for s in sorted(self._positions) if s >= self.current]
+        location = self._vehicle.location.global_relative_frame
+        if not seqs or location.lat is None:
+            return None, None
+        lat, lon = self._positions[seqs[0]]
+        remaining = float(geodesy.distance(location.lat, location.lon, lat, lon, method='haversine')) + self._remaining[seqs[0]]
+        speed = self._vehicle.groundspeed or 0.
+        if speed < MIN_SPEED:
+            speed = (self._vehicle.parameters.get('WPNAV_SPEED') or 0.) / 100.
+        return round(remaining, 1), round(remaining / speed, 1) if speed > 0 else None
+
+    def _returning(self):
+        """
+        Return True if only the commands returning to land are left after the last item reached.
+        """
+        return all(cmd.command in RETURN_COMMANDS or (cmd.command not in NAV_COMMANDS and cmd.command != mavlink.MAV_CMD_NAV_TAKEOFF)
+            for seq, cmd in self._commands.items() if seq > (self.last_reached or 0))
+
+    def _push(self, event):
+        if self.state in ('completed', 'interrupted'):
+            self.finished = time.time()
+        msg = self.progress()
+        msg['event'] = event
+        self._pushed = time.time()
+        self.updates += 1
+        try:
+            self._progress_cb(msg)
+        except Exception as e:
+            Runtime.syslog("Error sending the mission progress event %s: %s", event, e, level=logger.WARNING)
+
+    def _on_current(self, vehicle, name, msg):
+        """
+        DroneKit MISSION_CURRENT listener.
+        """
+        with self._lock:
+            if self.running() and msg.seq != self.current and msg.seq > 0:
+                self.current = msg.seq
+                self._push('current')
+
+    def _on_reached(self, vehicle, name, msg):
+        """
+        DroneKit MISSION_ITEM_REACHED listener.
+        """
+        with self._lock:
+            if not self.running() or msg.seq == self.last_reached:
+                return
+            self.reached += 1
+            self.last_reached = msg.seq
+            if msg.seq >= self.total:
+                self.state = 'completed'
+                self._push('completed')
+            else:
+                self._push('reached')
+
+    def _on_mode(self, vehicle, name, mode):
+        """
+        DroneKit mode listener.
+        """
+        with self._lock:
+            if self.state == 'running' and mode.name != 'AUTO' and not self._returning():
+                self.state = 'paused'
+                self._push('paused')
+            elif self.state == 'paused' and mode.name == 'AUTO':
+                self.state = 'running'
+                self._push('resumed')
+
+    def _on_armed(self, vehicle, name, armed):
+        """
+        DroneKit armed listener, the mission ends when the vehicle lands and disarms.
+        """
+        with self._lock:
+            if armed or not self.running():
+                return
+            if self.current >= self.total or self._returning():
+                self.state = 'completed'
+                self._push('completed')
+            else:
+                self.state = 'interrupted'
+                self._push('interrupted')
+
+    def _on_location(self, vehicle, name, location):
+        """
+        DroneKit location listener, pushing the progress every period while flying the mission.
+        """
+        if self.state == 'running' and self.period and time.time() - self._pushed >= self.period:
+            with self._lock:
+                if self.state == 'running':
+                    self._push('progress')
@@ -0,0 +1,182 @@
+""" Network interface information with change notifications for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The default route is read from /proc/net/route and the address of its interface with the
+SIOCGIFADDR ioctl, without forking a process. The result is cached and refreshed when the
+kernel reports a link, address or route change on a netlink socket.
+"""
+
+__all__ = ["NetworkMonitor"]
+
+import time
+import fcntl
+import socket
+import struct
+import threading
+
+ROUTE_FILENAME = '/proc/net/route'
+
+# Seconds between refreshes when netlink is not available
+POLL_PERIOD = 5
+# Seconds to wait for a burst of netlink messages to end before refreshing
+SETTLE_TIME = 0.2
+
+# <linux/rtnetlink.h>
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+# <linux/sockios.h> and <linux/route.h>
+SIOCGIFADDR = 0x8915
+RTF_UP = 0x1
+RTF_GATEWAY = 0x2
+
+NOT_AVAILABLE = 'N/A'
+
+def _default_route():
+    """
+    Return the (interface, gateway) of the default route with the lowest metric, or None.
+    """
+    best = None
+    with open(ROUTE_FILENAME) as f:
+        # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if len(fields) < 8 or fields[1] != '00000000' or fields[7] != '00000000':
+                continue
+            flags = int(fields[3], 16)
+            if not (flags & RTF_UP and flags & RTF_GATEWAY):
+                continue
+            metric = int(fields[6])
+            if best is None or metric < best[0]:
+                # addresses are in host byte order
+                best = (metric, fields[0], socket.inet_ntoa(struct.pack('=L', int(fields[2], 16))))
+    return best[1:] if best else None
+
+def _interface_address(interface):
+    """
+    Return the IPv4 address of an interface, or None.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', interface[:15]))
+        return socket.inet_ntoa(ifreq[20:24])
+    except IOError:
+        return None
+    finally:
+        s.close()
+
+class NetworkMonitor(object):
+    """
+    Cached information of the network interface of the default route.
+    """
+
+    def __init__(self):
+        self._info = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _read(self):
+        """
+        Read the current network information.
+        """
+        try:
+            route = _default_route()
+        except IOError:
+            route = None
+        if route is None:
+            return {'interface': NOT_AVAILABLE, 'gateway': NOT_AVAILABLE, 'ip_address': NOT_AVAILABLE}
+        interface, gateway = route
+        return {'interface': interface, 'gateway': gateway, 'ip_address': _interface_address(interface) or NOT_AVAILABLE}
+
+    def info(self):
+        """
+        Return the cached network information {'interface': 'wlan0', 'gateway': '192.168.1.1', 'ip_address': '192.168.1.10'}.
+        """
+        if self._info is None:
+            self.refresh()
+        return dict(self._info)
+
+    def refresh(self):
+        """
+        Read the network information and notify the listeners if it changed.
+        """
+        info = self._read()
+        with self._lock:
+            old = self._info
+            self._info = info
+        if old is None or old == info:
+            return
+        for listener in self._listeners:
+            try:
+                listener(old, info)
+            except Exception as e:
+                # imported here since the runtime imports this module
+                from runtime import Runtime
+                import logger
+                Runtime.syslog("Error notifying a network change: %s", e, level=logger.WARNING)
+
+    def add_listener(self, listener):
+        """
+        Add a function(old, new) invoked when the interface, address or gateway changes.
+        """
+        self._listeners.append(listener)
+
+    def watch(self):
+        """
+        Start watching for network changes, with netlink when available.
+        """
+        if self._thread:
+            return
+        self.info()
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+            self._thread = threading.Thread(target=self._watch_netlink, args=(sock,))
+        except (AttributeError, socket.error):
+            self._thread = threading.Thread(target=self._watch_poll)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch_netlink(self, sock):
+        """
+        Refresh on every burst of netlink messages. The messages are not parsed, since
+        reading the routing table again is simpler and cheap.
+        """
+        while True:
+            sock.recv(65536)
+            time.sleep(SETTLE_TIME)
+            # drain the messages received while settling
+            sock.setblocking(0)
+            try:
+                while True:
+                    sock.recv(65536)
+            except socket.error:
+                pass
+            sock.setblocking(1)
+            self.refresh()
+
+    def _watch_poll(self):
+        """
+        Refresh periodically.
+        """
+        while True:
+            time.sleep(POLL_PERIOD)
+            self.refresh()
@@ -0,0 +1,124 @@
+""" Survey and waypoint pattern generator for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Waypoint patterns are computed in meters North and East of a reference position and projected
+to latitude and longitude with geodesy.offset, the vectorized version of utils.get_location_meters.
+All functions return a tuple of arrays (lat, lon), and raise ValueError before computing the
+waypoints when their number, derived from the size of the pattern, exceeds max_waypoints.
+"""
+
+__all__ = ["lawnmower", "grid", "orbit", "path_length", "MAX_WAYPOINTS"]
+
+import numpy as np
+
+import geodesy
+
+# Default values
+MAX_WAYPOINTS = 700     # waypoints of a pattern, within the mission items stored by the autopilot
+
+def _to_meters(lat, lon, lat0, lon0):
+    """
+    Inverse of geodesy.offset: meters North and East of the reference position.
+    """
+    north = np.radians(lat - lat0) * geodesy.EARTH_RADIUS
+    east = np.radians(lon - lon0) * geodesy.EARTH_RADIUS * np.cos(np.radians(lat0))
+    return north, east
+
+def lawnmower(polygon, spacing, angle=0., max_waypoints=MAX_WAYPOINTS):
+    """
+    Back and forth sweep lines `spacing` meters apart covering the polygon.
+
+    polygon: list of [lat, lon] vertices
+    spacing: distance in meters between sweep lines
+    angle: direction of the sweep lines in degrees from North
+    max_waypoints: maximum number of waypoints
+    """
+    pts = np.array(polygon, dtype=np.float64)
+    if pts.ndim != 2 or pts.shape[0] < 3 or pts.shape[1] != 2:
+        raise ValueError("Invalid polygon")
+    if spacing <= 0:
+        raise ValueError("Invalid spacing")
+    lat0, lon0 = pts[:, 0].mean(), pts[:, 1].mean()
+    north, east = _to_meters(pts[:, 0], pts[:, 1], lat0, lon0)
+
+    # rotate so that the sweep lines are parallel to the u axis
+    a = np.radians(angle)
+    u = north * np.cos(a) + east * np.sin(a)
+    v = -north * np.sin(a) + east * np.cos(a)
+    u_j, v_j = np.roll(u, -1), np.roll(v, -1)
+
+    # every sweep line enters and leaves the polygon at least once
+    count = max(int(np.ceil((v.max() - v.min() - spacing / 2.) / spacing)), 0)
+    if 2 * count > max_waypoints:
+        raise ValueError("Too many waypoints, at least %d" % (2 * count))
+    lines = np.arange(v.min() + spacing / 2., v.max(), spacing)
+    us = []
+    vs = []
+    for k, line in enumerate(lines):
+        # intersections of the sweep line with the polygon edges
+        crossing = (v > line) != (v_j > line)
+        x = u[crossing] + (line - v[crossing]) * (u_j[crossing] - u[crossing]) / (v_j[crossing] - v[crossing])
+        x.sort()
+        if k % 2:
+            x = x[::-1]
+        # pairs of intersections delimit the segments inside the polygon
+        us.extend(x[:len(x) // 2 * 2])
+        vs.extend([line] * (len(x) // 2 * 2))
+    if len(us) > max_waypoints:
+        raise ValueError("Too many waypoints, %d" % len(us))
+    us = np.array(us)
+    vs = np.array(vs)
+
+    # rotate back and project
+    north = us * np.cos(a) - vs * np.sin(a)
+    east = us * np.sin(a) + vs * np.cos(a)
+    return geodesy.offset(lat0, lon0, north, east)
+
+def grid(polygon, spacing, angle=0., max_waypoints=MAX_WAYPOINTS):
+    """
+    Two lawnmower sweeps of the polygon at right angles.
+    """
+    lat1, lon1 = lawnmower(polygon, spacing, angle, max_waypoints)
+    lat2, lon2 = lawnmower(polygon, spacing, angle + 90., max_waypoints - len(lat1))
+    return np.concatenate((lat1, lat2)), np.concatenate((lon1, lon2))
+
+def orbit(center, radius, points=16, turns=1., max_waypoints=MAX_WAYPOINTS):
+    """
+    Waypoints on a circle around the center, clockwise starting North.
+
+    center: [lat, lon] of the center
+    radius: radius in meters
+    points: number of waypoints per turn
+    turns: number of turns
+    max_waypoints: maximum number of waypoints
+    """
+    if radius <= 0 or points < 3 or turns <= 0:
+        raise ValueError("Invalid orbit")
+    count = int(round(points * turns)) + 1
+    if count > max_waypoints:
+        raise ValueError("Too many waypoints, %d" % count)
+    a = np.linspace(0., 2 * np.pi * turns, count)
+    return geodesy.offset(center[0], center[1], radius * np.cos(a), radius * np.sin(a))
+
+def path_length(lat, lon):
+    """
+    Length in meters of the path through the waypoints.
+    """
+    if len(lat) < 2:
+        return 0.
+    return float(np.sum(geodesy.distance(lat[:-1], lon[:-1], lat[1:], lon[1:], 'haversine')))
@@ -0,0 +1,128 @@
+""" Sampling profiler and request timing for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The sampler reads the current stack of every thread with sys._current_frames at a fixed
+interval and counts identical stacks. The result is in the collapsed format of the flame graph
+tools, one line per stack: "thread;file:function;file:function count", outermost frame first.
+"""
+
+__all__ = ["Sampler", "MethodStats"]
+
+import os
+import sys
+import time
+import threading
+
+from runtime import Runtime
+import logger
+
+DEFAULT_INTERVAL = 0.01
+MAX_DURATION = 60.
+MAX_DEPTH = 64
+
+class Sampler(object):
+    """
+    Sample the stacks of all threads for a duration in a background thread.
+    """
+
+    def __init__(self, duration, interval=DEFAULT_INTERVAL, done_cb=None):
+        """
+        duration: seconds to sample, up to MAX_DURATION
+        interval: seconds between samples
+        done_cb: function(sampler) invoked when the sampling ends
+        """
+        self.duration = min(duration, MAX_DURATION)
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}            # collapsed stack -> count
+        self._done_cb = done_cb
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        me = threading.current_thread().ident
+        end = time.time() + self.duration
+        while time.time() < end:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = self._collapse(names.get(ident, str(ident)), frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        if self._done_cb:
+            try:
+                self._done_cb(self)
+            except Exception as e:
+                Runtime.syslog("Error sending the profile: %s", e, level=logger.WARNING)
+
+    @staticmethod
+    def _collapse(name, frame):
+        frames = []
+        while frame is not None and len(frames) < MAX_DEPTH:
+            code = frame.f_code
+            frames.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        frames.append(name.replace(' ', '_'))
+        return ';'.join(reversed(frames))
+
+    def collapsed(self):
+        """
+        Return the stacks in the collapsed format, most frequent first.
+        """
+        return '\n'.join("%s %d" % (s, n) for s, n in sorted(self.stacks.items(), key=lambda x: -x[1]))
+
+class MethodStats(object):
+    """
+    Wall and CPU time of the requests by method.
+    """
+
+    def __init__(self):
+        self._stats = {}            # method -> [calls, errors, wall total, wall max, cpu total]
+        self._lock = threading.Lock()
+
+    def record(self, method, wall, cpu, error=False):
+        with self._lock:
+            s = self._stats.get(method)
+            if s is None:
+                s = self._stats[method] = [0, 0, 0., 0., 0.]
+            s[0] += 1
+            s[1] += int(error)
+            s[2] += wall
+            s[3] = max(s[3], wall)
+            s[4] += cpu
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def stats(self):
+        """
+        Return the statistics by method with times in milliseconds.
+        """
+        with self._lock:
+            return dict((m, {'calls': s[0], 'errors': s[1], 'wall_ms': s[2] * 1000, 'wall_max_ms': s[3] * 1000,
+                'wall_mean_ms': s[2] * 1000 / s[0], 'cpu_ms': s[4] * 1000}) for m, s in self._stats.items())
@@ -0,0 +1,140 @@
+""" Traffic recorder for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+A recording is a gzip file starting with a line of JSON describing it, followed by one binary
+record for each JSON-RPC request received and each frame sent by the Cometa client: a header
+with the monotonic time in seconds, the direction, the priority lane of the frame sent and the
+length of the data, then the data. The file is flushed every second, so that a recording of an
+agent terminated abruptly is readable up to the last flush.
+"""
+
+__all__ = ["TrafficRecorder", "read_recording", "recording_path", "RECEIVED", "SENT"]
+
+import os
+import json
+import gzip
+import time
+import struct
+import threading
+
+from runtime import Runtime
+
+# Default values
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024    # bytes of data recorded before stopping
+
+MAGIC = 'cometa-traffic'
+RECEIVED = 0        # request received
+SENT = 1            # frame sent
+HEADER = struct.Struct('<dBBI')     # time, direction, priority, length
+# seconds between flushes of the file
+FLUSH_INTERVAL = 1.
+
+class TrafficRecorder(object):
+    """
+    Record the traffic of a Cometa client, set as its recorder.
+    """
+
+    def __init__(self, path, device_id, max_size=DEFAULT_MAX_SIZE):
+        """
+        path: file of the recording
+        device_id: device id of the client recorded
+        max_size: bytes of data recorded before stopping
+        """
+        self.path = path
+        self.max_size = max_size
+        self.records = 0
+        self.size = 0               # bytes of data recorded
+        self.dropped = 0            # records not written after max_size
+
+        self._lock = threading.Lock()
+        self._flushed = Runtime.monotonic()
+        self._file = gzip.open(path, 'wb')
+        self._file.write(json.dumps({'format': MAGIC, 'version': 1, 'device_id': device_id,
+            'time': time.time(), 'monotonic': self._flushed}) + '\n')
+
+    def received(self, data):
+        """
+        Record a request received.
+        """
+        self._record(RECEIVED, 0, data)
+
+    def sent(self, frame, priority):
+        """
+        Record a frame sent in the lane of the specified priority.
+        """
+        self._record(SENT, priority, frame)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def status(self):
+        return {'path': self.path, 'records': self.records, 'size': self.size, 'dropped': self.dropped,
+            'max_size': self.max_size}
+
+    def _record(self, direction, priority, data):
+        now = Runtime.monotonic()
+        with self._lock:
+            if self._file is None:
+                return
+            if self.size + len(data) > self.max_size:
+                self.dropped += 1
+                return
+            self._file.write(HEADER.pack(now, direction, priority, len(data)))
+            self._file.write(data)
+            self.records += 1
+            self.size += len(data)
+            if now - self._flushed >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now
+
+def read_recording(path):
+    """
+    Return the description of a recording and a generator of its records (time, direction, priority, data).
+    """
+    f = gzip.open(path, 'rb')
+    info = json.loads(f.readline())
+    if info.get('format') != MAGIC:
+        f.close()
+        raise ValueError("%s is not a traffic recording" % path)
+
+    def records():
+        try:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                t, direction, priority, length = HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield t, direction, priority, data
+        except (IOError, EOFError, struct.error):
+            # the end of a recording not closed
+            return
+        finally:
+            f.close()
+    return info, records()
+
+def recording_path(directory, device_id):
+    """
+    Return the path of a new recording of a device in a directory.
+    """
+    return os.path.join(directory, "%s-%s.rec.gz" % (device_id, time.strftime("%Y%m%d-%H%M%S")))
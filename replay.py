@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+""" Replay of recorded traffic for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The requests of a recording made with the "record" parameters of config.json are fed to the
+message handler of an agent with the fake vehicle, or with SITL, in the same sequence as the
+Cometa client receives them, at the original pacing or as fast as possible. The events sent
+are counted without a connection to the Cometa server.
+
+The latency of a request is from the time it is due, at the original pacing, to its reply,
+so it includes the time waiting for the previous requests. The report has the latency by
+method, compared with the latency of the recorded replies, which also includes the time
+queued for sending, and the throughput of the replay.
+
+Usage:
+    ./replay.py [-f] [-x speed] [-s] [-r report.json] [-b report.json] [-t tolerance] recording
+
+    -f  replay as fast as possible instead of at the original pacing
+    -x  speed factor of the original pacing (default 1)
+    -s  use SITL as configured in config.json instead of the fake vehicle
+    -r  file of the JSON report
+    -b  compare with the report of a previous replay and exit with status 1 if the p95
+        latency of a method is higher than in the report by more than the tolerance
+    -t  tolerance as a fraction of the p95 latency of the report (default 0.25)
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import threading
+from collections import deque
+
+from runtime import Runtime
+from cometalib import CometaClient
+from configuration import ConfigError, freeze
+from recorder import read_recording, RECEIVED, SENT
+from startup import Startup
+import application
+
+DEFAULT_TOLERANCE = 0.25
+
+class ReplayClient(object):
+    """
+    Replacement of the Cometa client of the agent counting the data events sent.
+    """
+
+    def __init__(self):
+        self.debug = False
+        self.error = 0
+        self.recorder = None
+        self.events = [0, 0, 0]     # data events sent in each priority lane
+        self.bytes = 0
+
+    def send_data(self, msg, priority=CometaClient.PRIORITY_TELEMETRY):
+        self.events[priority] += 1
+        self.bytes += len(msg)
+        return 0
+
+    def queued(self):
+        return [0, 0, 0]
+
+def load(path):
+    """
+    Return the description of a recording and its requests [(time, data, recorded latency)], the
+    latency None for a request without a recorded reply.
+    """
+    info, records = read_recording(path)
+    requests = []
+    pending = deque()   # (index, id) of the requests waiting for a reply, in order
+    for t, direction, priority, data in records:
+        if direction == RECEIVED:
+            try:
+                rid = json.loads(data).get('id')
+            except (ValueError, AttributeError):
+                rid = None
+            pending.append((len(requests), rid))
+            requests.append([t, data, None])
+        elif direction == SENT:
+            # a reply frame is a chunk with the JSON-RPC reply, data events and heartbeats start with their type
+            body = data.split('\r\n', 1)[-1][:-2]
+            if not body or body[0] in '\x06\x07':
+                continue
+            try:
+                rid = json.loads(body).get('id')
+            except (ValueError, AttributeError):
+                continue
+            # the reply of the first request with its id still waiting, as ids are reused, or of
+            # the first request waiting for an error reply without id
+            for i, (index, request_id) in enumerate(pending):
+                if rid is None or request_id == rid:
+                    del pending[i]
+                    requests[index][2] = t - requests[index][0]
+                    break
+    return info, requests
+
+def setup(info, sitl):
+    """
+    Create the agent of the recorded device with the fake vehicle, or SITL.
+    """
+    config = Runtime.read_config()
+    device_id, c = application.agent_configs(config, info['device_id'])[0]
+    c = dict(c, use_fake=not sitl)
+    application.config = config
+    agent = application.add_agent(info['device_id'], freeze(c))
+    agent.com = ReplayClient()
+    agent.bind(application.start_vehicle)(Startup())
+    agent.status = application.STATUS_READY
+    Runtime.set_status(application.STATUS_READY)
+    t = threading.Thread(target=application.telemetry_loop, name='replay-telemetry')
+    t.daemon = True
+    t.start()
+    return agent
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+def replay(agent, requests, speed, fast):
+    """
+    Replay the requests and return the latencies [(method, latency, recorded latency, error)].
+    """
+    handler = agent.bind(application.message_handler)
+    results = []
+    lag = 0.
+    start = Runtime.monotonic()
+    t0 = requests[0][0] if requests else 0.
+    for t, data, recorded in requests:
+        try:
+            method = json.loads(data).get('method')
+        except (ValueError, AttributeError):
+            method = None
+        now = Runtime.monotonic()
+        due = now if fast else start + (t - t0) / speed
+        if due > now:
+            time.sleep(due - now)
+        begin = Runtime.monotonic()
+        lag = max(lag, begin - due)
+        reply = handler(data, len(data))
+        end = Runtime.monotonic()
+        try:
+            result = json.loads(reply)
+            error = 'error' in result or (isinstance(result.get('result'), dict) and result['result'].get('success') is False)
+        except (ValueError, TypeError, AttributeError):
+            error = True
+        results.append((method or 'invalid', end - due, recorded, error))
+    return results, Runtime.monotonic() - start, lag
+
+def report(path, info, requests, results, elapsed, lag, client):
+    methods = {}
+    for method, latency, recorded, error in results:
+        m = methods.setdefault(method, {'calls': 0, 'errors': 0, 'latency': [], 'recorded': []})
+        m['calls'] += 1
+        m['errors'] += error
+        m['latency'].append(latency * 1000)
+        if recorded is not None:
+            m['recorded'].append(recorded * 1000)
+    for m in methods.values():
+        latency = sorted(m.pop('latency'))
+        recorded = sorted(m.pop('recorded'))
+        m.update({'p50_ms': percentile(latency, 0.5), 'p95_ms': percentile(latency, 0.95), 'max_ms': latency[-1],
+            'recorded_p50_ms': percentile(recorded, 0.5), 'recorded_p95_ms': percentile(recorded, 0.95)})
+    return {'recording': path, 'device_id': info['device_id'], 'recorded_at': info['time'],
+        'requests': len(results), 'duration': requests[-1][0] - requests[0][0] if requests else 0.,
+        'elapsed': elapsed, 'throughput': len(results) / elapsed if elapsed > 0 else 0.,
+        'lag_max_ms': lag * 1000, 'events': sum(client.events), 'events_by_priority': client.events,
+        'event_bytes': client.bytes, 'methods': methods}
+
+def compare(result, baseline, tolerance):
+    """
+    Print the comparison with a previous report and return the methods that regressed.
+    """
+    regressions = []
+    for method, m in sorted(result['methods'].items()):
+        b = baseline['methods'].get(method)
+        if b is None or not b['p95_ms']:
+            continue
+        change = m['p95_ms'] / b['p95_ms'] - 1
+        flag = ''
+        if change > tolerance:
+            flag = ' REGRESSION'
+            regressions.append(method)
+        print "%-32s %+7.1f%% p95%s" % (method, change * 100, flag)
+    return regressions
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "fx:sr:b:t:h")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    fast = False
+    speed = 1.
+    sitl = False
+    report_file = None
+    baseline_file = None
+    tolerance = DEFAULT_TOLERANCE
+    for opt, arg in opts:
+        if opt == '-f':
+            fast = True
+        elif opt == '-x':
+            speed = float(arg)
+        elif opt == '-s':
+            sitl = True
+        elif opt == '-r':
+            report_file = arg
+        elif opt == '-b':
+            baseline_file = arg
+        elif opt == '-t':
+            tolerance = float(arg)
+        elif opt == '-h':
+            print __doc__
+            sys.exit(0)
+    if len(args) != 1 or speed <= 0:
+        print __doc__
+        sys.exit(2)
+
+    path = args[0]
+    try:
+        info, requests = load(path)
+    except (IOError, ValueError), e:
+        print "(FATAL) Error in reading the recording.", e
+        sys.exit(2)
+    print "Replaying %d requests of %s recorded %s" % (len(requests), info['device_id'],
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info['time'])))
+
+    # the output of the agent and of its threads is not mixed with the report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        agent = setup(info, sitl)
+        results, elapsed, lag = replay(agent, requests, speed, fast)
+    except ConfigError, e:
+        sys.stdout = stdout
+        print "(FATAL) Error in the configuration.", e
+        sys.exit(2)
+    finally:
+        sys.stdout = stdout
+    result = report(path, info, requests, results, elapsed, lag, agent.com)
+
+    print "%-32s %7s %7s %9s %9s %9s %9s" % ('method', 'calls', 'errors', 'p50 ms', 'p95 ms', 'rec p50', 'rec p95')
+    for method, m in sorted(result['methods'].items()):
+        print "%-32s %7d %7d %9.2f %9.2f %9s %9s" % (method, m['calls'], m['errors'], m['p50_ms'], m['p95_ms'],
+            '%.2f' % m['recorded_p50_ms'] if m['recorded_p50_ms'] is not None else '-',
+            '%.2f' % m['recorded_p95_ms'] if m['recorded_p95_ms'] is not None else '-')
+    print "%d requests in %.2f s (%.1f/s, recorded in %.2f s), max lag %.2f ms, %d events" % (result['requests'],
+        result['elapsed'], result['throughput'], result['duration'], result['lag_max_ms'], result['events'])
+
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print "Report saved in", report_file
+
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        print "\nCompared with %s" % baseline_file
+        regressions = compare(result, baseline, tolerance)
+        if regressions:
+            print "\n%d methods regressed more than %d%%: %s" % (len(regressions), tolerance * 100, ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
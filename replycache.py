@@ -0,0 +1,94 @@
+""" JSON-RPC reply cache for retransmitted requests for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["ReplyCache"]
+
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Default values
+DEFAULT_SIZE = 256      # replies
+DEFAULT_WINDOW = 30     # seconds
+
+class ReplyCache(object):
+    """
+    Bounded LRU cache of JSON-RPC replies keyed by method, request id and a hash of the request params.
+    A request retransmitted within the window gets the cached reply instead of being executed again.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, window=DEFAULT_WINDOW):
+        """
+        size: maximum number of cached replies
+        window: seconds a reply is valid for a retransmitted request
+        """
+        self.size = size
+        self.window = window
+
+        self._replies = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @staticmethod
+    def key(method, rpc_id, params):
+        """
+        Return the cache key of a request.
+        """
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+        return "%s:%s:%s" % (method, json.dumps(rpc_id), digest)
+
+    def get(self, key):
+        """
+        Return the cached reply for the key or None.
+        """
+        with self._lock:
+            entry = self._replies.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            if time.time() - entry[0] > self.window:
+                self._expirations += 1
+                self._misses += 1
+                return None
+            # move to the most recently used end
+            self._replies[key] = entry
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, reply):
+        """
+        Cache a reply, evicting the least recently used one when the cache is full.
+        """
+        with self._lock:
+            self._replies.pop(key, None)
+            self._replies[key] = (time.time(), reply)
+            while len(self._replies) > self.size:
+                self._replies.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self):
+        """
+        Return the cache statistics.
+        """
+        with self._lock:
+            return {'size': self.size, 'window': self.window, 'entries': len(self._replies),
+                'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions, 'expirations': self._expirations}
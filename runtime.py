@@ -24,11 +24,31 @@ import threading
 import json
 import subprocess
 import os
+import ctypes
+import ctypes.util
 from uuid import getnode as get_mac
 
+from configuration import Configuration
+from netinfo import NetworkMonitor
+from videodev import VideoInventory
+from logger import Logger, INFO
+
 # Default values
 DCT_FILENAME = 'config.json'
 
+# clock_gettime(CLOCK_MONOTONIC) for a clock not affected by system time changes
+CLOCK_MONOTONIC = 1
+CLOCK_THREAD_CPUTIME_ID = 3
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+except (OSError, AttributeError):
+    _clock_gettime = None
+
 # This module uses the following enviromental variables:
 #	COMETA_APIKEY
 #	COMETA_SERVER
@@ -51,6 +71,18 @@ class Runtime(object):
     # Thread IDs
     __thtime = None     # Update __systime thread
 
+    # Device configuration
+    __configuration = None
+
+    # Network information
+    __network = None
+
+    # Video devices
+    __video = None
+
+    # System logger
+    __logger = None
+
     def __init__(self):
         """
         The Runtime object instance constructor.
@@ -102,6 +134,34 @@ class Runtime(object):
     def get_hostsystime(klass):
     	return int(time.time())
 
+    # Get monotonic time
+    @classmethod
+    def monotonic(klass):
+        """
+        Return the time in seconds of a monotonic clock with nanosecond resolution,
+        or the system time if not available.
+        """
+        t = klass._clock_gettime(CLOCK_MONOTONIC)
+        return time.time() if t is None else t
+
+    # Get CPU time of the current thread
+    @classmethod
+    def thread_time(klass):
+        """
+        Return the CPU time in seconds used by the calling thread, or 0 if not available.
+        """
+        t = klass._clock_gettime(CLOCK_THREAD_CPUTIME_ID)
+        return 0. if t is None else t
+
+    @classmethod
+    def _clock_gettime(klass, clock_id):
+        if _clock_gettime is None:
+            return None
+        t = _timespec()
+        if _clock_gettime(clock_id, ctypes.byref(t)) != 0:
+            return None
+        return t.tv_sec + t.tv_nsec * 1e-9
+
     # Set current status
     @classmethod
     def set_status(klass, new_status):
@@ -121,41 +181,28 @@ class Runtime(object):
     # Read config from DCT (Device Configuration Table simulated in a file)
     @classmethod
     def read_config(klass):
-        # read the configuration from the DCT
-        try:
-            f = open(DCT_FILENAME)
-            content = json.loads(f.read())['config']
-
-            # get Cometa API Key and Server name from the environment
-            if not 'app_key' in content['cometa']:
-            	content['cometa']['app_key'] =  os.environ['COMETA_APIKEY']
-            if not 'server' in content['cometa']:
-            	content['cometa']['server'] = os.environ['COMETA_SERVER']
-            if not 'port' in content['cometa']: 
-            	content['cometa']['port'] = int(os.environ['COMETA_PORT'])
-            return content
-        except Exception as e:
-            print e
-            return ""
+        """
+        Return a read-only snapshot of the 'config' object in the DCT. Raise ConfigError if invalid.
+        """
+        return klass.configuration().config()
 
     # Read all DCT
     @classmethod
-    def read_dct(klass):  
-        # read the DCT
-        try:
-            f = open(DCT_FILENAME)
-            #content = f.read().replace(u'\n', u'').replace(u'\r', u'')
-            content = json.loads(f.read().replace('\n', '').replace('\r', ''))
-            # get Cometa API Key and Server name from the environment
-            if not 'app_key' in content['cometa']:
-            	content['cometa']['app_key'] =  os.environ['COMETA_APIKEY']
-            if not 'server' in content['cometa']:
-            	content['cometa']['server'] = os.environ['COMETA_SERVER']
-            if not 'port' in content['cometa']: 
-            	content['cometa']['port'] = int(os.environ['COMETA_PORT'])         
-            return content
-        except Exception as e:
-            return ""
+    def read_dct(klass):
+        """
+        Return a read-only snapshot of the whole DCT. Raise ConfigError if invalid.
+        """
+        return klass.configuration().dct()
+
+    # The DCT, parsed and validated once
+    @classmethod
+    def configuration(klass):
+        """
+        Return the Configuration instance of the DCT.
+        """
+        if klass.__configuration == None:
+            klass.__configuration = Configuration(DCT_FILENAME)
+        return klass.__configuration
 
     # Get device serial number
     # in Linux hosts is the least six digits of the MAC address
@@ -188,75 +235,60 @@ class Runtime(object):
     # Get info of the current network interface
     @classmethod
     def get_network_info(klass):
+        """
+        Return the cached gateway, IP address and interface of the default route.
+        """
         # TODO: testing only
         #return {'gateway': 'N/A', 'ip_address': 'N/A'}
 
-        # get network info
-        s = subprocess.Popen('ip route', shell=True, stdout=subprocess.PIPE).stdout.read()
-        reply = {}
-        reply['gateway'] = s.split('default via')[-1].split()[0]
-        reply['ip_address'] = s.split('src')[-1].split()[0]
-        return reply
+        return klass.network().info()
+
+    # Network information with change notifications
+    @classmethod
+    def network(klass):
+        """
+        Return the NetworkMonitor instance.
+        """
+        if klass.__network == None:
+            klass.__network = NetworkMonitor()
+        return klass.__network
 
     # Simple system logger
     @classmethod
-    def syslog(klass, msg, escape=False):
+    def syslog(klass, msg, *args, **kwargs):
+        """
+        Simple system logger. The message is formatted as msg % args and written asynchronously.
+
+        escape: replace line breaks in the message
+        level: logger.DEBUG, INFO (default), WARNING or ERROR
+        """
+        klass.logger().log(klass.get_systime(), kwargs.get('level', INFO), msg, args, kwargs.get('escape', False))
+
+    # Logger with the most recent records
+    @classmethod
+    def logger(klass):
         """
-        Simple system logger.
+        Return the Logger instance.
         """
-        if escape:
-            #print ("[%d] %s" % (klass.__systime, msg.replace(u'\n', u'#015').replace(u'\r', u'#012')))
-            print ("[%d] %s" % (klass.get_systime(), msg.replace('\n', '#015').replace('\r', '#012')))
-        else:
-            print ("[%d] %s" % (klass.get_systime(), msg))
+        if klass.__logger == None:
+            klass.__logger = Logger()
+        return klass.__logger
 
     # Get list of camera devices
     @classmethod
     def list_camera_devices(klass):
-		"""
-		List all video devices and their names
-		"""
-		videodevs = ["/dev/" + x for x in os.listdir("/dev/") if x.startswith("video") ]
-
-		# Do ioctl dance to extract the name of the device
-		import fcntl
-		_IOC_NRBITS   =  8
-		_IOC_TYPEBITS =  8
-		_IOC_SIZEBITS = 14
-		_IOC_DIRBITS  =  2
-
-		_IOC_NRSHIFT = 0
-		_IOC_TYPESHIFT =(_IOC_NRSHIFT+_IOC_NRBITS)
-		_IOC_SIZESHIFT =(_IOC_TYPESHIFT+_IOC_TYPEBITS)
-		_IOC_DIRSHIFT  =(_IOC_SIZESHIFT+_IOC_SIZEBITS)
-
-		_IOC_NONE = 0
-		_IOC_WRITE = 1
-		_IOC_READ = 2
-		def _IOC(direction,type,nr,size):
-			return (((direction)  << _IOC_DIRSHIFT) |
-				((type) << _IOC_TYPESHIFT) |
-				((nr)   << _IOC_NRSHIFT) |
-				((size) << _IOC_SIZESHIFT))
-		def _IOR(type, number, size):
-			return _IOC(_IOC_READ, type, number, size)
-		def _IOW(type, number, size):
-			return _IOC(_IOC_WRITE, type, number, size)
-
-		sizeof_struct_v4l2_capability = (16 + 32 + 32 + 4 + 4 + 16)
-		VIDIOC_QUERYCAP = _IOR(ord('V'),  0, sizeof_struct_v4l2_capability)
-
-		import array
-		import struct
-		emptybuf = " " * (16 + 32 + 32 + 4 + 4 + 16) # sizeof(struct v4l2_capability)
-		buf = array.array('c', emptybuf)
-		cameranames = []
-		for dev in videodevs:
-			camera_dev = open(dev, "rw")
-			camera_fd = camera_dev.fileno()
-			fcntl.ioctl(camera_fd, VIDIOC_QUERYCAP, buf, 1)
-			cameranames.append(buf[16:48].tostring())
-#			bus_info = buf[48:80].tostring()
-			camera_dev.close()
-
-		return [videodevs, cameranames]
+        """
+        List all video devices and their names
+        """
+        devices = klass.video_inventory().devices()
+        return [[d['device'] for d in devices], [d['name'] for d in devices]]
+
+    # Inventory of video devices
+    @classmethod
+    def video_inventory(klass):
+        """
+        Return the VideoInventory instance.
+        """
+        if klass.__video == None:
+            klass.__video = VideoInventory()
+        return klass.__video
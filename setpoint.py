@@ -0,0 +1,148 @@
+""" Continuous setpoint streamer for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["SetpointStreamer"]
+
+import time
+import threading
+
+from pymavlink import mavutil
+
+# Default values
+DEFAULT_RATE = 10       # setpoints per second
+DEFAULT_WATCHDOG = 3    # seconds without an update before braking
+
+class SetpointStreamer(object):
+    """
+    Hold the current position or velocity setpoint and re-send it to the vehicle at a fixed rate,
+    since ArduPilot stops the vehicle when no setpoint is received for about 3 seconds.
+    The setpoint is encoded once and the same MAVLink buffer is re-sent at every period.
+    A watchdog brakes the vehicle when no update arrives in time.
+    """
+
+    def __init__(self, vehicle, rate=DEFAULT_RATE, watchdog=DEFAULT_WATCHDOG, brake_cb=None):
+        """
+        vehicle: the DroneKit vehicle
+        rate: setpoints sent per second
+        watchdog: seconds without an update before braking, 0 to disable
+        brake_cb: function() invoked when the watchdog brakes the vehicle
+        """
+        self.rate = rate
+        self.watchdog = watchdog
+        self.sent = 0
+        self.brakes = 0
+
+        self._vehicle = vehicle
+        self._brake_cb = brake_cb
+        self._msg = None
+        self._msgbuf = None
+        self._last_update = 0.
+        self._lock = threading.Lock()
+
+        # zero velocity setpoint in the local frame
+        self._brake_msg = vehicle.message_factory.set_position_target_local_ned_encode(
+            0,       # time_boot_ms (not used)
+            0, 0,    # target system, target component
+            mavutil.mavlink.MAV_FRAME_LOCAL_NED, # frame
+            0b0000111111000111, # type_mask (only speeds enabled)
+            0, 0, 0, # x, y, z positions (not used)
+            0, 0, 0, # x, y, z velocity in m/s
+            0, 0, 0, # x, y, z acceleration (not supported yet, ignored in GCS_Mavlink)
+            0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, msg):
+        """
+        Send a new setpoint message to the vehicle and keep streaming it.
+        """
+        with self._lock:
+            # the first send encodes the message with the vehicle target system
+            self._vehicle.send_mavlink(msg)
+            self._msg = msg
+            self._msgbuf = msg.get_msgbuf()
+            self._last_update = time.time()
+            self.sent += 1
+
+    def stop(self):
+        """
+        Stop streaming the current setpoint, without braking.
+        """
+        with self._lock:
+            self._msg = None
+            self._msgbuf = None
+
+    def brake(self):
+        """
+        Stop streaming and send a zero velocity setpoint.
+        """
+        with self._lock:
+            self._msg = None
+            self._msgbuf = None
+            self._vehicle.send_mavlink(self._brake_msg)
+            self.brakes += 1
+
+    def bind(self, vehicle):
+        """
+        Stop streaming and send the setpoints to a new vehicle connection.
+        """
+        with self._lock:
+            self._msg = None
+            self._msgbuf = None
+            self._vehicle = vehicle
+
+    def status(self):
+        """
+        Return the streamer status.
+        """
+        with self._lock:
+            return {'streaming': self._msg is not None, 'setpoint': self._msg.get_type() if self._msg else None,
+                'age': time.time() - self._last_update if self._msg else None,
+                'rate': self.rate, 'watchdog': self.watchdog, 'sent': self.sent, 'brakes': self.brakes}
+
+    def _write(self, buf):
+        """
+        Re-send an encoded setpoint, through the vehicle connection writer when available.
+        """
+        try:
+            self._vehicle._master.mav.file.write(buf)
+        except AttributeError:
+            self._vehicle.send_mavlink(self._msg)
+
+    def _run(self):
+        """
+        Thread re-sending the current setpoint at the configured rate.
+        """
+        while True:
+            time.sleep(1. / self.rate)
+            braked = False
+            with self._lock:
+                if self._msg is None:
+                    continue
+                if self.watchdog and time.time() - self._last_update > self.watchdog:
+                    self._msg = None
+                    self._msgbuf = None
+                    self._vehicle.send_mavlink(self._brake_msg)
+                    self.brakes += 1
+                    braked = True
+                else:
+                    self._write(self._msgbuf)
+                    self.sent += 1
+            if braked and self._brake_cb:
+                self._brake_cb()
@@ -0,0 +1,140 @@
+""" Shell command execution for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["ShellCommand", "MAX_TIMEOUT", "MAX_RUN_TIMEOUT", "MAX_OUTPUT"]
+
+import os
+import time
+import select
+import signal
+import threading
+import subprocess
+
+from runtime import Runtime
+import logger
+
+# Default values
+DEFAULT_TIMEOUT = 30            # seconds
+DEFAULT_MAX_OUTPUT = 1048576    # bytes of stdout + stderr
+MAX_TIMEOUT = 3600              # seconds of a command streaming its output
+MAX_RUN_TIMEOUT = 60            # seconds of a command replying with its output
+MAX_OUTPUT = 16777216           # bytes of stdout + stderr
+READ_SIZE = 4096                # bytes read from a pipe at a time
+POLL_INTERVAL = 0.01            # seconds between checks of a command that closed its pipes
+
+class ShellCommand(object):
+    """
+    A shell command executed exactly once, with a timeout and a cap on the output size.
+    Output is delivered incrementally to an optional callback as it is read from the pipes.
+    """
+
+    def __init__(self, command, timeout=DEFAULT_TIMEOUT, max_output=DEFAULT_MAX_OUTPUT, output_cb=None):
+        """
+        command: the command line passed to /bin/sh
+        timeout: seconds after which the command is killed
+        max_output: bytes of output after which the command is killed
+        output_cb: function(stream, data) invoked for every block read, stream is 'stdout' or 'stderr'
+        """
+        self.command = command
+        self.timeout = timeout
+        self.max_output = max_output
+        self.returncode = None
+        self.timed_out = False
+        self.truncated = False
+
+        self._output_cb = output_cb
+        self._proc = None
+        self._thread = None
+
+    def run(self):
+        """
+        Run the command in the calling thread until it exits, times out or exceeds the output cap.
+        Return a tuple (returncode, stdout, stderr) with the captured output.
+        """
+        captured = {'stdout': [], 'stderr': []}
+        # run the command in its own process group to be able to kill the children too
+        self._proc = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            close_fds=True, preexec_fn=os.setsid)
+        streams = {self._proc.stdout.fileno(): 'stdout', self._proc.stderr.fileno(): 'stderr'}
+        exited = False
+        try:
+            deadline = time.time() + self.timeout
+            total = 0
+            while streams:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timed_out = True
+                    break
+                ready, _, _ = select.select(streams.keys(), [], [], remaining)
+                for fd in ready:
+                    data = os.read(fd, READ_SIZE)
+                    if not data:
+                        # end of file on this pipe
+                        del streams[fd]
+                        continue
+                    if total + len(data) > self.max_output:
+                        data = data[:self.max_output - total]
+                        self.truncated = True
+                    total += len(data)
+                    captured[streams[fd]].append(data)
+                    if self._output_cb and data:
+                        self._output_cb(streams[fd], data)
+                if self.truncated:
+                    break
+            # the command may close its pipes and keep running
+            while not (self.timed_out or self.truncated) and self._proc.poll() is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timed_out = True
+                    break
+                time.sleep(min(remaining, POLL_INTERVAL))
+            exited = not (self.timed_out or self.truncated)
+        finally:
+            # the command is never left running, also when reading fails
+            if not exited:
+                self.kill()
+            self.returncode = self._proc.wait()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+        return self.returncode, ''.join(captured['stdout']), ''.join(captured['stderr'])
+
+    def start(self, done_cb=None):
+        """
+        Run the command in a background thread. The done_cb function(shell_command) is invoked on completion.
+        """
+        def target():
+            try:
+                self.run()
+            except Exception as e:
+                Runtime.syslog("Error running the shell command %s: %s", self.command, e, level=logger.WARNING)
+            if done_cb:
+                done_cb(self)
+
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def kill(self):
+        """
+        Kill the command and all its children.
+        """
+        if self._proc and self._proc.poll() is None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
@@ -0,0 +1,91 @@
+""" Startup phases for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["Startup"]
+
+import sys
+import time
+import threading
+
+class Phase(object):
+    """
+    A startup phase running in a thread.
+    """
+
+    def __init__(self, startup, name, func, args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(startup, name, func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, startup, name, func, args):
+        try:
+            self._result = startup.run(name, func, *args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self):
+        """
+        Wait for the phase to complete and return the result of its function, or raise its exception.
+        """
+        # join with a timeout to remain interruptible by SIGINT
+        while self._thread.is_alive():
+            self._thread.join(1)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class Startup(object):
+    """
+    Timed startup phases, run in sequence or concurrently.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.timings = []           # (name, start offset, duration)
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """
+        Run a phase and return the result of its function.
+        """
+        t0 = time.time()
+        try:
+            return func(*args)
+        finally:
+            t1 = time.time()
+            with self._lock:
+                self.timings.append((name, t0 - self.start_time, t1 - t0))
+            print "Startup phase %s completed in %.3f s (at %.3f s)" % (name, t1 - t0, t1 - self.start_time)
+
+    def start(self, name, func, *args):
+        """
+        Start a phase in a thread and return the Phase to wait for.
+        """
+        return Phase(self, name, func, args)
+
+    def report(self):
+        """
+        Return the timings of the completed phases.
+        """
+        with self._lock:
+            return {'total': time.time() - self.start_time,
+                'phases': [{'name': n, 'start': s, 'duration': d} for n, s, d in self.timings]}
@@ -0,0 +1,255 @@
+""" MAVLink stream rate control for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The rate of each MAVLink message is the highest rate required by the telemetry, the attribute
+subscriptions and the other services using it, such as the geofence, within [min_rate, max_rate].
+The messages not required are lowered to min_rate, or stopped when it is 0. The rates are set
+with MAV_CMD_SET_MESSAGE_INTERVAL for every message, or with REQUEST_DATA_STREAM for every
+ArduPilot stream group when the autopilot does not accept the command. Stream rates are whole
+messages per second, so a rate below 1 is rounded up. Only the rates changed since the last
+negotiation are sent to the vehicle.
+"""
+
+__all__ = ["StreamRates", "attribute_rates"]
+
+import math
+import time
+import threading
+
+from pymavlink import mavutil
+
+from runtime import Runtime
+import logger
+
+mavlink = mavutil.mavlink
+
+# Default values
+DEFAULT_MIN_RATE = 0.5      # messages per second of the messages not required
+DEFAULT_MAX_RATE = 10.
+
+# values sampled at twice the telemetry rate are at most half a period old
+OVERSAMPLING = 2.
+# rate of the attributes of the subscriptions without a max_rate
+SUBSCRIPTION_RATE = 4.
+# rate of the location checked against the geofence
+GEOFENCE_RATE = 4.
+
+# seconds waiting for the autopilot to accept MAV_CMD_SET_MESSAGE_INTERVAL
+ACK_TIMEOUT = 2.
+# seconds collecting changes before a negotiation
+SETTLE_TIME = 0.1
+
+METHODS = ('auto', 'interval', 'data_stream')
+
+# MAVLink messages updating each vehicle attribute, the ones of the HEARTBEAT are always sent at 1 Hz
+ATTRIBUTE_MESSAGES = {
+    'attitude': ('ATTITUDE',),
+    'location': ('GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED'),
+    'velocity': ('GLOBAL_POSITION_INT',),
+    'gps': ('GPS_RAW_INT',),
+    'gimbal': ('MOUNT_STATUS',),
+    'battery': ('SYS_STATUS',),
+    'ekf_ok': ('EKF_STATUS_REPORT',),
+    'rangefinder': ('RANGEFINDER',),
+    'heading': ('VFR_HUD',),
+    'armable': ('GPS_RAW_INT', 'EKF_STATUS_REPORT'),
+    'groundspeed': ('VFR_HUD',),
+    'airspeed': ('VFR_HUD',),
+    'last_heartbeat': (),
+    'state': (),
+    'mode': (),
+    'armed': (),
+}
+
+# ArduPilot stream groups of REQUEST_DATA_STREAM and their messages
+STREAMS = {
+    mavlink.MAV_DATA_STREAM_RAW_SENSORS: ('RAW_IMU', 'SCALED_IMU2', 'SCALED_PRESSURE', 'SENSOR_OFFSETS'),
+    mavlink.MAV_DATA_STREAM_EXTENDED_STATUS: ('SYS_STATUS', 'MEMINFO', 'MISSION_CURRENT', 'GPS_RAW_INT',
+        'NAV_CONTROLLER_OUTPUT', 'LIMITS_STATUS'),
+    mavlink.MAV_DATA_STREAM_RC_CHANNELS: ('SERVO_OUTPUT_RAW', 'RC_CHANNELS_RAW'),
+    mavlink.MAV_DATA_STREAM_RAW_CONTROLLER: (),
+    mavlink.MAV_DATA_STREAM_POSITION: ('GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED'),
+    mavlink.MAV_DATA_STREAM_EXTRA1: ('ATTITUDE', 'SIMSTATE', 'PID_TUNING'),
+    mavlink.MAV_DATA_STREAM_EXTRA2: ('VFR_HUD',),
+    mavlink.MAV_DATA_STREAM_EXTRA3: ('AHRS', 'HWSTATUS', 'SYSTEM_TIME', 'RANGEFINDER', 'EKF_STATUS_REPORT',
+        'VIBRATION', 'BATTERY2', 'MOUNT_STATUS'),
+}
+
+# the messages with a rate set by SET_MESSAGE_INTERVAL, and their ids
+MESSAGE_IDS = dict((name, getattr(mavlink, 'MAVLINK_MSG_ID_' + name)) for messages in STREAMS.values()
+    for name in messages if hasattr(mavlink, 'MAVLINK_MSG_ID_' + name))
+
+def attribute_rates(attributes, rate, rates=None):
+    """
+    Return the rates of the messages of vehicle attributes required at the specified rate,
+    merged with the rates specified.
+    """
+    rates = dict(rates or {})
+    for a in attributes:
+        for m in ATTRIBUTE_MESSAGES.get(a, ()):
+            rates[m] = max(rates.get(m, 0), rate)
+    return rates
+
+class StreamRates(object):
+    """
+    Negotiate with the vehicle the rates of the MAVLink messages required by the agent.
+    """
+
+    def __init__(self, vehicle, method='auto', min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE):
+        """
+        vehicle: the DroneKit vehicle
+        method: 'interval' for SET_MESSAGE_INTERVAL, 'data_stream' for REQUEST_DATA_STREAM,
+            or 'auto' for SET_MESSAGE_INTERVAL when accepted by the autopilot
+        min_rate: messages per second of the messages not required, 0 to stop them
+        max_rate: maximum messages per second of any message
+        """
+        self.method = method
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.negotiations = 0
+        self.sent = 0               # SET_MESSAGE_INTERVAL and REQUEST_DATA_STREAM messages sent
+
+        self._vehicle = None
+        self._required = {}         # source -> {message: rate}
+        self._applied = {}          # message name or stream id -> rate set
+        self._interval = None       # SET_MESSAGE_INTERVAL accepted, None until known
+        self._ack = threading.Event()
+        self._ack_result = None
+        self._changed = threading.Event()
+        self._lock = threading.Lock()
+
+        self.bind(vehicle)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def bind(self, vehicle):
+        """
+        Negotiate all the rates again with a new vehicle, after a reconnection.
+        """
+        with self._lock:
+            if self._vehicle is not None:
+                self._vehicle.remove_message_listener('COMMAND_ACK', self._on_ack)
+            self._vehicle = vehicle
+            self._applied = {}
+            self._interval = None
+            vehicle.add_message_listener('COMMAND_ACK', self._on_ack)
+        self._changed.set()
+
+    def require(self, source, rates):
+        """
+        Set the rates {message: rate} required by a source, an empty object to remove them.
+        """
+        with self._lock:
+            if rates:
+                self._required[source] = dict(rates)
+            else:
+                self._required.pop(source, None)
+        self._changed.set()
+
+    def renegotiate(self):
+        """
+        Apply a change of min_rate or max_rate.
+        """
+        self._changed.set()
+
+    def rates(self):
+        """
+        Return the rate of each required message.
+        """
+        with self._lock:
+            rates = {}
+            for required in self._required.values():
+                for m, r in required.items():
+                    rates[m] = max(rates.get(m, 0), r)
+        return dict((m, min(max(r, self.min_rate), self.max_rate)) for m, r in rates.items())
+
+    def status(self):
+        with self._lock:
+            required = dict((s, dict(r)) for s, r in self._required.items())
+        method = self.method
+        if method == 'auto' and self._interval is not None:
+            method = 'interval' if self._interval else 'data_stream'
+        return {'method': method, 'min_rate': self.min_rate, 'max_rate': self.max_rate, 'rates': self.rates(),
+            'required': required, 'negotiations': self.negotiations, 'sent': self.sent}
+
+    def _on_ack(self, vehicle, name, msg):
+        """
+        DroneKit COMMAND_ACK listener.
+        """
+        if msg.command == mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            self._ack_result = msg.result
+            self._ack.set()
+
+    def _run(self):
+        """
+        Thread negotiating the rates after every change.
+        """
+        while True:
+            self._changed.wait()
+            time.sleep(SETTLE_TIME)
+            self._changed.clear()
+            try:
+                self._negotiate()
+            except Exception as e:
+                Runtime.syslog("Error negotiating stream rates: %s", e, level=logger.WARNING)
+
+    def _negotiate(self):
+        rates = self.rates()
+        if self.method == 'data_stream' or self._interval is False:
+            self._request_streams(rates)
+        else:
+            self._set_intervals(rates)
+        self.negotiations += 1
+
+    def _set_intervals(self, rates):
+        for name, msgid in MESSAGE_IDS.items():
+            rate = rates.get(name, self.min_rate)
+            if self._applied.get(name) == rate:
+                continue
+            self._ack.clear()
+            self._vehicle.send_mavlink(self._vehicle.message_factory.command_long_encode(
+                0, 0,    # target system, target component
+                mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, # command
+                0, # confirmation
+                msgid, # param 1, message id
+                int(1e6 / rate) if rate > 0 else -1, # param 2, interval in microseconds, -1 to disable
+                0, 0, 0, 0, 0)) # param 3 ~ 7 not used
+            self.sent += 1
+            if self._interval is None and self.method == 'auto':
+                # the first command tells if the autopilot supports it
+                if not self._ack.wait(ACK_TIMEOUT) or self._ack_result != mavlink.MAV_RESULT_ACCEPTED:
+                    self._interval = False
+                    self._applied = {}
+                    self._request_streams(rates)
+                    return
+            self._interval = True
+            self._applied[name] = rate
+
+    def _request_streams(self, rates):
+        for stream, messages in STREAMS.items():
+            rate = max([rates.get(m, self.min_rate) for m in messages] or [self.min_rate])
+            hz = int(math.ceil(rate)) if rate > 0 else 0
+            if self._applied.get(stream) == hz:
+                continue
+            self._vehicle.send_mavlink(self._vehicle.message_factory.request_data_stream_encode(
+                0, 0,    # target system, target component
+                stream, hz,
+                1 if hz else 0)) # start or stop
+            self.sent += 1
+            self._applied[stream] = hz
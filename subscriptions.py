@@ -0,0 +1,226 @@
+""" Server-push vehicle attribute subscriptions for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+__all__ = ["SubscriptionManager"]
+
+import math
+import time
+import threading
+
+from runtime import Runtime
+import logger
+import utils
+
+# DroneKit attribute listener names for the agent attribute names
+LISTENER_NAMES = {'attitude':'attitude', 'location':'location', 'velocity':'velocity', 'gps':'gps_0',
+    'gimbal':'gimbal', 'battery':'battery', 'ekf_ok':'ekf_ok', 'last_heartbeat':'last_heartbeat',
+    'rangefinder':'rangefinder', 'heading':'heading', 'armable':'ekf_ok', 'state':'system_status',
+    'groundspeed':'groundspeed', 'airspeed':'airspeed', 'mode':'mode', 'armed':'armed'}
+
+# Deadband quantities: (attribute the quantity belongs to, function returning its value from the vehicle)
+DEADBANDS = {
+    'altitude': ('location', lambda v: v.location.global_relative_frame.alt),
+    'distance': ('location', lambda v: v.location.global_relative_frame),
+    'heading': ('heading', lambda v: v.heading),
+    'groundspeed': ('groundspeed', lambda v: v.groundspeed),
+    'airspeed': ('airspeed', lambda v: v.airspeed),
+    'roll': ('attitude', lambda v: math.degrees(v.attitude.roll)),
+    'pitch': ('attitude', lambda v: math.degrees(v.attitude.pitch)),
+    'yaw': ('attitude', lambda v: math.degrees(v.attitude.yaw)),
+    'voltage': ('battery', lambda v: v.battery.voltage),
+    'level': ('battery', lambda v: v.battery.level),
+}
+
+# Deadband quantities that are angles in degrees
+ANGLES = ('heading', 'roll', 'pitch', 'yaw')
+
+# Period of the thread pushing rate-limited and refresh updates
+TICK = 0.05
+
+def _delta(key, last, value):
+    """Return the absolute change of a deadband quantity."""
+    if last is None or value is None:
+        return float('inf') if last is not value else 0.
+    if key == 'distance':
+        return utils.get_distance_meters(last, value)
+    d = abs(value - last)
+    if key in ANGLES:
+        d = d % 360.
+        d = min(d, 360. - d)
+    return d
+
+class Subscription(object):
+    """
+    A client subscription to a set of vehicle attributes.
+    """
+
+    def __init__(self, sid, attributes, max_rate, deadband, refresh):
+        self.sid = sid
+        self.attributes = attributes
+        self.min_period = 1. / max_rate if max_rate else 0.
+        self.deadband = deadband
+        self.refresh = refresh
+
+        self.last_push = 0.
+        self.last_values = {}       # attribute values at the last push
+        self.last_deadband = {}     # deadband quantities at the last push
+        self.pending = set()        # attributes changed beyond the deadband and not pushed yet
+
+class SubscriptionManager(object):
+    """
+    Push vehicle attribute updates upstream only when they change beyond a deadband,
+    driven by DroneKit attribute listeners and limited to a maximum rate per subscription.
+    """
+
+    def __init__(self, vehicle, getters, send_cb):
+        """
+        vehicle: the DroneKit vehicle
+        getters: dictionary of functions returning the value of each agent attribute
+        send_cb: function(subscription_id, attributes) invoked to push an update upstream
+        """
+        self._vehicle = vehicle
+        self._getters = getters
+        self._send_cb = send_cb
+        self._subscriptions = {}
+        self._listening = {}        # DroneKit listener name -> number of subscribed attributes
+        self._next_sid = 1
+        self._lock = threading.RLock()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def subscribe(self, attributes, max_rate=None, deadband=None, refresh=None):
+        """
+        Add a subscription and return its id.
+
+        attributes: list of agent attribute names
+        max_rate: maximum number of updates per second
+        deadband: dictionary of thresholds {'altitude': 0.5, 'heading': 2.0}
+        refresh: maximum interval in seconds between updates, regardless of changes
+        """
+        deadband = deadband or {}
+        for key in deadband:
+            if key not in DEADBANDS or DEADBANDS[key][0] not in attributes:
+                raise ValueError("Invalid deadband %s" % key)
+        with self._lock:
+            sid = self._next_sid
+            self._next_sid += 1
+            sub = Subscription(sid, list(attributes), max_rate, deadband, refresh)
+            self._subscriptions[sid] = sub
+            for name in set(LISTENER_NAMES[a] for a in attributes):
+                if self._listening.get(name, 0) == 0:
+                    self._vehicle.add_attribute_listener(name, self._on_attribute)
+                self._listening[name] = self._listening.get(name, 0) + 1
+            # push the initial values
+            self._push(sub, sub.attributes, time.time())
+        return sid
+
+    def unsubscribe(self, sid):
+        """
+        Remove a subscription. Return False if the subscription does not exist.
+        """
+        with self._lock:
+            sub = self._subscriptions.pop(sid, None)
+            if sub is None:
+                return False
+            for name in set(LISTENER_NAMES[a] for a in sub.attributes):
+                self._listening[name] -= 1
+                if self._listening[name] == 0:
+                    self._vehicle.remove_attribute_listener(name, self._on_attribute)
+        return True
+
+    def bind(self, vehicle):
+        """
+        Move the listeners of the active subscriptions to a new vehicle connection.
+        """
+        with self._lock:
+            for name in self._listening:
+                if self._listening[name] > 0:
+                    try:
+                        self._vehicle.remove_attribute_listener(name, self._on_attribute)
+                    except Exception:
+                        pass
+                    vehicle.add_attribute_listener(name, self._on_attribute)
+            self._vehicle = vehicle
+
+    def subscriptions(self):
+        """
+        Return the list of active subscriptions.
+        """
+        with self._lock:
+            return [{'subscription': s.sid, 'attributes': s.attributes, 'deadband': s.deadband,
+                'max_rate': 1. / s.min_period if s.min_period else None, 'refresh': s.refresh}
+                for s in self._subscriptions.values()]
+
+    def _on_attribute(self, vehicle, name, value):
+        """
+        DroneKit attribute listener.
+        """
+        now = time.time()
+        with self._lock:
+            for sub in self._subscriptions.values():
+                changed = [a for a in sub.attributes if LISTENER_NAMES[a] == name and self._changed(sub, a)]
+                if not changed:
+                    continue
+                sub.pending.update(changed)
+                if now - sub.last_push >= sub.min_period:
+                    self._push(sub, sub.pending, now)
+
+    def _changed(self, sub, attribute):
+        """
+        Check if an attribute changed beyond the subscription deadband since the last push.
+        """
+        keys = [k for k in sub.deadband if DEADBANDS[k][0] == attribute]
+        if not keys:
+            return self._getters[attribute]() != sub.last_values.get(attribute)
+        for k in keys:
+            if _delta(k, sub.last_deadband.get(k), DEADBANDS[k][1](self._vehicle)) > sub.deadband[k]:
+                return True
+        return False
+
+    def _push(self, sub, attributes, now):
+        """
+        Send an update with the specified attributes and reset the deadband references.
+        """
+        values = {}
+        for a in attributes:
+            values[a] = self._getters[a]()
+            sub.last_values[a] = values[a]
+        for k in sub.deadband:
+            if DEADBANDS[k][0] in attributes:
+                sub.last_deadband[k] = DEADBANDS[k][1](self._vehicle)
+        sub.pending = set()
+        sub.last_push = now
+        try:
+            self._send_cb(sub.sid, values)
+        except Exception as e:
+            Runtime.syslog("Error sending the update of subscription %s: %s", sub.sid, e, level=logger.WARNING)
+
+    def _run(self):
+        """
+        Thread pushing updates held back by the rate limit and periodic refresh updates.
+        """
+        while True:
+            time.sleep(TICK)
+            now = time.time()
+            with self._lock:
+                for sub in self._subscriptions.values():
+                    if sub.pending and now - sub.last_push >= sub.min_period:
+                        self._push(sub, sub.pending, now)
+                    elif sub.refresh and now - sub.last_push >= sub.refresh:
+                        self._push(sub, sub.attributes, now)
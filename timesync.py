@@ -0,0 +1,115 @@
+""" Server clock synchronization for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The server stamps its reply to a request with its clock, at some instant between the local
+monotonic times the request was sent (t0) and the reply received (t1). The offset between the
+server clock and the monotonic clock is therefore in the interval
+[server_time - t1, server_time + resolution - t0]. Intersecting the intervals of several samples,
+corrected for the estimated drift, narrows the offset, and half the width of the intersection
+is the error bound.
+"""
+
+__all__ = ["TimeSync"]
+
+import time
+import threading
+
+# Samples kept for the estimate
+WINDOW = 16
+# Minimum time in seconds between the first and the last sample to estimate the drift
+MIN_DRIFT_SPAN = 600.
+# Maximum drift of the local oscillator (100 ppm), bounding the drift estimate and the error growth
+MAX_DRIFT = 100e-6
+
+class TimeSync(object):
+    """
+    Estimate of the server time from a local monotonic clock.
+    """
+
+    def __init__(self, clock, window=WINDOW):
+        """
+        clock: function returning the local monotonic time in seconds
+        window: number of samples kept
+        """
+        self._clock = clock
+        self._window = window
+        self._samples = []          # (t1, low offset, high offset)
+        self._lock = threading.Lock()
+
+        self.offset = None          # server time - monotonic time at the reference time
+        self.error = None           # error bound of the offset in seconds
+        self.drift = 0.             # estimated drift in seconds per second
+        self._ref = None            # monotonic reference time of the estimate
+
+    def add_sample(self, t0, t1, server_time, resolution=1.):
+        """
+        Add a sample of the server clock.
+
+        t0, t1: monotonic times the request was sent and the reply received
+        server_time: server time stamped in the reply
+        resolution: resolution of the server time in seconds
+        """
+        with self._lock:
+            self._samples.append((t1, server_time - t1, server_time + resolution - t0))
+            self._samples = self._samples[-self._window:]
+            self._estimate()
+
+    def _estimate(self):
+        """
+        Update the drift and the offset from the samples.
+        """
+        samples = self._samples
+        first, last = samples[0], samples[-1]
+        drift = 0.
+        if last[0] - first[0] >= MIN_DRIFT_SPAN:
+            drift = ((last[1] + last[2]) - (first[1] + first[2])) / 2. / (last[0] - first[0])
+            drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift))
+        ref = last[0]
+        low = max(s[1] + drift * (ref - s[0]) for s in samples)
+        high = min(s[2] + drift * (ref - s[0]) for s in samples)
+        if low > high:
+            # the server or the local clock stepped: start over from the last sample
+            self._samples = [last]
+            drift = 0.
+            low, high = last[1], last[2]
+        self.drift = drift
+        self.offset = (low + high) / 2.
+        self.error = (high - low) / 2.
+        self._ref = ref
+
+    def now(self):
+        """
+        Return the estimated server time in seconds and its error bound, or the local
+        wall clock time and None before the first sample.
+        """
+        with self._lock:
+            if self.offset is None:
+                return time.time(), None
+            t = self._clock()
+            elapsed = abs(t - self._ref)
+            return t + self.offset + self.drift * (t - self._ref), self.error + MAX_DRIFT * elapsed
+
+    def status(self):
+        """
+        Return the synchronization status.
+        """
+        server_time, error = self.now()
+        with self._lock:
+            return {'synchronized': self.offset is not None, 'time_ms': int(server_time * 1000),
+                'error_ms': error * 1000 if error is not None else None, 'drift_ppm': self.drift * 1e6,
+                'samples': len(self._samples)}
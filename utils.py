@@ -16,7 +16,6 @@ limitations under the License.
 """
 
 import math
-from dronekit import LocationGlobal, LocationGlobalRelative
 
 def check_rpc_msg(req):
     ret = False
@@ -49,6 +48,10 @@ def isanumber(x):
             return False
     return True
 
+def isnumber(x):
+    # a JSON number, not a string that converts to a number nor a boolean
+    return isinstance(x, (int, long, float)) and not isinstance(x, bool)
+
 """
 Functions to make it easy to convert between the different frames-of-reference. In particular these
 make it easy to navigate in terms of "metres from the current position" when using commands that take 
@@ -61,6 +64,10 @@ Specifically, it provides:
 * get_location_meters - Get LocationGlobal (decimal degrees) at distance (m) North & East of a given LocationGlobal.
 * get_distance_meters - Get the distance between two LocationGlobal objects in metres
 * get_bearing - Get the bearing in degrees to a LocationGlobal
+
+The functions are scalar wrappers of the vectorized functions in the geodesy module, which should be used
+directly to process many positions at once or for the more accurate great circle and ellipsoid methods.
+DroneKit and NumPy are imported on first use, to keep them out of the agent startup path.
 """
 
 def get_location_meters(original_location, dNorth, dEast):
@@ -77,14 +84,12 @@ def get_location_meters(original_location, dNorth, dEast):
     For more information see:
     http://gis.stackexchange.com/questions/2951/algorithm-for-offsetting-a-latitude-longitude-by-some-amount-of-meters
     """
-    earth_radius = 6378137.0 #Radius of "spherical" earth
-    #Coordinate offsets in radians
-    dLat = dNorth/earth_radius
-    dLon = dEast/(earth_radius*math.cos(math.pi*original_location.lat/180))
-
-    #New position in decimal degrees
-    newlat = original_location.lat + (dLat * 180/math.pi)
-    newlon = original_location.lon + (dLon * 180/math.pi)
+    from dronekit import LocationGlobal, LocationGlobalRelative
+    import geodesy
+
+    newlat, newlon = geodesy.offset(original_location.lat, original_location.lon, dNorth, dEast)
+    newlat = float(newlat)
+    newlon = float(newlon)
     if type(original_location) is LocationGlobal:
         targetlocation=LocationGlobal(newlat, newlon,original_location.alt)
     elif type(original_location) is LocationGlobalRelative:
@@ -103,9 +108,8 @@ def get_distance_meters(aLocation1, aLocation2):
     earth's poles. It comes from the ArduPilot test code: 
     https://github.com/diydrones/ardupilot/blob/master/Tools/autotest/common.py
     """
-    dlat = aLocation2.lat - aLocation1.lat
-    dlong = aLocation2.lon - aLocation1.lon
-    return math.sqrt((dlat*dlat) + (dlong*dlong)) * 1.113195e5
+    import geodesy
+    return float(geodesy.distance(aLocation1.lat, aLocation1.lon, aLocation2.lat, aLocation2.lon))
 
 
 def get_bearing(aLocation1, aLocation2):
@@ -116,9 +120,5 @@ def get_bearing(aLocation1, aLocation2):
     earth's poles. It comes from the ArduPilot test code: 
     https://github.com/diydrones/ardupilot/blob/master/Tools/autotest/common.py
     """ 
-    off_x = aLocation2.lon - aLocation1.lon
-    off_y = aLocation2.lat - aLocation1.lat
-    bearing = 90.00 + math.atan2(-off_y, off_x) * 57.2957795
-    if bearing < 0:
-        bearing += 360.00
-    return bearing;
+    import geodesy
+    return float(geodesy.bearing(aLocation1.lat, aLocation1.lon, aLocation2.lat, aLocation2.lon))
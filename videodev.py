@@ -0,0 +1,197 @@
+""" Video device inventory for the Cometa agent for DroneKit.
+
+Author: Marco Graziano
+"""
+__license__ = """
+Copyright 2016 Visible Energy Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Each /dev/video* node is opened and probed with the V4L2 ioctls only once, when it appears.
+The inventory is kept up to date with inotify events on /dev, or by comparing the list of nodes
+in /dev when inotify is not available, so that reading it never opens a device in use.
+"""
+
+__all__ = ["VideoInventory"]
+
+import os
+import time
+import fcntl
+import struct
+import threading
+
+import inotify
+
+DEV_DIR = '/dev'
+PREFIX = 'video'
+
+# Seconds to wait for udev to set the permissions of a new device node
+SETTLE_TIME = 0.5
+
+# ioctl numbers from <asm-generic/ioctl.h>
+_IOC_NRSHIFT = 0
+_IOC_TYPESHIFT = 8
+_IOC_SIZESHIFT = 16
+_IOC_DIRSHIFT = 30
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _IOC(direction, type, nr, size):
+    return (direction << _IOC_DIRSHIFT) | (type << _IOC_TYPESHIFT) | (nr << _IOC_NRSHIFT) | (size << _IOC_SIZESHIFT)
+
+# struct v4l2_capability {u8 driver[16]; u8 card[32]; u8 bus_info[32]; u32 version; u32 capabilities; u32 device_caps; u32 reserved[3];}
+_CAPABILITY = struct.Struct('16s32s32sIII12x')
+# struct v4l2_fmtdesc {u32 index; u32 type; u32 flags; u8 description[32]; u32 pixelformat; u32 reserved[4];}
+_FMTDESC = struct.Struct('III32sI16x')
+# struct v4l2_frmsizeenum {u32 index; u32 pixel_format; u32 type; union {discrete; stepwise} u32[6]; u32 reserved[2];}
+_FRMSIZEENUM = struct.Struct('III6I8x')
+
+VIDIOC_QUERYCAP = _IOC(_IOC_READ, ord('V'), 0, _CAPABILITY.size)
+VIDIOC_ENUM_FMT = _IOC(_IOC_READ | _IOC_WRITE, ord('V'), 2, _FMTDESC.size)
+VIDIOC_ENUM_FRAMESIZES = _IOC(_IOC_READ | _IOC_WRITE, ord('V'), 74, _FRMSIZEENUM.size)
+
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+
+def _string(s):
+    return s.split('\0', 1)[0]
+
+def _fourcc(code):
+    return struct.pack('<I', code).rstrip('\0 ')
+
+def _frame_sizes(fd, pixelformat):
+    """
+    Return the discrete frame sizes [[width, height], ...] or the range
+    {'min': [width, height], 'max': [width, height], 'step': [width, height]} of a pixel format.
+    """
+    sizes = []
+    index = 0
+    while True:
+        try:
+            buf = fcntl.ioctl(fd, VIDIOC_ENUM_FRAMESIZES, _FRMSIZEENUM.pack(index, pixelformat, 0, 0, 0, 0, 0, 0, 0))
+        except IOError:
+            break
+        fields = _FRMSIZEENUM.unpack(buf)
+        if fields[2] != V4L2_FRMSIZE_TYPE_DISCRETE:
+            # continuous or stepwise sizes are described by a single entry
+            min_w, max_w, step_w, min_h, max_h, step_h = fields[3:]
+            return {'min': [min_w, min_h], 'max': [max_w, max_h], 'step': [step_w, step_h]}
+        sizes.append([fields[3], fields[4]])
+        index += 1
+    return sizes
+
+def _formats(fd):
+    """
+    Return the list of capture formats of a device.
+    """
+    formats = []
+    index = 0
+    while True:
+        try:
+            buf = fcntl.ioctl(fd, VIDIOC_ENUM_FMT, _FMTDESC.pack(index, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, '', 0))
+        except IOError:
+            break
+        _, _, flags, description, pixelformat = _FMTDESC.unpack(buf)
+        formats.append({'format': _fourcc(pixelformat), 'description': _string(description),
+            'sizes': _frame_sizes(fd, pixelformat)})
+        index += 1
+    return formats
+
+def probe(device):
+    """
+    Query the capabilities, formats and frame sizes of a video device.
+    """
+    # non-blocking open does not wait for a device busy streaming
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        buf = fcntl.ioctl(fd, VIDIOC_QUERYCAP, '\0' * _CAPABILITY.size)
+        driver, card, bus_info, version, capabilities, device_caps = _CAPABILITY.unpack(buf)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        info = {'device': device, 'name': _string(card), 'driver': _string(driver), 'bus_info': _string(bus_info),
+            'version': "%d.%d.%d" % (version >> 16, (version >> 8) & 0xff, version & 0xff),
+            'capabilities': capabilities, 'capture': bool(capabilities & V4L2_CAP_VIDEO_CAPTURE), 'formats': []}
+        if info['capture']:
+            info['formats'] = _formats(fd)
+        return info
+    finally:
+        os.close(fd)
+
+class VideoInventory(object):
+    """
+    Cached information of the video devices, updated on hotplug.
+    """
+
+    def __init__(self):
+        self._devices = None        # device path -> information
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _probe(self, device):
+        try:
+            return probe(device)
+        except (IOError, OSError) as e:
+            return {'device': device, 'name': '', 'error': os.strerror(e.errno) if e.errno else str(e)}
+
+    def _nodes(self):
+        return set(os.path.join(DEV_DIR, x) for x in os.listdir(DEV_DIR) if x.startswith(PREFIX))
+
+    def _sync(self):
+        """
+        Probe the new devices and remove the missing ones.
+        """
+        nodes = self._nodes()
+        with self._lock:
+            known = set(self._devices or {})
+        added = dict((d, self._probe(d)) for d in nodes - known)
+        with self._lock:
+            devices = dict((d, i) for d, i in (self._devices or {}).items() if d in nodes)
+            devices.update(added)
+            self._devices = devices
+
+    def devices(self):
+        """
+        Return the list of device information sorted by device path.
+        """
+        if self._devices is None or not self._thread:
+            # without watching, only listing /dev detects changes
+            self._sync()
+        with self._lock:
+            return [self._devices[d] for d in sorted(self._devices)]
+
+    def watch(self):
+        """
+        Start watching /dev for video devices added or removed.
+        """
+        if self._thread or not inotify.available():
+            return
+        ino = inotify.Inotify()
+        ino.add_watch(DEV_DIR, inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_ATTRIB | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM)
+        self._sync()
+        self._thread = threading.Thread(target=self._watch, args=(ino,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self, ino):
+        while True:
+            events = ino.read()
+            changed = set(os.path.join(DEV_DIR, e[2]) for e in events if e[2].startswith(PREFIX))
+            if not changed:
+                continue
+            time.sleep(SETTLE_TIME)
+            with self._lock:
+                # probe again the nodes created or whose permissions changed
+                for d in changed:
+                    self._devices.pop(d, None)
+            self._sync()